@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# Compare the encoders compress_image() could use on synthetic disk images that look like eupneaos-uefi.img: a mostly
+# empty ext4 with clustered files, firmware-like binary blobs, shared libraries and text configs.
+# Reports the compression ratio, compression and decompression throughput and the peak memory of every encoder and
+# level. The images are generated from a fixed seed, so the results are reproducible without network access.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+
+from functions import *
+from filesystem import rmdir
+from runner import run
+import zstd_seekable
+
+# name -> compress command, decompress command. {level} is replaced by every level of the encoder.
+ENCODERS = {
+    "xz": (["xz", "-{level}", "-T0", "-c"], ["xz", "-dc", "-T0"], [1, 6, 9]),
+    "zstd": (["zstd", "-{level}", "--long=27", "-T0", "-q", "-c"], ["zstd", "-dc", "--long=27", "-q"], [3, 9, 15, 19]),
+    "gzip": (["gzip", "-{level}", "-c"], ["gzip", "-dc"], [6, 9]),
+    "pigz": (["pigz", "-{level}", "-c"], ["pigz", "-dc"], [6, 9]),
+    "bzip2": (["bzip2", "-{level}", "-c"], ["bzip2", "-dc"], [9]),
+    "lz4": (["lz4", "-{level}", "-c"], ["lz4", "-dc"], [1, 9]),
+    "rar": (["rar", "a", "-m{level}", "-idq", "-si", "{output}"], ["rar", "p", "-inul", "{archive}"], [3, 5]),
+}
+WORDS = ["enable", "disable", "device", "kernel", "module", "firmware", "options", "timeout", "path", "default",
+         "service", "target", "after", "wants", "exec", "true", "false", "auto", "none", "root", "user", "group"]
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", dest="work_dir", default="/tmp/eupneaos-compression-benchmark",
+                        help="Directory to create the synthetic images and archives in.")
+    parser.add_argument("--size", dest="size_mib", type=int, default=1024, help="Image size in MiB.")
+    parser.add_argument("--data", dest="data_mib", type=int, default=160, help="MiB of files in the image.")
+    parser.add_argument("--encoders", dest="encoders", default=",".join(ENCODERS) + ",zstd-seekable",
+                        help="Comma separated encoders to run. Encoders that aren't installed are skipped.")
+    parser.add_argument("--seed", dest="seed", type=int, default=42, help="Seed of the synthetic content.")
+    parser.add_argument("--json", dest="json_path", default="", help="Write the results to this json file.")
+    return parser.parse_args()
+
+
+#######################################################################################
+#                                SYNTHETIC IMAGE                                      #
+#######################################################################################
+def __text_file(rng: random.Random, size: int) -> bytes:
+    lines = []
+    while sum(len(line) + 1 for line in lines) < size:
+        lines.append(f"{rng.choice(WORDS)}_{rng.choice(WORDS)}={rng.choice(WORDS)} # {rng.randint(0, 9999)}")
+    return "\n".join(lines).encode()[:size]
+
+
+# Firmware is mostly incompressible code with tables, padding and strings in between
+def __firmware_blob(rng: random.Random, size: int) -> bytes:
+    blob = bytearray()
+    while len(blob) < size:
+        kind = rng.random()
+        length = rng.randint(512, 65536)
+        if kind < 0.6:
+            blob += rng.randbytes(length)
+        elif kind < 0.8:
+            blob += bytes([rng.randrange(256)]) * length  # padding
+        else:
+            blob += rng.randbytes(64) * (length // 64)  # repeated tables
+    return bytes(blob[:size])
+
+
+# Shared libraries compress to about a third: code with a small alphabet of opcodes plus symbol names
+def __library(rng: random.Random, size: int) -> bytes:
+    opcodes = [rng.randbytes(rng.randint(1, 6)) for _ in range(200)]
+    library = bytearray(b"\x7fELF\x02\x01\x01" + bytes(57))
+    while len(library) < size:
+        if rng.random() < 0.9:
+            library += rng.choice(opcodes)
+        else:
+            library += f"{rng.choice(WORDS)}_{rng.choice(WORDS)}\0".encode()
+    return bytes(library[:size])
+
+
+# Write a tree of configs, libraries and firmware with data_size bytes in total
+def create_tree(tree_path: str, data_size: int, rng: random.Random) -> None:
+    kinds = [("etc", __text_file, 0.1, (200, 16384)), ("usr/lib64", __library, 0.5, (16384, 4194304)),
+             ("lib/firmware", __firmware_blob, 0.4, (4096, 8388608))]
+    for dir_name, generate, share, (min_size, max_size) in kinds:
+        written = 0
+        file_number = 0
+        while written < data_size * share:
+            file_dir = f"{tree_path}/{dir_name}/{rng.choice(WORDS)}"
+            mkdir(file_dir, create_parents=True)
+            file_size = min(rng.randint(min_size, max_size), int(data_size * share - written) + min_size)
+            with open(f"{file_dir}/{file_number}", "wb") as file:
+                file.write(generate(rng, file_size))
+            written += file_size
+            file_number += 1
+    for root, dirs, files in os.walk(tree_path):
+        for name in dirs + files + [""]:
+            os.utime(os.path.join(root, name), (0, 0))
+
+
+# mkfs.ext4 -d places the files like a real build does. Without it the data is written in a few clusters.
+# The uuid, hash seed and timestamps are fixed, so the same seed gives the same image apart from the inode change times
+# (ctime can't be set from userspace). Those are a few bytes per inode and don't change the results.
+def create_image(image_path: str, size: int, data_size: int, seed: int) -> None:
+    rng = random.Random(seed)
+    tree_path = f"{image_path}.tree"
+    if path_exists(tree_path):
+        rmdir(tree_path, keep_dir=False)
+    create_tree(tree_path, data_size, rng)
+    rmfile(image_path)
+    with open(image_path, "wb") as image:
+        image.truncate(size)
+    if shutil.which("mkfs.ext4"):
+        fs_uuid = str(uuid.UUID(int=seed))
+        os.environ["E2FSPROGS_FAKE_TIME"] = "1"
+        run(["mkfs.ext4", "-q", "-F", "-U", fs_uuid, "-E", f"root_owner=0:0,hash_seed={fs_uuid}", "-d", tree_path,
+             image_path], echo=False)
+    else:
+        print_warning("mkfs.ext4 not found, writing the files in clusters instead")
+        with open(image_path, "r+b") as image:
+            for root, dirs, files in sorted(os.walk(tree_path)):
+                image.seek(rng.randrange(0, size - data_size, 1048576))
+                for name in sorted(files):
+                    with open(os.path.join(root, name), "rb") as file:
+                        image.write(file.read())
+    rmdir(tree_path, keep_dir=False)
+
+
+#######################################################################################
+#                                    ENCODERS                                         #
+#######################################################################################
+# Return a field of /proc/<pid>/status in KiB and the pids of the children, 0 and [] once the process is gone
+def __read_process(pid: int, field: str) -> tuple:
+    try:
+        with open(f"/proc/{pid}/status", "r") as status_file:
+            value = next((int(line.split()[1]) for line in status_file if line.startswith(f"{field}:")), 0)
+        children = []
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r") as children_file:
+                children.extend(int(child) for child in children_file.read().split())
+        return value, children
+    except (FileNotFoundError, ProcessLookupError, ValueError):
+        return 0, []
+
+
+# Run a command and return its wall time and peak memory (KiB).
+# ru_maxrss can't be used: the forked python is counted as well, since Linux keeps the maxrss across exec. Instead the
+# resident memory of the process and its children is sampled while it runs, VmHWM catches the peaks in between of the
+# process itself.
+def measure_command(command: list, stdin_path: str, stdout_path: str) -> tuple:
+    peak_memory = 0
+    with open(stdin_path, "rb") as stdin, open(stdout_path, "wb") as stdout:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+        while process.poll() is None:
+            high_water_mark, children = __read_process(process.pid, "VmHWM")
+            tree_memory = __read_process(process.pid, "VmRSS")[0]
+            while children:
+                child_memory, grandchildren = __read_process(children.pop(), "VmRSS")
+                tree_memory += child_memory
+                children.extend(grandchildren)
+            peak_memory = max(peak_memory, high_water_mark, tree_memory)
+            time.sleep(0.01)
+        wall_time = time.perf_counter() - start_time
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return wall_time, peak_memory
+
+
+def __format_command(command: list, level: int, output_path: str) -> list:
+    return [arg.format(level=level, output=output_path, archive=output_path) for arg in command]
+
+
+def benchmark_encoder(name: str, level: int, image_path: str, work_dir: str) -> dict:
+    compress_command, decompress_command, _ = ENCODERS[name]
+    archive_path = f"{work_dir}/image.{name}"
+    rmfile(archive_path)
+    if "{output}" in " ".join(compress_command):  # rar writes the archive itself
+        compress_time, compress_memory = measure_command(__format_command(compress_command, level, archive_path),
+                                                         image_path, os.devnull)
+    else:
+        compress_time, compress_memory = measure_command(__format_command(compress_command, level, archive_path),
+                                                         image_path, archive_path)
+    decompress_stdin = os.devnull if "{archive}" in " ".join(decompress_command) else archive_path
+    decompress_time, decompress_memory = measure_command(__format_command(decompress_command, level, archive_path),
+                                                         decompress_stdin, os.devnull)
+    result = {"encoder": name, "level": level, "archive_bytes": os.path.getsize(archive_path),
+              "compress_time": compress_time, "decompress_time": decompress_time,
+              "compress_memory_kib": compress_memory, "decompress_memory_kib": decompress_memory}
+    rmfile(archive_path)
+    return result
+
+
+# zstd_seekable.py runs as a separate process, so that the zstd processes it starts per frame are measured as well
+def benchmark_zstd_seekable(level: int, image_path: str, work_dir: str) -> dict:
+    archive_path = f"{work_dir}/image.zst"
+    script_path = f"{os.path.dirname(os.path.abspath(__file__))}/zstd_seekable.py"
+    compress_time, compress_memory = measure_command(
+        [sys.executable, script_path, "compress", image_path, "--output", archive_path, "--level", str(level)],
+        os.devnull, os.devnull)
+    decompress_time, decompress_memory = measure_command(
+        [sys.executable, script_path, "decompress", archive_path, f"{work_dir}/decompressed.img"], os.devnull,
+        os.devnull)
+    result = {"encoder": "zstd-seekable", "level": level, "archive_bytes": os.path.getsize(archive_path),
+              "compress_time": compress_time, "decompress_time": decompress_time,
+              "compress_memory_kib": compress_memory, "decompress_memory_kib": decompress_memory}
+    rmfile(archive_path)
+    rmfile(f"{work_dir}/decompressed.img")
+    return result
+
+
+if __name__ == "__main__":
+    args = process_args()
+    mkdir(args.work_dir, create_parents=True)
+    image_path = f"{args.work_dir}/image.img"
+    image_size = args.size_mib * 1048576
+    print_status(f"Creating {args.size_mib} MiB image with {args.data_mib} MiB of files")
+    create_image(image_path, image_size, args.data_mib * 1048576, args.seed)
+
+    results = []
+    for name in args.encoders.split(","):
+        if name == "zstd-seekable":
+            if shutil.which("zstd"):
+                print_status(f"Running zstd-seekable -{zstd_seekable.ZSTD_LEVEL}")
+                results.append(benchmark_zstd_seekable(zstd_seekable.ZSTD_LEVEL, image_path, args.work_dir))
+            continue
+        if name not in ENCODERS:
+            print_error(f"Unknown encoder {name}")
+            exit(1)
+        if not shutil.which(ENCODERS[name][0][0]):
+            print_warning(f"{name} is not installed, skipping it")
+            continue
+        for level in ENCODERS[name][2]:
+            print_status(f"Running {name} -{level}")
+            results.append(benchmark_encoder(name, level, image_path, args.work_dir))
+    rmfile(image_path)
+
+    print_header(f"{args.size_mib} MiB image, {args.data_mib} MiB of files")
+    # peak memory is the resident set of the encoder, for zstd-seekable including the zstd processes it started
+    print(f"{'encoder':<16}{'level':>6}{'ratio':>8}{'size (MiB)':>12}{'comp (MiB/s)':>14}{'decomp (MiB/s)':>16}"
+          f"{'comp mem (MiB)':>16}{'decomp mem (MiB)':>18}")
+    for result in sorted(results, key=lambda r: r["archive_bytes"]):
+        result["ratio"] = image_size / result["archive_bytes"]
+        result["compress_mib_s"] = args.size_mib / result["compress_time"]
+        result["decompress_mib_s"] = args.size_mib / result["decompress_time"]
+        print(f"{result['encoder']:<16}{result['level']:>6}{result['ratio']:>8.1f}"
+              f"{result['archive_bytes'] / 1048576:>12.1f}{result['compress_mib_s']:>14.1f}"
+              f"{result['decompress_mib_s']:>16.1f}{result['compress_memory_kib'] / 1024:>16.1f}"
+              f"{result['decompress_memory_kib'] / 1024:>18.1f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump({"size_mib": args.size_mib, "data_mib": args.data_mib, "seed": args.seed, "results": results},
+                      json_file, indent=2)
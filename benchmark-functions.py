@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Time the filesystem helpers of functions.py (cpdir, cpfile, rmdir, mkdir, create_tree) against their coreutils
+# equivalents on synthetic trees shaped like linux-firmware and a Fedora rootfs: deep nesting, many small files, a few
+# huge blobs and symlinks. Runs on the filesystem of --dir or on a tmpfs mounted there with --tmpfs.
+# With --baseline the results are compared to an earlier --json output, to catch regressions in the helpers.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import time
+
+from functions import *
+from filesystem import cpdir, cpfile, rmdir
+
+WORDS = ["amd", "intel", "qcom", "mediatek", "rtl", "brcm", "ath", "iwlwifi", "nvidia", "i915", "sof", "cirrus",
+         "python3", "share", "locale", "systemd", "network", "kernel", "modules", "include", "doc", "licenses"]
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", dest="work_dir", default="/tmp/eupneaos-functions-benchmark",
+                        help="Directory to create the synthetic trees in.")
+    parser.add_argument("--tmpfs", dest="tmpfs", action="store_true", default=False,
+                        help="Mount a tmpfs on --dir for the benchmark (needs root).")
+    parser.add_argument("--scale", dest="scale", type=float, default=1,
+                        help="Multiplies the number and size of the files of the trees.")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3, help="Runs per operation, the median is used.")
+    parser.add_argument("--trees", dest="trees", default="firmware,rootfs", help="Comma separated trees to run.")
+    parser.add_argument("--json", dest="json_path", default="", help="Write the results to this json file.")
+    parser.add_argument("--baseline", dest="baseline_path", default="",
+                        help="json file of an earlier run to compare the functions.py times to.")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=20,
+                        help="Percentage a helper may be slower than in the baseline before it counts as a regression.")
+    return parser.parse_args()
+
+
+#######################################################################################
+#                                  SYNTHETIC TREES                                    #
+#######################################################################################
+def __write_file(path: str, size: int, rng: random.Random) -> None:
+    with open(path, "wb") as file:
+        if size <= 1048576:
+            file.write(rng.randbytes(size))
+            return
+        block = rng.randbytes(1048576)
+        for offset in range(0, size, len(block)):  # different data in every MiB, so nothing can be deduplicated
+            file.write(offset.to_bytes(8, "little") + block[8:min(len(block), size - offset)])
+
+
+# linux-firmware: a few thousand blobs of 10K-2M in vendor dirs two to four levels deep, a few huge blobs (GPU and DSP
+# firmware) and a lot of relative symlinks between vendors and versions
+def create_firmware_tree(tree_path: str, scale: float, rng: random.Random) -> None:
+    files = []
+    for index in range(int(3000 * scale)):
+        vendor_dir = os.path.join(tree_path, *[rng.choice(WORDS[:12]) for _ in range(rng.randint(1, 3))])
+        mkdir(vendor_dir, create_parents=True)
+        file_path = f"{vendor_dir}/fw-{index}.bin"
+        __write_file(file_path, int(rng.choice([10240, 65536, 262144, 2097152]) * rng.random()), rng)
+        files.append(file_path)
+    for index in range(4):
+        __write_file(f"{tree_path}/blob-{index}.bin", int(32 * 1048576 * scale), rng)
+    for index in range(int(800 * scale)):
+        target = rng.choice(files)
+        link_dir = os.path.dirname(rng.choice(files))
+        os.symlink(os.path.relpath(target, link_dir), f"{link_dir}/link-{index}.bin")
+
+
+# Fedora rootfs: tens of thousands of small files, deep dirs (site-packages, locales, kernel headers), a few large
+# libraries, the usrmerge symlinks, absolute alternatives symlinks and dangling ones
+def create_rootfs_tree(tree_path: str, scale: float, rng: random.Random) -> None:
+    files = []
+    for index in range(int(20000 * scale)):
+        depth = min(int(rng.expovariate(0.3)) + 2, 14)
+        file_dir = os.path.join(tree_path, "usr", *[rng.choice(WORDS[12:]) for _ in range(depth)])
+        mkdir(file_dir, create_parents=True)
+        file_path = f"{file_dir}/file-{index}"
+        __write_file(file_path, int(rng.expovariate(1 / 4096)), rng)
+        files.append(file_path)
+    mkdir(f"{tree_path}/usr/lib64", create_parents=True)
+    for index in range(3):
+        __write_file(f"{tree_path}/usr/lib64/libbig-{index}.so", int(64 * 1048576 * scale), rng)
+    for name in ["bin", "sbin", "lib", "lib64"]:
+        os.symlink(f"usr/{name}", f"{tree_path}/{name}")
+    mkdir(f"{tree_path}/etc/alternatives", create_parents=True)
+    for index in range(int(2000 * scale)):
+        target = rng.choice(files) if rng.random() < 0.9 else f"{tree_path}/usr/missing-{index}"
+        os.symlink(target.replace(tree_path, "", 1), f"{tree_path}/etc/alternatives/alt-{index}")
+
+
+TREES = {"firmware": create_firmware_tree, "rootfs": create_rootfs_tree}
+
+
+def get_tree_stats(tree_path: str) -> dict:
+    stats = {"files": 0, "dirs": 0, "symlinks": 0, "bytes": 0}
+    for root, dirs, files in os.walk(tree_path):
+        stats["dirs"] += len(dirs)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                stats["symlinks"] += 1
+            elif os.path.isfile(path):
+                stats["files"] += 1
+                stats["bytes"] += os.path.getsize(path)
+    return stats
+
+
+#######################################################################################
+#                                    OPERATIONS                                       #
+#######################################################################################
+# Every operation is a (prepare, functions.py run, coreutils run) set. prepare resets the work dir and isn't timed.
+def __reset(path: str) -> None:
+    if os.path.lexists(path):
+        subprocess.run(["rm", "-rf", path], check=True)
+
+
+def __copy_tree(tree_path: str, path: str) -> None:
+    __reset(path)
+    subprocess.run(["cp", "-a", tree_path, path], check=True)
+
+
+def __get_relative_files(tree_path: str) -> list:
+    return [os.path.relpath(os.path.join(root, name), tree_path) for root, dirs, files in os.walk(tree_path)
+            for name in files if not os.path.islink(os.path.join(root, name))]
+
+
+def __get_leaf_dirs(tree_path: str) -> list:
+    return [os.path.relpath(root, tree_path) for root, dirs, files in os.walk(tree_path) if not dirs]
+
+
+def __xargs(arguments: list, command: list, cwd: str) -> None:
+    subprocess.run(["xargs", "-0"] + command, input="\0".join(arguments).encode(), cwd=cwd, check=True)
+
+
+def get_operations(tree_path: str, work_path: str) -> dict:
+    copy_path = f"{work_path}/copy"
+    relative_files = __get_relative_files(tree_path)
+    small_files = [path for path in relative_files if os.path.getsize(f"{tree_path}/{path}") < 1048576]
+    large_files = sorted(set(relative_files) - set(small_files))
+    leaf_dirs = __get_leaf_dirs(tree_path)
+
+    def prepare_file_copy() -> None:
+        __reset(copy_path)
+        for file_dir in {os.path.dirname(path) for path in relative_files}:
+            os.makedirs(f"{copy_path}/{file_dir}", exist_ok=True)
+
+    def copy_files(files: list) -> None:
+        for path in files:
+            cpfile(f"{tree_path}/{path}", f"{copy_path}/{path}", preserve=True)
+
+    def create_dirs() -> None:
+        for leaf_dir in leaf_dirs:
+            mkdir(f"{copy_path}/{leaf_dir}", create_parents=True)
+
+    # "tree" prints the same, find lists the same entries when tree isn't installed
+    tree_command = ["tree", "-a", "--noreport", tree_path] if shutil.which("tree") else ["find", tree_path]
+    return {
+        "cpdir": (lambda: __reset(copy_path), lambda: cpdir(tree_path, copy_path),
+                  lambda: subprocess.run(["cp", "-a", f"{tree_path}/.", copy_path], check=True)),
+        "cpdir (unchanged)": (lambda: __copy_tree(tree_path, copy_path), lambda: cpdir(tree_path, copy_path),
+                              lambda: subprocess.run(["cp", "-a", "-u", f"{tree_path}/.", copy_path], check=True)),
+        "cpdir (hardlink)": (lambda: __reset(copy_path), lambda: cpdir(tree_path, copy_path, hardlink=True),
+                             lambda: subprocess.run(["cp", "-a", "-l", f"{tree_path}/.", copy_path], check=True)),
+        "cpfile (small)": (prepare_file_copy, lambda: copy_files(small_files),
+                           lambda: __xargs(small_files, ["cp", "--preserve=mode,ownership,xattr", "--parents", "-t",
+                                                         copy_path], tree_path)),
+        "cpfile (large)": (prepare_file_copy, lambda: copy_files(large_files),
+                           lambda: __xargs(large_files, ["cp", "--preserve=mode,ownership,xattr", "--parents", "-t",
+                                                         copy_path], tree_path)),
+        "rmdir": (lambda: __copy_tree(tree_path, copy_path), lambda: rmdir(copy_path, keep_dir=False),
+                  lambda: subprocess.run(["rm", "-rf", copy_path], check=True)),
+        "mkdir": (lambda: __reset(copy_path), create_dirs,
+                  lambda: __xargs([f"{copy_path}/{leaf_dir}" for leaf_dir in leaf_dirs], ["mkdir", "-p"], tree_path)),
+        "create_tree": (lambda: None, lambda: create_tree(tree_path),
+                        lambda: subprocess.run(tree_command, stdout=subprocess.DEVNULL, check=True)),
+    }
+
+
+# The page cache is flushed before every run, so that writeback of the previous run isn't counted
+def time_operation(prepare, function) -> float:
+    prepare()
+    os.sync()
+    start_time = time.perf_counter()
+    function()
+    return time.perf_counter() - start_time
+
+
+def run_tree(name: str, work_dir: str, scale: float, repeat: int) -> dict:
+    tree_path = f"{work_dir}/{name}"
+    work_path = f"{work_dir}/{name}-work"
+    __reset(tree_path)
+    mkdir(work_path, create_parents=True)
+    print_status(f"Creating {name} tree")
+    TREES[name](tree_path, scale, random.Random(42))
+    results = {"tree": get_tree_stats(tree_path), "operations": {}}
+    for operation, (prepare, functions_run, coreutils_run) in get_operations(tree_path, work_path).items():
+        print_status(f"Running {operation} on {name}")
+        times = {"functions": [], "coreutils": []}
+        for _ in range(repeat):  # alternate, so that both see the same state of the system
+            times["functions"].append(time_operation(prepare, functions_run))
+            times["coreutils"].append(time_operation(prepare, coreutils_run))
+        results["operations"][operation] = {key: statistics.median(value) for key, value in times.items()}
+    __reset(tree_path)
+    __reset(work_path)
+    return results
+
+
+def get_filesystem_type(path: str) -> str:
+    return bash(f"stat -f -c %T {path}")
+
+
+if __name__ == "__main__":
+    args = process_args()
+    for name in args.trees.split(","):
+        if name not in TREES:
+            print_error(f"Unknown tree {name}, available: {', '.join(TREES)}")
+            exit(1)
+    mkdir(args.work_dir, create_parents=True)
+    if args.tmpfs:
+        bash(f"mount -t tmpfs -o size=50% tmpfs {args.work_dir}")
+    try:
+        filesystem = get_filesystem_type(args.work_dir)
+        results = {"filesystem": filesystem, "scale": args.scale, "trees": {}}
+        for name in args.trees.split(","):
+            results["trees"][name] = run_tree(name, args.work_dir, args.scale, args.repeat)
+    finally:
+        if args.tmpfs:
+            bash(f"umount {args.work_dir}")
+
+    baseline = {}
+    if args.baseline_path:
+        with open(args.baseline_path, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["scale"] != args.scale or baseline["filesystem"] != filesystem:
+            print_warning(f"Baseline ran with scale {baseline['scale']} on {baseline['filesystem']}, the times aren't "
+                          f"comparable")
+        baseline = baseline["trees"]
+    regressions = []
+    for name, tree_results in results["trees"].items():
+        tree = tree_results["tree"]
+        print_header(f"{name} on {filesystem}: {tree['files']} files, {tree['dirs']} dirs, "
+                     f"{tree['symlinks']} symlinks, {tree['bytes'] / 1048576:.0f} MiB")
+        # relative is functions.py / coreutils, baseline is the change of the functions.py time to the baseline
+        print(f"{'operation':<20}{'functions (s)':>15}{'coreutils (s)':>15}{'relative':>10}{'baseline':>10}")
+        for operation, times in tree_results["operations"].items():
+            line = (f"{operation:<20}{times['functions']:>15.3f}{times['coreutils']:>15.3f}"
+                    f"{times['functions'] / max(times['coreutils'], 0.000001):>9.2f}x")
+            baseline_time = baseline.get(name, {}).get("operations", {}).get(operation, {}).get("functions")
+            if baseline_time:
+                change = (times["functions"] / baseline_time - 1) * 100
+                line += f"{change:>+9.0f}%"
+                if change > args.threshold:
+                    regressions.append(f"{operation} on {name}")
+            print(line)
+
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    if regressions:
+        print_error(f"Slower than the baseline by more than {args.threshold:.0f}%: {', '.join(regressions)}")
+        exit(1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Compare the dense and the sparse-aware image handling of build.py on a synthetic, mostly empty image.
+# Reports wall time, bytes written while creating the image and bytes read from the image while hashing and archiving.
+
+import argparse
+import json
+import os
+import random
+import time
+
+from functions import *
+from build import Sha256Consumer, TarProcessConsumer, fan_out_file, get_data_ranges
+
+
+def process_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", dest="work_dir", default="/tmp/eupneaos-sparse-benchmark",
+                        help="Directory to create the synthetic images in.")
+    parser.add_argument("--size", dest="size_mib", type=int, default=2048, help="Image size in MiB.")
+    parser.add_argument("--data", dest="data_percent", type=float, default=3,
+                        help="Percentage of the image that contains data.")
+    parser.add_argument("--xz-level", dest="xz_level", default="1", help="xz preset used for the archive.")
+    parser.add_argument("--json", dest="json_path", default="", help="Write the results to this json file.")
+    return parser.parse_args()
+
+
+# /proc/self/io counts bytes passed to read()/write(), including the ones of reaped children like the encoders
+def read_io_counters() -> dict:
+    counters = {}
+    with open("/proc/self/io", "r") as io_file:
+        for line in io_file:
+            key, value = line.split(":")
+            counters[key] = int(value)
+    return counters
+
+
+# Data is placed in a few clusters of 1-8 MiB, like the metadata and file extents of a freshly populated ext4
+def get_synthetic_extents(size: int, data_percent: float) -> list:
+    rng = random.Random(42)
+    extents = []
+    data_left = int(size * data_percent / 100)
+    while data_left > 0:
+        length = min(rng.randint(1, 8) * 1048576, data_left)
+        extents.append((rng.randrange(0, size - length, 4096), length))
+        data_left -= length
+    return sorted(extents)
+
+
+def create_image(image_path: str, size: int, extents: list, sparse: bool) -> None:
+    rng = random.Random(1)
+    with open(image_path, "wb") as image:
+        if sparse:
+            image.truncate(size)
+        else:  # the old dd if=/dev/zero fallback
+            zeros = bytes(1048576)
+            for _ in range(size // len(zeros)):
+                image.write(zeros)
+        for offset, length in extents:
+            image.seek(offset)
+            image.write(rng.randbytes(length))
+        image.flush()
+        os.fsync(image.fileno())
+
+
+def archive_image(image_path: str, archive_path: str, xz_level: str, sparse: bool) -> tuple:
+    data_ranges = get_data_ranges(image_path) if sparse else None
+    image_hash = Sha256Consumer("sha256")
+    tar_xz = TarProcessConsumer("xz", ["xz", f"-{xz_level}", "-T0", "-c"], archive_path, image_path, data_ranges)
+    bytes_read = fan_out_file(image_path, [image_hash, tar_xz], sparse=sparse, data_ranges=data_ranges)
+    return image_hash.hexdigest(), bytes_read
+
+
+def measure(function, *function_args) -> tuple:
+    io_before = read_io_counters()
+    start_time = time.perf_counter()
+    result = function(*function_args)
+    wall_time = time.perf_counter() - start_time
+    io_after = read_io_counters()
+    return result, {"wall_time": wall_time, "bytes_written": io_after["wchar"] - io_before["wchar"]}
+
+
+if __name__ == "__main__":
+    args = process_args()
+    mkdir(args.work_dir, create_parents=True)
+    image_size = args.size_mib * 1048576
+    extents = get_synthetic_extents(image_size, args.data_percent)
+
+    results = {}
+    hashes = {}
+    for mode in ["dense", "sparse"]:
+        print_status(f"Running {mode} pass")
+        image_path = f"{args.work_dir}/{mode}.img"
+        archive_path = f"{args.work_dir}/{mode}.img.tar.xz"
+        _, create_stats = measure(create_image, image_path, image_size, extents, mode == "sparse")
+        create_stats["bytes_read"] = 0
+        (hashes[mode], bytes_read), archive_stats = measure(archive_image, image_path, archive_path, args.xz_level,
+                                                            mode == "sparse")
+        archive_stats["bytes_read"] = bytes_read
+        results[mode] = {"create": create_stats, "archive": archive_stats,
+                         "allocated_bytes": os.stat(image_path).st_blocks * 512,
+                         "archive_bytes": os.path.getsize(archive_path)}
+        rmfile(image_path)
+        rmfile(archive_path)
+
+    if hashes["dense"] != hashes["sparse"]:
+        print_error("Dense and sparse images have different sha256sums")
+        exit(1)
+
+    print_header(f"{args.size_mib} MiB image, {args.data_percent}% data")
+    # "written" for the archive step includes the data piped into xz
+    print(f"{'step':<10}{'mode':<8}{'wall (s)':>10}{'read (MiB)':>13}{'written (MiB)':>15}")
+    for step in ["create", "archive"]:
+        for mode in ["dense", "sparse"]:
+            stats = results[mode][step]
+            print(f"{step:<10}{mode:<8}{stats['wall_time']:>10.2f}{stats['bytes_read'] / 1048576:>13.1f}"
+                  f"{stats['bytes_written'] / 1048576:>15.1f}")
+    for mode in ["dense", "sparse"]:
+        print(f"{mode}: {results[mode]['allocated_bytes'] / 1048576:.1f} MiB allocated, "
+              f"archive {results[mode]['archive_bytes'] / 1048576:.1f} MiB")
+
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
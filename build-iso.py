@@ -6,6 +6,7 @@ import os
 import sys
 
 from functions import *
+from filesystem import cpdir
 
 
 # parse arguments from the cli. Only for testing/advanced use. All other parameters are handled by cli_input.py
@@ -56,9 +57,8 @@ def configure_rootfs(uuids) -> None:
 
     # copy previously downloaded firmware
     print_status("Copying google firmware")
-    start_progress(force_show=True)  # start fake progress
-    cpdir("linux-firmware", "/mnt/eupneaos/lib/firmware")
-    stop_progress(force_show=True)  # stop fake progress
+    stats = cpdir("linux-firmware", "/mnt/eupneaos/lib/firmware")
+    print_status(f"Copied {stats['files']} files ({stats['bytes'] / 1048576:.1f} MiB) in {stats['time']:.1f}s")
 
     print_status("Configuring liveuser")
     chroot("useradd --create-home --shell /bin/bash liveuser")  # add user
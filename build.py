@@ -2,10 +2,110 @@
 # This script is cloud oriented, so it is not very user-friendly.
 
 import argparse
+import errno
+import hashlib
+import json
 import os
+import re
+import shutil
+import subprocess
 import sys
+import tarfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from time import sleep
 
 from functions import *
+from filesystem import cpdir, cpfile, rmdir
+# commands run through the streaming runner, functions.bash() is the buffered upstream version
+from runner import bash, run, log_command, set_command_log, wait_process
+from downloads import download_files, set_download_cache_dir
+from profiler import profile_stage, start_load_sampler, stop_load_sampler, write_profile_report
+from progress import ProgressMonitor
+import chunk_index
+import downloads
+import firmware
+import functions
+import gpt
+import kernel_modules
+import profiler
+import relabel
+import scheduler
+import stage_cache
+import zstd_seekable
+from scheduler import step
+from sparse import get_data_ranges, read_sparse_chunks
+
+# Stages of a build, in order. The output of each stage can be cached, see stage_cache.py
+BUILD_STAGES = ["prepare_image", "bootstrap_rootfs", "configure_rootfs", "customize_kde", "relabel_files"]
+# Files, directories and git clones each stage reads, in addition to BUILD_SOURCES
+STAGE_INPUTS = {
+    "prepare_image": ["/tmp/eupneaos-build/bzImage", "configs/kernel.flags"],
+    "bootstrap_rootfs": ["/tmp/eupneaos-build/rootfs.tar.xz", "/tmp/eupneaos-build/modules.tar.xz",
+                         "/tmp/eupneaos-build/headers.tar.xz"],
+    "configure_rootfs": ["configs", "linux-firmware", "postinstall-scripts", "audio-scripts", "systemd-services",
+                         "/tmp/eupneaos-build/modules.tar.xz"],
+    "customize_kde": ["configs/kde-configs", "eupneaos-theme"],
+    "relabel_files": ["configs/selinux"],
+}
+# The stages run code from all of these, a change to any of them invalidates every stage
+BUILD_SOURCES = ["build.py", "functions.py", "filesystem.py", "runner.py", "scheduler.py", "downloads.py",
+                 "progress.py", "profiler.py", "gpt.py", "sparse.py", "kernel_modules.py", "firmware.py", "relabel.py"]
+# Files in the working directory a stage writes for later stages and the kernel variants. They are cached together
+# with the output of the stage and every stage after it.
+STAGE_OUTPUTS = {
+    "prepare_image": ["kernel.flags"],  # the kernel cmdline with the rootfs PARTUUID, signed into every kernel
+}
+
+# Packages are declared once and every stage installs its packages in a single dnf transaction.
+# Groups are prefixed with @. Urls are replaced by the package name when installing from an offline repo.
+# TODO: Replace generic repos with own EupneaOS repos
+DNF_PACKAGES = {
+    "bootstrap_rootfs": ["generic-logos", "generic-release", "generic-release-common",
+                         "@Hardware Support", "@Common NetworkManager Submodules", "linux-firmware",
+                         # postinstall dependencies
+                         "git", "vboot-utils", "rsync", "cloud-utils", "parted", "grub2-efi-x64", "efibootmgr",
+                         "grub2-efi-x64-modules", "grub2-efi", "grub2-efi-modules", "shim",
+                         # RPMFusion repos
+                         "https://download1.rpmfusion.org/nonfree/fedora/rpmfusion-nonfree-release-37.noarch.rpm",
+                         "https://download1.rpmfusion.org/free/fedora/rpmfusion-free-release-37.noarch.rpm"],
+    "customize_kde": ["@KDE Plasma Workspaces"],
+}
+DNF_PARALLEL_DOWNLOADS = 10
+# Prebuilt kernel and rootfs, downloaded into /tmp/eupneaos-build. Add a sha256 to pin a release.
+BUILD_ARTIFACTS = [
+    {"url": "https://github.com/eupnea-linux/mainline-kernel/releases/latest/download/bzImage-stable",
+     "path": "/tmp/eupneaos-build/bzImage"},
+    {"url": "https://github.com/eupnea-linux/mainline-kernel/releases/latest/download/modules-stable.tar.xz",
+     "path": "/tmp/eupneaos-build/modules.tar.xz"},
+    {"url": "https://github.com/eupnea-linux/mainline-kernel/releases/latest/download/headers-stable.tar.xz",
+     "path": "/tmp/eupneaos-build/headers.tar.xz"},
+    {"url": "https://github.com/eupnea-linux/fedora-rootfs/releases/latest/download/fedora-rootfs-37.tar.xz",
+     "path": "/tmp/eupneaos-build/rootfs.tar.xz"},
+]
+# Kernel flavours that --variants builds from the same rootfs as the mainline image: release url and artifact suffix.
+# Their kernel, modules and headers are downloaded into /tmp/eupneaos-build/<variant>.
+KERNEL_VARIANTS = {
+    "mainline-testing": ("https://github.com/eupnea-linux/mainline-kernel/releases/latest/download", "testing"),
+    "stable": ("https://github.com/eupnea-linux/chromeos-kernel/releases/latest/download", "stable"),
+    "exp": ("https://github.com/eupnea-linux/chromeos-kernel/releases/latest/download", "exp"),
+}
+# Archives compress_image() creates: tar.xz, rar and seekable zstd (see zstd_seekable.py)
+IMAGE_FORMATS = ["xz", "rar", "zst"]
+image_formats = ["xz", "rar"]
+write_chunk_index = False  # write <image>.chunks.json, see chunk_index.py
+chunk_store = ""  # directory the chunks of the released images are added to, needs the chunk index
+variants = []  # kernel variants to build in addition to the mainline image, needs a staging dir
+dnf_cache_dir = "/var/cache/eupneaos-build/dnf"  # kept on the host and reused by every build
+offline_repo = ""  # local repo directory (createrepo_c with comps) to install all packages from, without network
+# If set, the rootfs is built in this directory instead of a loop mounted image. root/ is bind mounted to /mnt/eupneaos
+# and esp/ to /mnt/eupneaos/boot. The partitions are only created at the end, directly from these trees.
+staging_dir = ""
+strip_modules = False  # strip debug sections from unsigned kernel modules
 
 
 # parse arguments from the cli. Only for testing/advanced use. All other parameters are handled by cli_input.py
@@ -16,35 +116,85 @@ def process_args():
     parser.add_argument("--exp", dest="exp", default=False, help="Use chromeos experimental 5.15 kernel.")
     parser.add_argument("--mainline-testing", dest="mainline_testing", default=False,
                         help="Use mainline testing kernel.")
+    parser.add_argument("--dnf-cache", dest="dnf_cache", default=dnf_cache_dir,
+                        help="Host directory for dnf packages and metadata, reused across builds.")
+    parser.add_argument("--offline-repo", dest="offline_repo", default="",
+                        help="Install all packages from this local repo directory instead of the online repos.")
+    parser.add_argument("--fetch-only", action="store_true", dest="fetch_only", default=False,
+                        help="Download the kernel and rootfs into /tmp/eupneaos-build and exit.")
+    parser.add_argument("--download-cache", dest="download_cache", default=downloads.download_cache_dir,
+                        help="Directory downloaded files are cached in.")
+    parser.add_argument("--staging-dir", dest="staging_dir", default="",
+                        help="Build the rootfs in this directory and create the image from it at the end, without "
+                             "loop devices. grub2-mkconfig has to be able to probe it, so it can't be on tmpfs.")
+    parser.add_argument("--variants", dest="variants", default="",
+                        help=f"Comma separated kernel variants to build from the same rootfs in addition to the "
+                             f"mainline image: {', '.join(KERNEL_VARIANTS)}. Needs --staging-dir.")
+    parser.add_argument("--formats", dest="formats", default=",".join(image_formats),
+                        help=f"Comma separated archive formats of the image: {', '.join(IMAGE_FORMATS)}.")
+    parser.add_argument("--chunk-index", action="store_true", dest="chunk_index", default=False,
+                        help="Write the content-defined chunk index of the image (<image>.chunks.json), so that users "
+                             "can update their image by downloading only the changed chunks.")
+    parser.add_argument("--chunk-store", dest="chunk_store", default="",
+                        help="Add the chunks of the image to this chunk store. Implies --chunk-index.")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=4,
+                        help="Maximum number of build steps that run at the same time.")
+    parser.add_argument("--strip-modules", action="store_true", dest="strip_modules", default=False,
+                        help="Strip debug sections from kernel modules. Signed modules are left as they are.")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache", default=False,
+                        help="Don't use or fill the stage cache.")
+    parser.add_argument("--resume-from", dest="resume_from", choices=BUILD_STAGES, default="",
+                        help="Restart the build at this stage, using the cached output of the stage before it.")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=stage_cache.cache_dir,
+                        help="Directory for cached stage outputs.")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=50,
+                        help="Maximum size of the stage cache in GiB. Least recently used stages are evicted.")
+    parser.add_argument("--command-log", dest="command_log", default="eupneaos-commands.jsonl",
+                        help="Json lines file that the timings of every command are written to.")
+    parser.add_argument("--profile", action="store_true", dest="profile", default=False,
+                        help="Sample system load, cpu usage and memory during the build for the profile report.")
+    parser.add_argument("--profile-report", dest="profile_report", default="eupneaos-profile.json",
+                        help="Json file the build profile is written to.")
+    parser.add_argument("--profile-baseline", dest="profile_baseline", default="",
+                        help="Profile report of an earlier build to compare the stage timings with.")
     return parser.parse_args()
 
 
+# Download the kernel and the rootfs. Files that are already in /tmp/eupneaos-build are only replaced when refresh is
+# set, so that locally built kernels can be used.
+def fetch_artifacts(refresh: bool) -> None:
+    mkdir("/tmp/eupneaos-build", create_parents=True)
+    for variant in variants:
+        mkdir(f"/tmp/eupneaos-build/{variant}")
+    artifacts = BUILD_ARTIFACTS + [artifact for variant in variants for artifact in get_variant_artifacts(variant)]
+    missing = [artifact for artifact in artifacts if refresh or not path_exists(artifact["path"])]
+    if missing:
+        print_status("Downloading kernel and rootfs")
+        download_files(missing)
+
+
+def get_variant_artifacts(variant: str) -> list:
+    release_url, suffix = KERNEL_VARIANTS[variant]
+    return [{"url": f"{release_url}/bzImage-{suffix}", "path": f"/tmp/eupneaos-build/{variant}/bzImage"},
+            {"url": f"{release_url}/modules-{suffix}.tar.xz", "path": f"/tmp/eupneaos-build/{variant}/modules.tar.xz"},
+            {"url": f"{release_url}/headers-{suffix}.tar.xz",
+             "path": f"/tmp/eupneaos-build/{variant}/headers.tar.xz"}]
+
+
 # Create, mount, partition the img and flash the mainline eupnea kernel
 def prepare_image() -> str:
+    if staging_dir:
+        return prepare_staging_dir()
     print_status("Preparing image")
 
-    try:
-        bash(f"fallocate -l 10G eupneaos-uefi.img")
-    except subprocess.CalledProcessError:  # try fallocate, if it fails use dd
-        bash(f"dd if=/dev/zero of=eupneaos-uefi.img status=progress bs=1024 count={10 * 1000000}")
-    print_status("Mounting empty image")
-    img_mnt = bash("losetup -f --show eupneaos-uefi.img")
-    if img_mnt == "":
-        print_error("Failed to mount image")
-        exit(1)
-
+    # Create a sparse image: only blocks that are actually written take up space and get read/compressed later
+    with open("eupneaos-uefi.img", "wb") as image:
+        image.truncate(10 * 1073741824)
     # partition image
     print_status("Preparing device/image partition")
-
-    # format as per depthcharge requirements,
-    # READ: https://wiki.gentoo.org/wiki/Creating_bootable_media_for_depthcharge_based_devices
-    bash(f"parted -s {img_mnt} mklabel gpt")
-    bash(f"parted -s -a optimal {img_mnt} unit mib mkpart Kernel 1 65")  # kernel partition
-    bash(f"parted -s -a optimal {img_mnt} unit mib mkpart Kernel 65 129")  # reserve kernel partition
-    bash(f"parted -s -a optimal {img_mnt} unit mib mkpart Root 129 629") # EFI System Partition
-    bash(f"parted -s -a optimal {img_mnt} unit mib mkpart Root 629 100%")  # rootfs partition
-    bash(f"cgpt add -i 1 -t kernel -S 1 -T 5 -P 15 {img_mnt}")  # set kernel flags
-    bash(f"cgpt add -i 2 -t kernel -S 1 -T 5 -P 1 {img_mnt}")  # set backup kernel flags
+    partition_image("eupneaos-uefi.img")
+    print_status("Mounting empty image")
+    img_mnt = attach_image()
 
     print_status("Formatting rootfs part")
     rootfs_mnt = img_mnt + "p4"  # fourth partition is rootfs
@@ -53,14 +203,10 @@ def prepare_image() -> str:
     bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
     # Create esp fat32 partition
     bash(f"yes 2>/dev/null | mkfs.fat -F 32 {esp_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
-    # Mount rootfs partition
-    bash(f"mount {rootfs_mnt} /mnt/eupneaos")
-    # Mount esp
-    bash("mkdir -p /mnt/eupneaos/boot")
-    bash(f"mount {esp_mnt} /mnt/eupneaos/boot")
+    mount_image(img_mnt)
 
     # get uuid of rootfs partition
-    rootfs_partuuid = bash(f"blkid -o value -s PARTUUID {rootfs_mnt}")
+    rootfs_partuuid = gpt.read_gpt("eupneaos-uefi.img")["partitions"][3]["guid"]
     # write PARTUUID to kernel flags and save it as a file
     with open(f"configs/kernel.flags", "r") as flags:
         temp_cmdline = flags.read().replace("insert_partuuid", rootfs_partuuid).strip()
@@ -72,41 +218,359 @@ def prepare_image() -> str:
     return img_mnt
 
 
+# format as per depthcharge requirements,
+# READ: https://wiki.gentoo.org/wiki/Creating_bootable_media_for_depthcharge_based_devices
+# A rootfs_end of 0 extends the rootfs to the end of the image
+def get_image_layout(rootfs_end: int = 0, esp_guid: str = "", rootfs_guid: str = "") -> list:
+    return [
+        # kernel partition, booted first
+        {"name": "Kernel", "type": gpt.CHROMEOS_KERNEL, "start": 1048576, "end": 68157440,
+         "attributes": gpt.chromeos_kernel_attributes(priority=15, tries=5, successful=True)},
+        # reserve kernel partition
+        {"name": "Kernel", "type": gpt.CHROMEOS_KERNEL, "start": 68157440, "end": 135266304,
+         "attributes": gpt.chromeos_kernel_attributes(priority=1, tries=5, successful=True)},
+        # EFI System Partition
+        {"name": "Root", "type": gpt.LINUX_DATA, "start": 135266304, "end": 659554304, "guid": esp_guid},
+        # rootfs partition
+        {"name": "Root", "type": gpt.LINUX_DATA, "start": 659554304, "end": rootfs_end, "guid": rootfs_guid},
+    ]
+
+
+# Write the partition table straight into the image file and read it back
+def partition_image(image_path: str, rootfs_end: int = 0, esp_guid: str = "", rootfs_guid: str = "") -> None:
+    layout = get_image_layout(rootfs_end, esp_guid, rootfs_guid)
+    gpt.write_gpt(image_path, layout)
+    gpt.verify_gpt(image_path, layout)
+
+
+# Start with empty staging trees. The partition and filesystem ids are chosen now, because the kernel cmdline, fstab
+# and grub config need them long before the partitions exist.
+def prepare_staging_dir() -> str:
+    print_status(f"Preparing staging dir {staging_dir}")
+    for tree in ["root", "esp"]:
+        rmdir(f"{staging_dir}/{tree}", keep_dir=False)
+        mkdir(f"{staging_dir}/{tree}", create_parents=True)
+    staging_ids = {"esp_partuuid": str(uuid.uuid4()), "rootfs_partuuid": str(uuid.uuid4()),
+                   "esp_volume_id": os.urandom(4).hex().upper(), "rootfs_uuid": str(uuid.uuid4())}
+    with open(f"{staging_dir}/ids.json", "w") as ids_file:
+        json.dump(staging_ids, ids_file, indent=2)
+    mount_image("")
+
+    with open(f"configs/kernel.flags", "r") as flags:
+        temp_cmdline = flags.read().replace("insert_partuuid", staging_ids["rootfs_partuuid"]).strip()
+    with open("kernel.flags", "w") as config:
+        config.write(temp_cmdline)
+    # the kernel is written to the kernel partition when the image is assembled
+    sign_kernel()
+    cpfile("/tmp/eupneaos-build/bzImage.signed", f"{staging_dir}/kernel.signed")
+    return ""
+
+
+def read_staging_ids() -> dict:
+    with open(f"{staging_dir}/ids.json", "r") as ids_file:
+        return json.load(ids_file)
+
+
+# Byte offset and size of every partition of an image file
+def get_partitions(image_path: str) -> dict:
+    return {partition["number"]: {"start": partition["start"], "size": partition["end"] - partition["start"]}
+            for partition in gpt.read_gpt(image_path)["partitions"]}
+
+
+# mkfs.ext4 -d fails if the filesystem is too small for the tree: add room for the metadata, the journal and the
+# files that are added after the first boot
+def get_rootfs_size(tree: str) -> tuple:
+    allocated = 0
+    inodes = 0
+    for root, dirs, files in os.walk(tree):
+        for name in dirs + files:
+            allocated += os.lstat(os.path.join(root, name)).st_blocks * 512
+            inodes += 1
+    size = int(allocated * 1.1) + 268435456
+    return size + -size % 1048576, int(inodes * 1.2) + 16384
+
+
+# Create eupneaos-uefi.img from the staging trees. Every filesystem is written straight into its partition of the image
+# file, nothing is mounted. Kernel variants pass their own image, rootfs tree and signed kernel.
+def assemble_image(image_path: str = "eupneaos-uefi.img", root_tree: str = "", signed_kernel: str = "") -> None:
+    print_status(f"Assembling {image_path} from staging dir")
+    root_tree = root_tree or f"{staging_dir}/root"
+    signed_kernel = signed_kernel or f"{staging_dir}/kernel.signed"
+    staging_ids = read_staging_ids()
+    rootfs_size, rootfs_inodes = get_rootfs_size(root_tree)
+    rootfs_end = get_image_layout()[-1]["start"] + rootfs_size
+    rmfile(image_path)
+    with open(image_path, "wb") as image:
+        image.truncate(gpt.get_image_size(rootfs_end))
+    partition_image(image_path, rootfs_end, staging_ids["esp_partuuid"], staging_ids["rootfs_partuuid"])
+    partitions = get_partitions(image_path)
+
+    print_status("Writing kernel partition")
+    bash(f"dd if={signed_kernel} of={image_path} bs=1M oflag=seek_bytes seek={partitions[1]['start']} conv=notrunc")
+
+    print_status("Creating esp")
+    esp = partitions[3]
+    bash(f"mkfs.fat -F 32 -i {staging_ids['esp_volume_id']} --offset {esp['start'] // 512} {image_path} "
+         f"{esp['size'] // 1024}")
+    esp_entries = [entry.path for entry in os.scandir(f"{staging_dir}/esp")]
+    if esp_entries:
+        run(["mcopy", "-s", "-p", "-i", f"{image_path}@@{esp['start']}"] + esp_entries + ["::/"])
+
+    print_status("Creating rootfs")
+    rootfs = partitions[4]
+    run(["mkfs.ext4", "-q", "-F", "-U", staging_ids["rootfs_uuid"], "-N", str(rootfs_inodes), "-E",
+         f"offset={rootfs['start']}", "-d", root_tree, image_path, f"{rootfs['size'] // 1024}k"])
+
+
+# Attach an already partitioned image to a loop device
+def attach_image() -> str:
+    if staging_dir:
+        return ""
+    img_mnt = bash("losetup -fP --show eupneaos-uefi.img")
+    if img_mnt == "":
+        print_error("Failed to mount image")
+        exit(1)
+    return img_mnt
+
+
+def mount_image(img_mnt: str) -> None:
+    if staging_dir:
+        bash(f"mount --bind {staging_dir}/root /mnt/eupneaos")
+        bash("mkdir -p /mnt/eupneaos/boot")
+        bash(f"mount --bind {staging_dir}/esp /mnt/eupneaos/boot")
+        return
+    # Mount rootfs partition
+    bash(f"mount {img_mnt}p4 /mnt/eupneaos")
+    # Mount esp
+    bash("mkdir -p /mnt/eupneaos/boot")
+    bash(f"mount {img_mnt}p3 /mnt/eupneaos/boot")
+
+
+# proc and dev are needed inside the chroot after the rootfs has been bootstrapped
+def mount_chroot_fs() -> None:
+    bash(f"mount -t proc none /mnt/eupneaos/proc && mount -o bind /dev /mnt/eupneaos/dev")
+
+
+def unmount_chroot_fs() -> None:
+    for mountpoint in ["/mnt/eupneaos/dev", "/mnt/eupneaos/proc"]:
+        if os.path.ismount(mountpoint):
+            bash(f"umount {mountpoint}")
+
+
+def unmount_image() -> None:
+    close_chroot_session()
+    unmount_dnf_dirs()
+    unmount_chroot_fs()
+    for mountpoint in ["/mnt/eupneaos/boot", "/mnt/eupneaos"]:
+        if os.path.ismount(mountpoint):
+            bash(f"umount {mountpoint}")
+
+
+# Unmount the image, so that the snapshot is consistent, cache it and mount it again
+def cache_stage(stage_name: str, stage_key: str, img_mnt: str) -> None:
+    unmount_image()
+    bash("sync")
+    stage_files = [file_path for cached_stage in BUILD_STAGES[:BUILD_STAGES.index(stage_name) + 1]
+                   for file_path in STAGE_OUTPUTS.get(cached_stage, [])]
+    stage_cache.store_snapshot(stage_key, stage_name, staging_dir or "eupneaos-uefi.img", stage_files)
+    mount_image(img_mnt)
+    if stage_name != "prepare_image":
+        mount_chroot_fs()
+
+
+# Chain the input hashes of all stages into one cache key per stage
+def get_stage_keys() -> dict:
+    stage_keys = {}
+    previous_key = ""
+    for stage_name in BUILD_STAGES:
+        # packages are declared outside the stage functions and the offline repo changes where they come from
+        packages = json.dumps([DNF_PACKAGES.get(stage_name, []), offline_repo,
+                               strip_modules if stage_name == "bootstrap_rootfs" else None])
+        inputs_hash = stage_cache.hash_stage_inputs(BUILD_SOURCES + STAGE_INPUTS[stage_name], packages)
+        previous_key = stage_cache.get_stage_key(previous_key, stage_name, inputs_hash)
+        stage_keys[stage_name] = previous_key
+    return stage_keys
+
+
+# Remove temporary files and trim the image
+def clean_image() -> None:
+    unmount_chroot_fs()  # don't delete files from the hosts proc and dev
+
+    # Clean image of temporary files
+    rmdir("/mnt/eupneaos/tmp")
+    rmdir("/mnt/eupneaos/var/tmp")
+    rmdir("/mnt/eupneaos/var/cache")
+    rmdir("/mnt/eupneaos/proc")
+    rmdir("/mnt/eupneaos/run")
+    rmdir("/mnt/eupneaos/sys")
+    rmdir("/mnt/eupneaos/lost+found")
+    rmdir("/mnt/eupneaos/dev")
+
+    if staging_dir:
+        return  # the filesystems don't exist yet, there is nothing to trim
+    # Discard freed blocks, so that they become holes in the sparse image again
+    try:
+        bash("fstrim -v /mnt/eupneaos")
+    except subprocess.CalledProcessError:
+        print_warning("Failed to trim image, freed blocks will be compressed too")
+
+
+# The steps of every stage with the things they need and produce, see scheduler.py. Steps of a stage that don't depend
+# on each other run at the same time. dnf transactions and mount changes are never run in parallel.
+def get_stage_steps(stage_name: str, img_mnt: str) -> list:
+    if stage_name == "prepare_image":
+        return [step(prepare_image, outputs=["image"], resources=["mounts"])]
+    elif stage_name == "bootstrap_rootfs":
+        return [step(extract_rootfs, outputs=["rootfs"]),
+                step(install_base_packages, inputs=["rootfs"], outputs=["packages"], resources=["dnf", "mounts"]),
+                # after dnf, its scriptlets (depmod, kernel-install) write to the /lib/modules extract_kernel replaces
+                step(extract_kernel, inputs=["packages"], outputs=["kernel"]),
+                step(process_modules, inputs=["kernel"], outputs=["modules"]),
+                step(mount_chroot_fs, inputs=["packages"], outputs=["chroot_fs"], resources=["mounts"])]
+    elif stage_name == "configure_rootfs":
+        return [step(copy_firmware, outputs=["firmware"]),
+                step(configure_liveuser, outputs=["liveuser"]),
+                step(copy_eupnea_files, outputs=["eupnea_files"]),
+                step(install_services, outputs=["services"]),
+                step(configure_system, args=[img_mnt], outputs=["fstab"]),
+                step(install_grub, inputs=["fstab"], outputs=["grub"])]
+    elif stage_name == "customize_kde":
+        return [step(install_kde, outputs=["kde"], resources=["dnf", "mounts"]),
+                step(copy_kde_configs, outputs=["kde_configs"]),
+                step(install_theme, inputs=["kde"], outputs=["theme"])]
+    elif stage_name == "relabel_files":
+        return [step(relabel_files)]
+
+
+def run_stage(stage_name: str, img_mnt: str, jobs: int) -> str:
+    results = scheduler.run_steps(get_stage_steps(stage_name, img_mnt), workers=jobs)
+    # the agent is reaped here, so that the commands it ran are accounted to this stage by the profiler
+    close_chroot_session()
+    return results.get("prepare_image", img_mnt)
+
+
 def flash_kernel(kernel_part: str) -> None:
     print_status("Flashing kernel to device/image")
-    # Sign kernel
-    bash("futility vbutil_kernel --arch x86_64 --version 1 --keyblock /usr/share/vboot/devkeys/kernel.keyblock"
-         + " --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader kernel.flags" +
-         " --config kernel.flags --vmlinuz /tmp/eupneaos-build/bzImage --pack /tmp/eupneaos-build/bzImage.signed")
+    sign_kernel()
     bash(f"dd if=/tmp/eupneaos-build/bzImage.signed of={kernel_part}")  # part 1 is the kernel partition
 
     print_status("Kernel flashed successfully")
 
 
-# Make a bootable rootfs
-def bootstrap_rootfs() -> None:
-    bash("tar xfp /tmp/eupneaos-build/rootfs.tar.xz -C /mnt/eupneaos --checkpoint=.10000")
+def sign_kernel(kernel: str = "/tmp/eupneaos-build/bzImage",
+                signed_kernel: str = "/tmp/eupneaos-build/bzImage.signed") -> None:
+    bash("futility vbutil_kernel --arch x86_64 --version 1 --keyblock /usr/share/vboot/devkeys/kernel.keyblock"
+         + " --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader kernel.flags" +
+         f" --config kernel.flags --vmlinuz {kernel} --pack {signed_kernel}")
+
+
+# xz decodes archives with multiple blocks in parallel since 5.4, older versions need pixz for that
+def get_xz_decoder() -> str:
+    version = bash("xz --version").splitlines()[0].split()[-1]  # xz (XZ Utils) 5.4.1
+    if tuple(int(part) for part in version.split(".")[:2]) >= (5, 4):
+        return "xz -T0"
+    if shutil.which("pixz"):
+        return "pixz"
+    print_warning(f"xz {version} can only decompress on one core, install pixz or xz 5.4+ for faster extraction")
+    return "xz"
+
+
+# Extract several tarballs at the same time. archives is a list of dicts with archive, dest and optionally sha256, which
+# the archive is checked against while it is read. Every archive is read once and piped into tar.
+def extract_archives(archives: list) -> None:
+    decoder = get_xz_decoder()
+    progress = ProgressMonitor(f"Extracting {', '.join(Path(a['archive']).name for a in archives)}",
+                               total=sum(os.path.getsize(archive["archive"]) for archive in archives))
+    errors = []
+    consumers = {}
+
+    def extract(archive: dict) -> None:
+        try:
+            tar = ProcessConsumer(Path(archive["archive"]).name,
+                                  ["tar", "-x", "-p", "-I", decoder, "-f", "-", "-C", archive["dest"]])
+            consumers[archive["archive"]] = [tar, ProgressConsumer("progress", progress)]
+            if archive.get("sha256"):
+                consumers[archive["archive"]].append(Sha256Consumer("sha256"))
+            fan_out_file(archive["archive"], consumers[archive["archive"]], sparse=False)
+            if archive.get("sha256") and consumers[archive["archive"]][2].hexdigest() != archive["sha256"]:
+                raise ValueError(f"sha256 of {archive['archive']} doesn't match {archive['sha256']}")
+        except Exception as e:
+            errors.append(e)
+
+    progress.start()
+    threads = [Thread(target=extract, args=(archive,), daemon=True) for archive in archives]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    progress.stop()
+    if errors:
+        raise errors[0]
+    print_throughput([archive_consumers[0] for archive_consumers in consumers.values()])
+
+
+# Sha256 of a downloaded build artifact, if it is pinned in BUILD_ARTIFACTS
+def get_artifact_sha256(artifact_path: str) -> str:
+    for artifact in BUILD_ARTIFACTS:
+        if artifact["path"] == artifact_path:
+            return artifact.get("sha256", "")
+    return ""
+
+
+# The modules tarball contains a single directory named after the kernel version. Only the first member is decoded.
+# The modules archive contains lib/modules/<version>/, possibly with a leading ./ entry
+def get_kernel_version(modules_archive: str) -> str:
+    with tarfile.open(modules_archive, "r|*") as archive:
+        for member in archive:
+            name = member.name.removeprefix("./").strip("/")
+            if name and name != ".":
+                return name.split("/")[0]
+    raise ValueError(f"{modules_archive} doesn't contain a kernel version directory")
+
+
+# Extract the rootfs and give the chroot internet access
+def extract_rootfs() -> None:
+    extract_archives([{"archive": "/tmp/eupneaos-build/rootfs.tar.xz", "dest": "/mnt/eupneaos",
+                       "sha256": get_artifact_sha256("/tmp/eupneaos-build/rootfs.tar.xz")}])
     # Create a temporary resolv.conf for internet inside the chroot
     mkdir("/mnt/eupneaos/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didnt run
     cpfile("/etc/resolv.conf",
            "/mnt/eupneaos/run/systemd/resolve/stub-resolv.conf")  # copy hosts resolv.conf to chroot
 
-    # TODO: Replace generic repos with own EupneaOS repos
-    chroot("dnf install --releasever=37 --allowerasing -y generic-logos generic-release generic-release-common")
-    chroot("dnf group install -y 'Hardware Support'")
-    chroot("dnf group install -y 'Common NetworkManager Submodules'")
-    chroot("dnf install -y linux-firmware")
-    chroot("dnf install -y git vboot-utils rsync cloud-utils parted grub2-efi-x64 efibootmgr")  # postinstall dependencies
-    chroot("dnf install -y grub2-efi-x64-modules grub2-efi grub2-efi-modules shim")
-
-    # Add RPMFusion repos
-    chroot(f"dnf install -y https://download1.rpmfusion.org/nonfree/fedora/rpmfusion-nonfree-release-37.noarch.rpm")
-    chroot(f"dnf install -y https://download1.rpmfusion.org/free/fedora/rpmfusion-free-release-37.noarch.rpm")
-    bash(f"mount -t proc none /mnt/eupneaos/proc && mount -o bind /dev /mnt/eupneaos/dev")
+
+def install_base_packages() -> None:
+    dnf_install(DNF_PACKAGES["bootstrap_rootfs"])
+
+
+# Modules and headers don't belong to any package, they replace whatever dnf put into /lib/modules
+def extract_kernel() -> None:
+    print_status("Extracting kernel modules and headers")
+    dir_kernel_version = get_kernel_version("/tmp/eupneaos-build/modules.tar.xz")
+    rmdir("/mnt/eupneaos/lib/modules")  # remove all old modules
+    mkdir("/mnt/eupneaos/lib/modules")
+    rmdir(f"/mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}", keep_dir=False)  # remove old headers
+    mkdir(f"/mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}", create_parents=True)
+    extract_archives([{"archive": "/tmp/eupneaos-build/modules.tar.xz", "dest": "/mnt/eupneaos/lib/modules/",
+                       "sha256": get_artifact_sha256("/tmp/eupneaos-build/modules.tar.xz")},
+                      {"archive": "/tmp/eupneaos-build/headers.tar.xz",
+                       "dest": f"/mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}/",
+                       "sha256": get_artifact_sha256("/tmp/eupneaos-build/headers.tar.xz")}])
+    chroot(["ln", "-s", f"/usr/src/linux-headers-{dir_kernel_version}/",
+            f"/lib/modules/{dir_kernel_version}/build"])  # use chroot for correct symlink
 
 
+# Compress the modules and generate modules.dep now instead of on the first boot
+def process_modules() -> None:
+    print_status("Compressing kernel modules")
+    stats = kernel_modules.process_modules("/mnt/eupneaos",
+                                           get_kernel_version("/tmp/eupneaos-build/modules.tar.xz"), strip_modules)
+    kernel_modules.print_modules_report(stats)
+
 
 def get_uuids(img_mnt: None) -> list:
+    if staging_dir:
+        staging_ids = read_staging_ids()
+        return [staging_ids["esp_partuuid"], staging_ids["rootfs_partuuid"]]
     bootpart = img_mnt + "p3"
     rootpart = img_mnt + "p4"
     bootuuid = bash(f"blkid -o value -s PARTUUID {bootpart}")
@@ -115,42 +579,32 @@ def get_uuids(img_mnt: None) -> list:
     return uuids
 
 
-def configure_rootfs(uuids) -> None:
-    # Extract kernel modules
-    print_status("Extracting kernel modules")
-    rmdir("/mnt/eupneaos/lib/modules")  # remove all old modules
-    mkdir("/mnt/eupneaos/lib/modules")
-    bash(f"tar xpf /tmp/eupneaos-build/modules.tar.xz -C /mnt/eupneaos/lib/modules/ --checkpoint=.10000")
-    print("")  # break line after tar
-
-    # Enable loading modules needed for eupnea
-    cpfile("configs/eupnea-modules.conf", "/mnt/eupneaos/etc/modules-load.d/eupnea-modules.conf")
-
-    # Extract kernel headers
-    print_status("Extracting kernel headers")
-    dir_kernel_version = bash(f"ls /mnt/eupneaos/lib/modules/").strip()  # get modules dir name
-    rmdir(f"/mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}", keep_dir=False)  # remove old headers
-    mkdir(f"/mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}", create_parents=True)
-    bash(f"tar xpf /tmp/eupneaos-build/headers.tar.xz -C /mnt/eupneaos/usr/src/linux-headers-{dir_kernel_version}/ "
-         f"--checkpoint=.10000")
-    print("")  # break line after tar
-    chroot(f"ln -s /usr/src/linux-headers-{dir_kernel_version}/ "
-           f"/lib/modules/{dir_kernel_version}/build")  # use chroot for correct symlink
-
-    # copy previously downloaded firmware
+def copy_firmware() -> None:
+    # copy the part of the previously downloaded firmware that the kernel can load
     print_status("Copying google firmware")
-    start_progress(force_show=True)  # start fake progress
-    cpdir("linux-firmware", "/mnt/eupneaos/lib/firmware")
-    stop_progress(force_show=True)  # stop fake progress
+    progress = ProgressMonitor("Copying firmware", unit="files")
+    progress.start()
+    stats = firmware.install_firmware("linux-firmware", "/mnt/eupneaos/lib/firmware",
+                                      "/tmp/eupneaos-build/modules.tar.xz", "configs/firmware-allowlist.conf",
+                                      progress=progress)
+    progress.stop()
+    firmware.print_firmware_report(stats)
+
 
+def configure_liveuser() -> None:
     print_status("Configuring liveuser")
-    chroot("useradd --create-home --shell /bin/bash liveuser")  # add user
-    chroot("usermod -aG wheel liveuser")  # add user to wheel
-    chroot(f'echo "liveuser:eupneaos" | chpasswd')  # set password to eupneaos
+    chroot(["useradd", "--create-home", "--shell", "/bin/bash", "liveuser"])  # add user
+    chroot(["usermod", "-aG", "wheel", "liveuser"])  # add user to wheel
+    chroot(["chpasswd"], input_text="liveuser:eupneaos\n")  # set password to eupneaos
     # set up automatic login on boot for temp-user
     with open("/mnt/eupneaos/etc/sddm.conf", "a") as sddm_conf:
         sddm_conf.write("\n[Autologin]\nUser=liveuser\nSession=plasma.desktop\n")
 
+
+def copy_eupnea_files() -> None:
+    # Enable loading modules needed for eupnea
+    cpfile("configs/eupnea-modules.conf", "/mnt/eupneaos/etc/modules-load.d/eupnea-modules.conf")
+
     print_status("Copying eupnea scripts and configs")
     # Copy postinstall scripts
     for file in Path("postinstall-scripts").iterdir():
@@ -158,14 +612,13 @@ def configure_rootfs(uuids) -> None:
             if file.name == "LICENSE" or file.name == "README.md" or file.name == ".gitignore":
                 continue  # dont copy license, readme and gitignore
             else:
-                cpfile(file.absolute().as_posix(), f"/mnt/eupneaos/usr/local/bin/{file.name}")
+                cpfile(file.absolute().as_posix(), f"/mnt/eupneaos/usr/local/bin/{file.name}", mode=0o755)
 
     # copy audio setup script
-    cpfile("audio-scripts/setup-audio", "/mnt/eupneaos/usr/local/bin/setup-audio")
+    cpfile("audio-scripts/setup-audio", "/mnt/eupneaos/usr/local/bin/setup-audio", mode=0o755)
 
     # copy functions file
-    cpfile("functions.py", "/mnt/eupneaos/usr/local/bin/functions.py")
-    chroot("chmod 755 /usr/local/bin/*")  # make scripts executable in system
+    cpfile("functions.py", "/mnt/eupneaos/usr/local/bin/functions.py", mode=0o755)
 
     # copy configs
     mkdir("/mnt/eupneaos/etc/eupnea")
@@ -176,6 +629,8 @@ def configure_rootfs(uuids) -> None:
     # copy preset eupnea settings file for postinstall scripts to read
     cpfile("configs/eupnea.json", "/mnt/eupneaos/etc/eupnea.json")
 
+
+def install_services() -> None:
     # Install systemd services
     print_status("Installing systemd services")
     # Copy postinstall scripts
@@ -185,9 +640,12 @@ def configure_rootfs(uuids) -> None:
                 continue  # dont copy license, readme and gitignore
             else:
                 cpfile(file.absolute().as_posix(), f"/mnt/eupneaos/etc/systemd/system/{file.name}")
-    chroot("systemctl enable eupnea-postinstall.service")
-    chroot("systemctl enable eupnea-update.timer")
+    # systemd-resolved.service needed to create /etc/resolv.conf link. Not enabled by default for some reason
+    chroot(["systemctl", "enable", "eupnea-postinstall.service", "eupnea-update.timer", "systemd-resolved"])
+
 
+def configure_system(img_mnt: str) -> None:
+    uuids = get_uuids(img_mnt)
     print_status("Fixing sleep")
     # disable hibernation aka S4 sleep, READ: https://eupnea-linux.github.io/main.html#/pages/bootlock
     # TODO: Fix S4 sleep
@@ -195,9 +653,6 @@ def configure_rootfs(uuids) -> None:
     with open("/mnt/eupneaos/etc/systemd/sleep.conf", "a") as conf:
         conf.write("SuspendState=freeze\nHibernateState=freeze\n")
 
-    # systemd-resolved.service needed to create /etc/resolv.conf link. Not enabled by default for some reason
-    chroot("systemctl enable systemd-resolved")
-
     # Fix fstab issue?
     bash("touch /mnt/eupneaos/etc/fstab")
     # Append lines to fstab
@@ -206,31 +661,57 @@ def configure_rootfs(uuids) -> None:
     with open("/mnt/eupneaos/etc/fstab", "w") as fstab:
         fstab = f"\nUUID={uuids[0]} /boot vfat rw,relatime,fmask=0022,dmask=0022,codepage=437 0 2\n{uuids[1]} / ext4 rw,relatime 0 1"
 
-    # Install grub
-    chroot("grub2-mkconfig > /boot/grub/grub.cfg")
-    chroot("grub2-mkconfig > /boot/grub2/grub.cfg")
-    chroot("grub2-install --target=x86_64-efi --efi-directory=/boot --removable")
-    chroot("grub2-mkconfig > /boot/grub/grub.cfg")
-
 
-def customize_kde() -> None:
+def install_grub() -> None:
+    if staging_dir:
+        install_grub_offline()
+        return
+    chroot_batch([["grub2-mkconfig", "-o", "/boot/grub/grub.cfg"], ["grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"]])
+    chroot(["grub2-install", "--target=x86_64-efi", "--efi-directory=/boot", "--removable"])
+    chroot(["grub2-mkconfig", "-o", "/boot/grub/grub.cfg"])
+
+
+# grub2-install needs the real esp, so the removable efi binary is built with grub2-mkimage instead. grub2-mkconfig
+# probes the filesystem the staging dir is on, its uuid is replaced with the ones the partitions will get.
+def install_grub_offline() -> None:
+    staging_ids = read_staging_ids()
+    esp_uuid = f"{staging_ids['esp_volume_id'][:4]}-{staging_ids['esp_volume_id'][4:]}"  # how grub shows fat ids
+    host_uuid = chroot(["grub2-probe", "--target=fs_uuid", "/"])
+    mkdir("/mnt/eupneaos/boot/EFI/BOOT", create_parents=True)
+    chroot(["grub2-mkimage", "-O", "x86_64-efi", "-d", "/usr/lib/grub/x86_64-efi", "-p", "/grub2",
+            "-o", "/boot/EFI/BOOT/BOOTX64.EFI", "part_gpt", "fat", "ext2", "normal", "configfile", "search",
+            "search_fs_uuid", "linux", "boot", "echo", "test", "all_video", "efi_gop", "gfxterm", "blscfg"])
+    for grub_cfg in ["/boot/grub/grub.cfg", "/boot/grub2/grub.cfg"]:
+        chroot(["grub2-mkconfig", "-o", grub_cfg])
+        with open(f"/mnt/eupneaos{grub_cfg}", "r") as config:
+            # root= is the rootfs, everything else grub searches for is on the esp
+            grub_config = config.read().replace(f"root=UUID={host_uuid}", f"root=UUID={staging_ids['rootfs_uuid']}")
+        with open(f"/mnt/eupneaos{grub_cfg}", "w") as config:
+            config.write(grub_config.replace(host_uuid, esp_uuid))
+
+
+def install_kde() -> None:
     # Install KDE
-    chroot("dnf group install -y 'KDE Plasma Workspaces'")
+    dnf_install(DNF_PACKAGES["customize_kde"])
     # Set system to boot to gui
-    chroot("systemctl set-default graphical.target")
+    chroot(["systemctl", "set-default", "graphical.target"])
 
+
+def copy_kde_configs() -> None:
     # Set kde ui settings
     print_status("Setting General UI settings")
     mkdir("/mnt/eupneaos/home/liveuser/.config")
     cpfile("configs/kde-configs/kwinrc", "/mnt/eupneaos/home/liveuser/.config/kwinrc")  # set general kwin settings
     cpfile("configs/kde-configs/kcminputrc", "/mnt/eupneaos/home/liveuser/.config/kcminputrc")  # set touchpad settings
-    chroot("chown -R liveuser:liveuser /home/liveuser/.config")  # set permissions
+    chroot(["chown", "-R", "liveuser:liveuser", "/home/liveuser/.config"])  # set permissions
+
 
+def install_theme() -> None:
     print_status("Installing global kde theme")
     # Installer needs to be run from within chroot
     cpdir("eupneaos-theme", "/mnt/eupneaos/tmp/eupneaos-theme")
     # run installer script from chroot
-    chroot("cd /tmp/eupneaos-theme && bash /tmp/eupneaos-theme/install.sh")  # install global theme
+    chroot(["bash", "/tmp/eupneaos-theme/install.sh"], cwd="/tmp/eupneaos-theme")  # install global theme
 
     # apply global dark theme
 
@@ -239,7 +720,17 @@ def relabel_files() -> None:
     # Fedora requires all files to be relabled for SELinux to work
     # If this is not done, SELinux will prevent users from logging in
     print_status("Relabeling files for SELinux")
+    try:
+        file_contexts = relabel.load_file_contexts("/mnt/eupneaos")
+    except (OSError, ValueError, re.error) as e:
+        print_warning(f"Failed to load the SELinux file contexts ({e}), relabeling with fixfiles")
+        relabel_files_fixfiles()
+        return
+    relabel.print_relabel_report(relabel.relabel_tree("/mnt/eupneaos", file_contexts))
+
 
+# Fallback for policies relabel.py can't read, runs fixfiles inside the chroot
+def relabel_files_fixfiles() -> None:
     # copy /proc files needed for fixfiles
     mkdir("/mnt/eupneaos/proc/self")
     cpfile("configs/selinux/mounts", "/mnt/eupneaos/proc/self/mounts")
@@ -250,52 +741,624 @@ def relabel_files() -> None:
     cpfile("configs/selinux/unlabeled", "/mnt/eupneaos/sys/fs/selinux/initial_contexts/unlabeled")
 
     # Backup original selinux
-    cpfile("/mnt/eupneaos/usr/sbin/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles.bak")
+    cpfile("/mnt/eupneaos/usr/sbin/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles.bak", preserve=True)
     # Copy patched fixfiles script
-    cpfile("configs/selinux/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles")
+    cpfile("configs/selinux/fixfiles", "/mnt/eupneaos/usr/sbin/fixfiles", mode=0o755)
 
-    chroot("/sbin/fixfiles -T 0 restore")
+    chroot(["/sbin/fixfiles", "-T", "0", "restore"])
 
-    # Restore original fixfiles
+    # Restore original fixfiles, writing into the existing file keeps the label it just got
     cpfile("/mnt/eupneaos/usr/sbin/fixfiles.bak", "/mnt/eupneaos/usr/sbin/fixfiles")
     rmfile("/mnt/eupneaos/usr/sbin/fixfiles.bak")
 
 
-# Shrink image to actual size
-def compress_image(img_mnt: str) -> None:
-    print_status("Shrinking image")
-    bash(f"e2fsck -fpv {img_mnt}p3")  # Force check filesystem for errors
-    bash(f"resize2fs -f -M {img_mnt}p3")
-    block_count = int(bash(f"dumpe2fs -h {img_mnt}p3 | grep 'Block count:'")[12:].split()[0])
-    actual_fs_in_bytes = block_count * 4096
-    # the kernel part is always the same size -> sector amount: 131072 * 512 => 67108864 bytes
-    # There are 2 kernel partitions -> 67108864 bytes * 2 = 134217728 bytes
-    actual_fs_in_bytes += 134217728
-    actual_fs_in_bytes += 20971520  # add 20mb for linux to be able to boot properly
-    bash(f"truncate --size={actual_fs_in_bytes} ./eupneaos-uefi.img")
+#######################################################################################
+#                              IMAGE STREAMING FUNCTIONS                              #
+#######################################################################################
+# A consumer receives the chunks of a file that is read only once by fan_out_file(). Each consumer runs in its own
+# thread, so the time it spends in write() is the time its encoder needed to accept the data.
+class StreamConsumer:
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes = 0
+        self.busy_time = 0.0  # time spent inside write()/close()
+        self.wall_time = 0.0  # time from the start of the stream until close() returned
 
-    # compress image to tar. Tars are smaller but the native file manager on chromeos cant uncompress them
-    # These are stored as backups in the GitHub releases
-    bash("tar -cv -I 'xz -9 -T0' -f ./eupneaos-uefi.img.tar.xz ./eupneaos-uefi.img")
+    def write(self, chunk: bytes) -> None:
+        raise NotImplementedError
+
+    # Called instead of write() for holes in sparse files. Consumers that can't represent holes get zeros from memory.
+    def write_hole(self, length: int) -> None:
+        zeros = bytes(min(length, 8388608))
+        while length > 0:
+            self.write(zeros if length >= len(zeros) else zeros[:length])
+            length -= len(zeros)
 
-    # Rar archives are bigger, but natively supported by the ChromeOS file manager
-    # These are uploaded as artifacts and then manually uploaded to a cloud storage
-    bash("rar a eupneaos-uefi.img.rar -m5 eupneaos-uefi.img")
+    def close(self) -> None:
+        pass
 
-    print_status("Calculating sha256sums")
-    # Calculate sha256sum sums
-    with open("eupneaos-uefi.sha256", "w") as file:
-        file.write(bash("sha256sum eupneaos-uefi.img eupneaos-uefi.img.tar.xz "
-                        "eupneaos-uefi.img.rar"))
+
+class Sha256Consumer(StreamConsumer):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.hash = hashlib.sha256()
+
+    def write(self, chunk: bytes) -> None:
+        self.hash.update(chunk)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+# Advances a progress monitor by the bytes that were read
+class ProgressConsumer(StreamConsumer):
+    def __init__(self, name: str, progress: ProgressMonitor):
+        super().__init__(name)
+        self.progress = progress
+
+    def write(self, chunk: bytes) -> None:
+        self.progress.advance(len(chunk))
+
+
+# Splits the stream into the content-defined chunks of chunk_index.py. Holes become zero chunks without being scanned.
+class ChunkIndexConsumer(StreamConsumer):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.chunker = chunk_index.Chunker()
+        self.chunks = []
+
+    def write(self, chunk: bytes) -> None:
+        self.chunker.update(chunk)
+
+    def write_hole(self, length: int) -> None:
+        self.chunker.update_zeros(length)
+
+    def close(self) -> None:
+        self.chunks = self.chunker.finish()
+
+
+# Compresses the stream into a seekable zstd archive, the frames are compressed in parallel. Holes become zero frames
+# that are only compressed once.
+class ZstdSeekableConsumer(StreamConsumer):
+    def __init__(self, name: str, output_path: str):
+        super().__init__(name)
+        self.writer = zstd_seekable.SeekableWriter(output_path)
+
+    def write(self, chunk: bytes) -> None:
+        self.writer.write(chunk)
+
+    def write_hole(self, length: int) -> None:
+        self.writer.write_zeros(length)
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def hexdigest(self) -> str:
+        return self.writer.hexdigest()
+
+
+# Feed the stream into the stdin of an encoder. If output_path is set, the encoder has to write to stdout, which is
+# saved to output_path and hashed while it is written.
+class ProcessConsumer(StreamConsumer):
+    def __init__(self, name: str, command: list, output_path: str = None):
+        super().__init__(name)
+        self.command = command
+        self.output_path = output_path
+        self.output_hash = hashlib.sha256()
+        self.start_time = time.perf_counter()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE if output_path else None)
+        self.drain_thread = None
+        if output_path:
+            self.drain_thread = Thread(target=self._drain_output, daemon=True)
+            self.drain_thread.start()
+
+    def _drain_output(self) -> None:
+        with open(self.output_path, "wb") as output:
+            while chunk := self.process.stdout.read(1048576):
+                output.write(chunk)
+                self.output_hash.update(chunk)
+
+    def write(self, chunk: bytes) -> None:
+        self.process.stdin.write(chunk)
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        if self.drain_thread:
+            self.drain_thread.join()
+        log_command(wait_process(self.process, self.command, self.start_time))
+        if self.process.returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+    def hexdigest(self) -> str:
+        return self.output_hash.hexdigest()
+
+
+# Wrap the stream into a single-member tar archive before handing it to the encoder, so that the result is identical
+# to "tar -c -I <encoder> -f <output_path> ./<file>".
+# If data_ranges is set, the member is stored in the GNU tar sparse format 1.0 (same as "tar -c -S") and holes are
+# never passed to the encoder. data_ranges has to be the same list that is passed to fan_out_file().
+class TarProcessConsumer(ProcessConsumer):
+    def __init__(self, name: str, command: list, output_path: str, member_path: str, data_ranges: list = None):
+        super().__init__(name, command, output_path)
+        file_stat = os.stat(member_path)
+        member_name = "./" + Path(member_path).name
+        sparse_map = b""
+        if data_ranges is None:
+            tar_info = tarfile.TarInfo(member_name)
+            tar_info.size = file_stat.st_size
+            tar_format = tarfile.GNU_FORMAT
+        else:
+            # the sparse map is stored as text in front of the data, GNU tar adds an empty region for trailing holes
+            regions = list(data_ranges)
+            if not regions or regions[-1][0] + regions[-1][1] < file_stat.st_size:
+                regions.append((file_stat.st_size, 0))
+            sparse_map = f"{len(regions)}\n".encode()
+            for offset, length in regions:
+                sparse_map += f"{offset}\n{length}\n".encode()
+            sparse_map += b"\0" * (-len(sparse_map) % tarfile.BLOCKSIZE)
+            tar_info = tarfile.TarInfo(f"./GNUSparseFile.0/{Path(member_path).name}")
+            tar_info.size = len(sparse_map) + sum(length for _, length in data_ranges)
+            tar_info.pax_headers = {"GNU.sparse.major": "1", "GNU.sparse.minor": "0", "GNU.sparse.name": member_name,
+                                    "GNU.sparse.realsize": str(file_stat.st_size)}
+            tar_format = tarfile.PAX_FORMAT
+        tar_info.mtime = int(file_stat.st_mtime)
+        tar_info.mode = file_stat.st_mode & 0o7777
+        tar_info.uid, tar_info.gid = file_stat.st_uid, file_stat.st_gid
+        header = tar_info.tobuf(format=tar_format) + sparse_map
+        self.sparse = data_ranges is not None
+        self.tar_size = tar_info.size
+        self.tar_written = len(header)
+        self.process.stdin.write(header)
+
+    def write(self, chunk: bytes) -> None:
+        super().write(chunk)
+        self.tar_written += len(chunk)
+
+    def write_hole(self, length: int) -> None:
+        if not self.sparse:
+            super().write_hole(length)
+
+    def close(self) -> None:
+        # pad the member data to a full block, add the two zero end blocks and pad the archive to a full record
+        trailer = b"\0" * (-self.tar_size % tarfile.BLOCKSIZE) + b"\0" * (2 * tarfile.BLOCKSIZE)
+        self.tar_written += len(trailer)
+        trailer += b"\0" * (-self.tar_written % tarfile.RECORDSIZE)
+        self.process.stdin.write(trailer)
+        super().close()
+
+
+def __run_consumer(consumer: StreamConsumer, chunks: Queue, start_time: float, errors: list) -> None:
+    failed = False
+    while True:
+        chunk = chunks.get()
+        if failed:  # keep emptying the queue so that the reader doesn't block on a dead consumer
+            if chunk is None:
+                return
+            continue
+        try:
+            busy_start = time.perf_counter()
+            if chunk is None:
+                consumer.close()
+            elif isinstance(chunk, int):  # hole
+                consumer.write_hole(chunk)
+                consumer.bytes += chunk
+            else:
+                consumer.write(chunk)
+                consumer.bytes += len(chunk)
+            consumer.busy_time += time.perf_counter() - busy_start
+        except Exception as e:
+            errors.append((consumer.name, e))
+            failed = True
+            continue
+        if chunk is None:
+            consumer.wall_time = time.perf_counter() - start_time
+            return
+
+
+# Read a file once and pass every chunk to all consumers at the same time. The queues are bounded, so the memory usage
+# is limited to queue_depth * chunk_size per consumer and the reader runs at the speed of the slowest consumer.
+# If sparse is set, holes are not read but passed to the consumers as their length. Returns the amount of bytes read.
+def fan_out_file(src: str, consumers: list, chunk_size: int = 8388608, queue_depth: int = 8, sparse: bool = True,
+                 data_ranges: list = None) -> int:
+    start_time = time.perf_counter()
+    errors = []
+    queues = [Queue(maxsize=queue_depth) for _ in consumers]
+    threads = [Thread(target=__run_consumer, args=(consumer, chunk_queue, start_time, errors), daemon=True)
+               for consumer, chunk_queue in zip(consumers, queues)]
+    for thread in threads:
+        thread.start()
+    if sparse:
+        chunks = read_sparse_chunks(src, data_ranges, chunk_size)
+    else:
+        chunks = read_sparse_chunks(src, [(0, os.path.getsize(src))], chunk_size)
+    bytes_read = 0
+    for chunk in chunks:
+        if not isinstance(chunk, int):
+            bytes_read += len(chunk)
+        for chunk_queue in queues:
+            chunk_queue.put(chunk)
+    for chunk_queue in queues:
+        chunk_queue.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(f"{errors[0][0]} failed while streaming {src}") from errors[0][1]
+    return bytes_read
+
+
+def print_throughput(consumers: list) -> None:
+    for consumer in sorted(consumers, key=lambda c: c.wall_time, reverse=True):
+        mib = consumer.bytes / 1048576
+        throughput = mib / consumer.wall_time if consumer.wall_time else 0
+        print_status(f"{consumer.name}: {mib:.0f} MiB in {consumer.wall_time:.1f}s ({throughput:.1f} MiB/s), "
+                     f"busy for {consumer.busy_time:.1f}s")
+
+
+# Holes are hashed as zeros from memory, so they are never read from disk
+def sha256_file(file_path: str) -> str:
+    file_hash = Sha256Consumer("sha256")
+    for chunk in read_sparse_chunks(file_path):
+        if isinstance(chunk, int):
+            file_hash.write_hole(chunk)
+        else:
+            file_hash.write(chunk)
+    return file_hash.hexdigest()
 
 
-def chroot(command: str) -> None:
-    bash(f'chroot /mnt/eupneaos /bin/bash -c "{command}"')  # always print output
+# Shrink image to actual size
+# Shrink the rootfs, the last partition, to its minimal size and cut the image right after it. Every byte removed here
+# doesn't have to be compressed, uploaded and downloaded.
+def shrink_image(img_mnt: str) -> None:
+    print_status("Shrinking image")
+    rootfs_part = f"{img_mnt}p4"
+    old_size = os.path.getsize("eupneaos-uefi.img")
+    # Force check filesystem for errors, 1 means errors were fixed
+    if run(["e2fsck", "-fy", rootfs_part], check=False)["returncode"] > 1:
+        print_error("Rootfs has errors that e2fsck couldn't fix")
+        exit(1)
+    bash(f"resize2fs -M {rootfs_part}")
+    superblock = {}
+    for line in bash(f"dumpe2fs -h {rootfs_part}").splitlines():
+        key, _, value = line.partition(":")
+        superblock[key] = value.strip()
+    fs_size = int(superblock["Block count"]) * int(superblock["Block size"])
+    bash(f"losetup -d {img_mnt}")  # unmount image
+
+    rootfs_start = gpt.read_gpt("eupneaos-uefi.img")["partitions"][3]["start"]
+    gpt.resize_last_partition("eupneaos-uefi.img", rootfs_start + fs_size)
+    new_size = os.path.getsize("eupneaos-uefi.img")
+    print_status(f"Shrunk image from {old_size / 1048576:.0f} MiB to {new_size / 1048576:.0f} MiB "
+                 f"({fs_size / 1048576:.0f} MiB rootfs)")
+
+
+def compress_image(image_path: str = "eupneaos-uefi.img") -> None:
+    print_status(f"Compressing {image_path} and calculating sha256sums")
+    # The image is read only once and streamed into all encoders and the hash at the same time. Holes in the sparse
+    # image are never read.
+    data_ranges = get_data_ranges(image_path)
+    image_hash = Sha256Consumer("sha256")
+    archives = {}  # archive path -> consumer that hashes it, None if it has to be hashed after it was written
+    consumers = [image_hash]
+    if "xz" in image_formats:
+        # compress image to tar. Tars are smaller but the native file manager on chromeos cant uncompress them
+        # These are stored as backups in the GitHub releases. Holes are stored as sparse tar regions.
+        tar_xz = TarProcessConsumer("xz", ["xz", "-9", "-T0", "-c"], f"{image_path}.tar.xz", image_path, data_ranges)
+        archives[f"{image_path}.tar.xz"] = tar_xz
+        consumers.append(tar_xz)
+    if "rar" in image_formats:
+        # Rar archives are bigger, but natively supported by the ChromeOS file manager
+        # These are uploaded as artifacts and then manually uploaded to a cloud storage
+        # rar can't write archives to stdout, so the rar archive is hashed after it has been written
+        consumers.append(ProcessConsumer("rar", ["rar", "a", "-m5", f"-si{image_path}", f"{image_path}.rar"]))
+        archives[f"{image_path}.rar"] = None
+    if "zst" in image_formats:
+        # Compresses much faster than xz and can be decompressed in parallel or streamed to a device with zstd -dc
+        zst = ZstdSeekableConsumer("zstd", f"{image_path}.zst")
+        archives[f"{image_path}.zst"] = zst
+        consumers.append(zst)
+    # The chunk index lets users rebuild this image from their old one and the chunks that changed. Chunking hashes
+    # the whole image a second time, so it is only done for releases.
+    chunks = None
+    if write_chunk_index:
+        chunks = ChunkIndexConsumer("chunk index")
+        consumers.append(chunks)
+    bytes_read = fan_out_file(image_path, consumers, data_ranges=data_ranges)
+    print_status(f"Read {bytes_read / 1048576:.0f} MiB of {image_hash.bytes / 1048576:.0f} MiB image")
+    print_throughput(consumers)
+
+    index_path = f"{image_path}.chunks.json"
+    if chunks:
+        if path_exists(index_path):  # index of the previous build
+            print_status("Chunks reused from the previous build:")
+            chunk_index.print_reuse(chunk_index.compare_indexes(chunk_index.read_index(index_path),
+                                                                {"chunks": chunks.chunks}))
+        chunk_index.write_index(index_path, image_hash.bytes, image_hash.hexdigest(), chunks.chunks)
+    if chunks and chunk_store:
+        store_stats = chunk_index.store_chunks(image_path, chunks.chunks, chunk_store)
+        print_status(f"Added {store_stats['new_chunks']} chunks ({store_stats['new_bytes'] / 1048576:.1f} MiB, "
+                     f"{store_stats['compressed_bytes'] / 1048576:.1f} MiB compressed) to the chunk store, "
+                     f"{store_stats['stored_chunks']} chunks ({store_stats['stored_bytes'] / 1048576:.1f} MiB) were "
+                     f"already stored")
+
+    # Calculate sha256sum sums, same format as sha256sum
+    with open(f"{image_path.removesuffix('.img')}.sha256", "w") as file:
+        file.write(f"{image_hash.hexdigest()}  {image_path}\n")
+        for archive_path, archive_hash in archives.items():
+            file.write(f"{archive_hash.hexdigest() if archive_hash else sha256_file(archive_path)}  {archive_path}\n")
+        if chunks:
+            file.write(f"{sha256_file(index_path)}  {index_path}\n")
+
+
+#######################################################################################
+#                                  KERNEL VARIANTS                                    #
+#######################################################################################
+# Every variant is an overlay on top of the finished staging rootfs that only replaces the kernel modules, headers and
+# firmware. The shared rootfs is never written, so all variants and the mainline image are assembled and compressed at
+# the same time.
+def prepare_variant(variant: str, file_contexts: relabel.FileContexts) -> None:
+    print_status(f"Preparing {variant} kernel variant")
+    variant_dir = f"{staging_dir}/variants/{variant}"
+    artifacts_dir = f"/tmp/eupneaos-build/{variant}"
+    if path_exists(variant_dir):
+        rmdir(variant_dir, keep_dir=False)  # leftover of an aborted build
+    for layer in ["upper", "work", "root"]:
+        mkdir(f"{variant_dir}/{layer}", create_parents=True)
+    bash(f"mount -t overlay overlay -o lowerdir={staging_dir}/root,upperdir={variant_dir}/upper,"
+         f"workdir={variant_dir}/work {variant_dir}/root")
+    root = f"{variant_dir}/root"
+
+    # replace the mainline kernel, removed files only become whiteouts in the upper layer
+    base_version = get_kernel_version("/tmp/eupneaos-build/modules.tar.xz")
+    kernel_version = get_kernel_version(f"{artifacts_dir}/modules.tar.xz")
+    rmdir(f"{root}/lib/modules/{base_version}", keep_dir=False)
+    rmdir(f"{root}/usr/src/linux-headers-{base_version}", keep_dir=False)
+    mkdir(f"{root}/usr/src/linux-headers-{kernel_version}", create_parents=True)
+    extract_archives([{"archive": f"{artifacts_dir}/modules.tar.xz", "dest": f"{root}/lib/modules/"},
+                      {"archive": f"{artifacts_dir}/headers.tar.xz",
+                       "dest": f"{root}/usr/src/linux-headers-{kernel_version}/"}])
+    os.symlink(f"/usr/src/linux-headers-{kernel_version}/", f"{root}/lib/modules/{kernel_version}/build")
+    kernel_modules.print_modules_report(kernel_modules.process_modules(root, kernel_version, strip_modules))
+    # firmware the mainline kernel already needed is in the lower layer
+    firmware.print_firmware_report(firmware.install_firmware("linux-firmware", f"{root}/lib/firmware",
+                                                             f"{artifacts_dir}/modules.tar.xz",
+                                                             "configs/firmware-allowlist.conf"))
+    # only the files of the variant don't have a label yet
+    relabel.print_relabel_report(relabel.relabel_tree(root, file_contexts))
+    sign_kernel(f"{artifacts_dir}/bzImage", f"{artifacts_dir}/bzImage.signed")
+
+
+def remove_variant(variant: str) -> None:
+    bash(f"umount {staging_dir}/variants/{variant}/root")
+    rmdir(f"{staging_dir}/variants/{variant}", keep_dir=False)
+
+
+def get_variant_steps(file_contexts: relabel.FileContexts) -> list:
+    steps = [step(assemble_image, outputs=["image"]),
+             step(compress_image, inputs=["image"])]
+    for variant in variants:
+        image_path = f"eupneaos-uefi-{variant}.img"
+        steps += [step(prepare_variant, args=[variant, file_contexts], outputs=[f"{variant}_root"],
+                       name=f"prepare_{variant}"),
+                  step(assemble_image, args=[image_path, f"{staging_dir}/variants/{variant}/root",
+                                             f"/tmp/eupneaos-build/{variant}/bzImage.signed"],
+                       inputs=[f"{variant}_root"], outputs=[f"{variant}_image"], name=f"assemble_{variant}"),
+                  step(remove_variant, args=[variant], inputs=[f"{variant}_image"], name=f"remove_{variant}"),
+                  step(compress_image, args=[image_path], inputs=[f"{variant}_image"], name=f"compress_{variant}")]
+    return steps
+
+
+# Assemble and compress the mainline image and every kernel variant from the finished staging rootfs
+def build_variants(jobs: int) -> None:
+    file_contexts = relabel.load_file_contexts(f"{staging_dir}/root")
+    # every variant needs a worker for each of its steps that can run at the same time
+    scheduler.run_steps(get_variant_steps(file_contexts), workers=max(jobs, 2 * len(variants) + 2))
+
+
+# Bind mount the host package cache (and the offline repo) into the chroot
+def mount_dnf_dirs() -> None:
+    mkdir(dnf_cache_dir, create_parents=True)
+    mkdir("/mnt/eupneaos/var/cache/dnf", create_parents=True)
+    bash(f"mount --bind {dnf_cache_dir} /mnt/eupneaos/var/cache/dnf")
+    if offline_repo:
+        mkdir("/mnt/eupneaos/run/eupneaos-repo", create_parents=True)
+        bash(f"mount --bind -o ro {get_full_path(offline_repo)} /mnt/eupneaos/run/eupneaos-repo")
+
+
+def unmount_dnf_dirs() -> None:
+    for mountpoint in ["/mnt/eupneaos/run/eupneaos-repo", "/mnt/eupneaos/var/cache/dnf"]:
+        if os.path.ismount(mountpoint):
+            bash(f"umount {mountpoint}")
+
+
+# Install all packages in one transaction: metadata is loaded and dependencies are resolved only once and all packages
+# are downloaded in parallel into the persistent cache
+def dnf_install(packages: list) -> None:
+    options = ["--releasever=37", "--allowerasing", "-y", "--setopt=keepcache=True",
+               f"--setopt=max_parallel_downloads={DNF_PARALLEL_DOWNLOADS}"]
+    if offline_repo:
+        options += ["--disablerepo=*", "--repofrompath=eupneaos-offline,/run/eupneaos-repo",
+                    "--enablerepo=eupneaos-offline", "--nogpgcheck"]
+        # release packages are installed by name from the offline repo, e.g. rpmfusion-free-release-37.noarch.rpm
+        packages = [Path(package).name.rsplit("-", 1)[0] if package.startswith("https://") else package
+                    for package in packages]
+    mount_dnf_dirs()
+    try:
+        chroot(["dnf", "install"] + options + packages)
+    finally:
+        unmount_dnf_dirs()
+
+
+#######################################################################################
+#                                  CHROOT FUNCTIONS                                   #
+#######################################################################################
+# The agent runs inside the chroot for the whole build. It reads one json request per line from stdin, runs the argv
+# of the request without a shell and sends back the output while it is produced and a result with the exit status and
+# the timings of the command. Requests are handled in parallel, each one in its own thread.
+CHROOT_AGENT = r'''
+import codecs, json, os, subprocess, sys, threading, time
+lock = threading.Lock()
+def send(message):
+    with lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+def pump(request_id, stream_name, stream, collected):
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    while data := os.read(stream.fileno(), 65536):
+        text = decoder.decode(data)
+        collected.append(text)
+        send({"id": request_id, "stream": stream_name, "data": text})
+def run(request):
+    start = time.perf_counter()
+    stdout, stderr = [], []
+    try:
+        process = subprocess.Popen(request["argv"], cwd=request.get("cwd") or "/", stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   stdin=subprocess.PIPE if request.get("input") is not None else subprocess.DEVNULL)
+    except OSError as e:
+        send({"id": request["id"], "returncode": 127, "stdout": "", "stderr": str(e), "wall_time": 0,
+              "user_time": 0, "system_time": 0, "max_rss": 0, "rchar": 0, "wchar": 0, "read_bytes": 0,
+              "write_bytes": 0})
+        return
+    pumps = [threading.Thread(target=pump, args=(request["id"], name, stream, collected))
+             for name, stream, collected in [("stdout", process.stdout, stdout), ("stderr", process.stderr, stderr)]]
+    for thread in pumps:
+        thread.start()
+    if request.get("input") is not None:
+        process.stdin.write(request["input"].encode())
+        process.stdin.close()
+    for thread in pumps:
+        thread.join()
+    # read the io counters of the zombie before reaping it, /proc is not mounted before bootstrap_rootfs finished
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    try:
+        with open(f"/proc/{process.pid}/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        io = {key: int(counters[key]) for key in ["rchar", "wchar", "read_bytes", "write_bytes"]}
+    except OSError:
+        io = None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if io is None:
+        io = {"rchar": 0, "wchar": 0, "read_bytes": usage.ru_inblock * 512, "write_bytes": usage.ru_oublock * 512}
+    send({"id": request["id"], "returncode": process.returncode, "stdout": "".join(stdout),
+          "stderr": "".join(stderr), "wall_time": time.perf_counter() - start, "user_time": usage.ru_utime,
+          "system_time": usage.ru_stime, "max_rss": usage.ru_maxrss, **io})
+for line in sys.stdin:
+    threading.Thread(target=run, args=(json.loads(line),)).start()
+'''
+
+
+# Host side of the chroot agent. The chroot process is started once and every command is sent to it over a pipe.
+class ChrootSession:
+    def __init__(self, root: str):
+        self.root = root
+        self.process = subprocess.Popen(["chroot", root, "/usr/bin/python3", "-u", "-c", CHROOT_AGENT],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}  # request id -> handle, see submit()
+        self.reader = Thread(target=self._read_results, daemon=True)
+        self.reader.start()
+
+    def _read_results(self) -> None:
+        for line in self.process.stdout:
+            message = json.loads(line)
+            if "stream" in message:
+                if functions.verbose:
+                    print(message["data"], end="", flush=True,
+                          file=sys.stdout if message["stream"] == "stdout" else sys.stderr)
+                continue
+            with self.lock:
+                handle = self.pending.pop(message["id"])
+            handle["result"] = message
+            handle["done"].set()
+        # agent died, fail all commands that are still waiting
+        with self.lock:
+            for handle in self.pending.values():
+                handle["done"].set()
+            self.pending.clear()
+
+    # Send a command to the agent without waiting for it, returns a handle for wait()
+    def submit(self, argv: list, cwd: str = None, input_text: str = None) -> dict:
+        with self.lock:
+            self.next_id += 1
+            handle = {"argv": argv, "done": threading.Event(), "result": None}
+            self.pending[self.next_id] = handle
+            self.process.stdin.write(json.dumps({"id": self.next_id, "argv": argv, "cwd": cwd,
+                                                 "input": input_text}) + "\n")
+            self.process.stdin.flush()
+        return handle
+
+    @staticmethod
+    def wait(handle: dict) -> dict:
+        handle["done"].wait()
+        result = handle["result"]
+        if result is None:
+            raise RuntimeError(f"chroot agent exited while running: {handle['argv']}")
+        result["argv"] = handle["argv"]
+        return result
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+        self.reader.join()
+
+
+chroot_session = None
+chroot_session_lock = threading.Lock()
+
+
+def get_chroot_session() -> ChrootSession:
+    global chroot_session
+    with chroot_session_lock:  # steps running at the same time share one agent
+        if chroot_session is None:
+            chroot_session = ChrootSession("/mnt/eupneaos")
+        return chroot_session
+
+
+# The chroot process keeps /mnt/eupneaos busy, it has to be closed before the image is unmounted
+def close_chroot_session() -> None:
+    global chroot_session
+    with chroot_session_lock:
+        if chroot_session is not None:
+            chroot_session.close()
+            chroot_session = None
+
+
+def __check_chroot_result(result: dict) -> dict:
+    log_command({"command": ["chroot"] + result["argv"]} | result)
+    if result["returncode"] != 0:
+        raise subprocess.CalledProcessError(result["returncode"], result["argv"], result["stdout"], result["stderr"])
+    return result
+
+
+# Run a command in the chroot and return its result (returncode, stdout, stderr and timings).
+# Commands are argv lists, strings are run with bash -c for shell features like globs.
+def chroot_run(command, cwd: str = None, input_text: str = None) -> dict:
+    argv = ["/bin/bash", "-c", command] if isinstance(command, str) else command
+    session = get_chroot_session()
+    return __check_chroot_result(session.wait(session.submit(argv, cwd, input_text)))
+
+
+# Run independent commands in the chroot at the same time
+def chroot_batch(commands: list) -> list:
+    session = get_chroot_session()
+    handles = [session.submit(["/bin/bash", "-c", command] if isinstance(command, str) else command)
+               for command in commands]
+    return [__check_chroot_result(result) for result in [session.wait(handle) for handle in handles]]
+
+
+def chroot(command, cwd: str = None, input_text: str = None) -> str:
+    return chroot_run(command, cwd, input_text)["stdout"].strip()
 
 
 if __name__ == "__main__":
     args = process_args()  # process args
     set_verbose(True)  # increase verbosity
+    set_command_log(args.command_log)
+    if args.profile:
+        start_load_sampler()
 
     # parse arguments
     kernel_type = "mainline"
@@ -311,32 +1374,97 @@ if __name__ == "__main__":
         print_warning("Using mainline testing kernel")
         kernel_type = "mainline-testing"
 
-    # prepare mount
-    mkdir("/mnt/eupneaos", create_parents=True)
-
-    image_props = prepare_image()
-    uuids = get_uuids(image_props)
-    bootstrap_rootfs()
-    configure_rootfs(uuids)
-    customize_kde()
-    relabel_files()
-
-    # Clean image of temporary files
-    rmdir("/mnt/eupneaos/tmp")
-    rmdir("/mnt/eupneaos/var/tmp")
-    rmdir("/mnt/eupneaos/var/cache")
-    rmdir("/mnt/eupneaos/proc")
-    rmdir("/mnt/eupneaos/run")
-    rmdir("/mnt/eupneaos/sys")
-    rmdir("/mnt/eupneaos/lost+found")
-    rmdir("/mnt/eupneaos/dev")
-    rmfile("/mnt/eupneaos/.stop_progress")
+    variants = [variant for variant in args.variants.split(",") if variant]
+    for variant in variants:
+        if variant not in KERNEL_VARIANTS:
+            print_error(f"Unknown kernel variant {variant}, available: {', '.join(KERNEL_VARIANTS)}")
+            exit(1)
+    if variants and not args.staging_dir and not args.fetch_only:
+        print_error("Kernel variants are built as overlays of the staging dir, --variants needs --staging-dir")
+        exit(1)
 
-    # Force unmount image
-    bash("umount -f /mnt/eupneaos")
-    sleep(5)  # wait for umount to finish
-    compress_image(image_props)
+    set_download_cache_dir(args.download_cache)
+    fetch_artifacts(refresh=args.fetch_only)
+    if args.fetch_only:
+        exit(0)
+
+    dnf_cache_dir = args.dnf_cache
+    staging_dir = get_full_path(args.staging_dir) if args.staging_dir else ""
+    strip_modules = args.strip_modules
+    chunk_store = get_full_path(args.chunk_store) if args.chunk_store else ""
+    write_chunk_index = args.chunk_index or bool(chunk_store)
+    image_formats = [image_format for image_format in args.formats.split(",") if image_format]
+    for image_format in image_formats:
+        if image_format not in IMAGE_FORMATS:
+            print_error(f"Unknown image format {image_format}, available: {', '.join(IMAGE_FORMATS)}")
+            exit(1)
+    offline_repo = args.offline_repo
+    if offline_repo:
+        print_warning(f"Installing packages from offline repo {offline_repo}")
 
-    bash(f"losetup -d {image_props}")  # unmount image
+    # prepare mount
+    mkdir("/mnt/eupneaos", create_parents=True)
 
+    # Find the first stage that has to run. Every stage before it is restored from the cache.
+    stage_keys = {}
+    first_stage = 0
+    if not args.no_cache:
+        stage_cache.set_cache_dir(args.cache_dir)
+        stage_cache.set_max_cache_size(args.cache_size * 1073741824)
+        print_status("Hashing stage inputs")
+        stage_keys = get_stage_keys()
+        if args.resume_from:
+            first_stage = BUILD_STAGES.index(args.resume_from)
+            if first_stage > 0 and not stage_cache.has_snapshot(stage_keys[BUILD_STAGES[first_stage - 1]]):
+                print_error(f"No valid cached output of {BUILD_STAGES[first_stage - 1]}, "
+                            f"can't resume from {args.resume_from}")
+                exit(1)
+        else:
+            for index, stage_name in enumerate(BUILD_STAGES):
+                if stage_cache.has_snapshot(stage_keys[stage_name]):
+                    first_stage = index + 1
+
+    image_props = ""
+    if first_stage > 0:
+        with profile_stage("restore_cache"):
+            stage_cache.restore_snapshot(stage_keys[BUILD_STAGES[first_stage - 1]],
+                                         staging_dir or "eupneaos-uefi.img")
+            image_props = attach_image()
+            mount_image(image_props)
+            if first_stage > 1:  # rootfs has been bootstrapped already
+                mount_chroot_fs()
+        print_status(f"Resuming build after {BUILD_STAGES[first_stage - 1]}")
+
+    for stage_name in BUILD_STAGES[first_stage:]:
+        with profile_stage(stage_name):
+            image_props = run_stage(stage_name, image_props, args.jobs)
+        if not args.no_cache:
+            with profile_stage(f"cache_{stage_name}"):
+                cache_stage(stage_name, stage_keys[stage_name], image_props)
+
+    with profile_stage("clean_image"):
+        clean_image()
+        # Unmount image
+        unmount_image()
+        sleep(5)  # wait for umount to finish
+
+    if variants:
+        with profile_stage("build_variants"):
+            build_variants(args.jobs)
+    else:
+        if staging_dir:
+            # the rootfs is sized to fit when it is created, there is nothing to shrink
+            with profile_stage("assemble_image"):
+                assemble_image()
+        else:
+            with profile_stage("shrink_image"):
+                shrink_image(image_props)
+
+        with profile_stage("compress_image"):
+            compress_image()
+
+    stop_load_sampler()
+    profiler.profile["steps"] = scheduler.step_timings
+    write_profile_report(args.profile_report, args.profile_baseline)
+    scheduler.print_critical_path()
     print_header("Image creation completed successfully!")
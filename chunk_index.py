@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# Content-defined chunk index of raw images, so that a new image can be rebuilt from an old one plus the changed chunks.
+# Files in ext4 and fat start at 4 KiB blocks, so the image is cut between blocks: after a block whose crc32 matches
+# CUT_MASK or where a run of zero blocks starts or ends, but not before MIN_CHUNK_SIZE and at MAX_CHUNK_SIZE at the
+# latest. A file that moves to other blocks still produces the same chunks, unlike fixed size chunks that only match if
+# the data stays at the same offset.
+# Chunks that only contain zeros (mostly holes of the sparse image) are marked with an empty hash and never stored.
+#
+# An index is a json file: {"version", "size", "sha256", "chunks": [[offset, length, sha256], ...]}
+# A chunk store is a directory (or the url of one) with the xz compressed chunks as <sha256[:2]>/<sha256>.xz.
+
+import argparse
+import hashlib
+import json
+import lzma
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from functions import *
+from sparse import read_sparse_chunks
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 4096
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 4194304
+CUT_MASK = 0x7F  # a cut after every 128th block on average, chunks are ~576 KiB
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+ZERO_BLOCK_CRC = zlib.crc32(ZERO_BLOCK)
+
+
+# Splits a stream into chunks. update() and update_zeros() can be called with any length, finish() returns the chunks.
+class Chunker:
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0  # start of the current chunk
+        self.length = 0  # length of the current chunk
+        self.hash = None  # None while the current chunk only contains zeros
+        self.pending = b""  # incomplete block
+
+    def __finish_chunk(self) -> None:
+        self.chunks.append([self.offset, self.length, self.hash.hexdigest() if self.hash else ""])
+        self.offset += self.length
+        self.length = 0
+        self.hash = None
+
+    def update(self, data: bytes) -> None:
+        if self.pending:
+            data = self.pending + bytes(data)
+        view = memoryview(data)
+        end = len(data) - len(data) % BLOCK_SIZE
+        hash_start = 0  # data before hash_start is already hashed or zeros of a zero chunk
+        for block_start in range(0, end, BLOCK_SIZE):
+            block = view[block_start:block_start + BLOCK_SIZE]
+            crc = zlib.crc32(block)
+            is_zero = crc == ZERO_BLOCK_CRC and block == ZERO_BLOCK
+            # cut where zeros start or end, so runs of zeros become zero chunks instead of filling up data chunks
+            if self.length >= MIN_CHUNK_SIZE and is_zero == (self.hash is not None):
+                if self.hash is not None:
+                    self.hash.update(view[hash_start:block_start])
+                hash_start = block_start
+                self.__finish_chunk()
+            if self.hash is None:
+                if is_zero:
+                    hash_start = block_start + BLOCK_SIZE
+                else:
+                    self.hash = hashlib.sha256(bytes(self.length))  # zeros of this chunk before the first data
+                    hash_start = block_start
+            self.length += BLOCK_SIZE
+            # zero blocks never cut after themselves, zero chunks only end at data or MAX_CHUNK_SIZE
+            if self.length >= MAX_CHUNK_SIZE or (self.length >= MIN_CHUNK_SIZE and not is_zero
+                                                 and crc & CUT_MASK == CUT_MASK):
+                if self.hash is not None:
+                    self.hash.update(view[hash_start:block_start + BLOCK_SIZE])
+                hash_start = block_start + BLOCK_SIZE
+                self.__finish_chunk()
+        if self.hash is not None and hash_start < end:
+            self.hash.update(view[hash_start:end])
+        self.pending = bytes(view[end:])
+
+    # Same as update(bytes(length)), without allocating and scanning the zeros
+    def update_zeros(self, length: int) -> None:
+        if self.pending:
+            fill = min(length, BLOCK_SIZE - len(self.pending))
+            self.update(bytes(fill))
+            length -= fill
+        while length >= BLOCK_SIZE:
+            limit = MAX_CHUNK_SIZE
+            if self.hash is not None:  # zeros after data end the data chunk once it reaches MIN_CHUNK_SIZE
+                if self.length >= MIN_CHUNK_SIZE:
+                    self.__finish_chunk()
+                else:
+                    limit = MIN_CHUNK_SIZE
+            blocks = min(length // BLOCK_SIZE, (limit - self.length) // BLOCK_SIZE)
+            if self.hash is not None:
+                self.hash.update(bytes(blocks * BLOCK_SIZE))
+            self.length += blocks * BLOCK_SIZE
+            length -= blocks * BLOCK_SIZE
+            if self.length >= MAX_CHUNK_SIZE:
+                self.__finish_chunk()
+        if length:
+            self.update(bytes(length))
+
+    def finish(self) -> list:
+        if self.pending:
+            if self.hash is None and self.pending.count(0) != len(self.pending):
+                self.hash = hashlib.sha256(bytes(self.length))
+            if self.hash is not None:
+                self.hash.update(self.pending)
+            self.length += len(self.pending)
+            self.pending = b""
+        if self.length:
+            self.__finish_chunk()
+        return self.chunks
+
+
+# Chunk a file, holes are not read. Returns the chunks and the sha256 of the whole file.
+def chunk_file(file_path: str) -> tuple:
+    chunker = Chunker()
+    file_hash = hashlib.sha256()
+    for chunk in read_sparse_chunks(file_path):
+        if isinstance(chunk, int):
+            chunker.update_zeros(chunk)
+            # feeding zeros is the only way to hash a hole, at least they don't have to be read
+            zeros = bytes(min(chunk, 8388608))
+            while chunk > 0:
+                file_hash.update(zeros[:chunk])
+                chunk -= len(zeros)
+        else:
+            chunker.update(chunk)
+            file_hash.update(chunk)
+    return chunker.finish(), file_hash.hexdigest()
+
+
+def write_index(index_path: str, size: int, sha256: str, chunks: list) -> None:
+    with open(f"{index_path}.tmp", "w") as index_file:
+        json.dump({"version": INDEX_VERSION, "size": size, "sha256": sha256, "chunks": chunks}, index_file)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def read_index(index_location: str) -> dict:
+    if index_location.startswith(("http://", "https://")):
+        with urlopen(index_location, timeout=60) as response:
+            index = json.load(response)
+    else:
+        with open(index_location, "r") as index_file:
+            index = json.load(index_file)
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported chunk index version {index.get('version')} in {index_location}")
+    return index
+
+
+#######################################################################################
+#                                   CHUNK STORE                                       #
+#######################################################################################
+def __chunk_path(store: str, sha256: str) -> str:
+    return f"{store}/{sha256[:2]}/{sha256}.xz"
+
+
+# Add the chunks of an image that are not in the store yet. Only those chunks are read from the image.
+# Returns how many chunks and bytes were already stored and how many were added.
+def store_chunks(image_path: str, chunks: list, store: str, jobs: int = 4) -> dict:
+    stats = {"stored_chunks": 0, "stored_bytes": 0, "new_chunks": 0, "new_bytes": 0, "compressed_bytes": 0}
+    unique_chunks = {chunk[2]: chunk for chunk in chunks if chunk[2]}
+    new_chunks = []
+    for sha256, chunk in unique_chunks.items():
+        if path_exists(__chunk_path(store, sha256)):
+            stats["stored_chunks"] += 1
+            stats["stored_bytes"] += chunk[1]
+        else:
+            new_chunks.append(chunk)
+
+    def store_chunk(chunk: list) -> int:
+        with open(image_path, "rb") as image:
+            data = os.pread(image.fileno(), chunk[1], chunk[0])
+        if hashlib.sha256(data).hexdigest() != chunk[2]:
+            raise ValueError(f"Chunk at {chunk[0]} of {image_path} changed after it was indexed")
+        chunk_path = __chunk_path(store, chunk[2])
+        mkdir(os.path.dirname(chunk_path), create_parents=True)
+        compressed = lzma.compress(data, preset=6)  # lzma releases the gil, the chunks are compressed in parallel
+        with open(f"{chunk_path}.{threading.get_ident()}.tmp", "wb") as chunk_file:
+            chunk_file.write(compressed)
+        os.replace(f"{chunk_path}.{threading.get_ident()}.tmp", chunk_path)
+        return len(compressed)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        stats["compressed_bytes"] = sum(executor.map(store_chunk, new_chunks))
+    stats["new_chunks"] = len(new_chunks)
+    stats["new_bytes"] = sum(chunk[1] for chunk in new_chunks)
+    return stats
+
+
+def __fetch_chunk(store: str, sha256: str) -> bytes:
+    location = __chunk_path(store, sha256)
+    for attempt in range(3):
+        try:
+            if location.startswith(("http://", "https://")):
+                with urlopen(location, timeout=60) as response:
+                    compressed = response.read()
+            else:
+                with open(location, "rb") as chunk_file:
+                    compressed = chunk_file.read()
+            data = lzma.decompress(compressed)
+            if hashlib.sha256(data).hexdigest() != sha256:
+                raise ValueError(f"Chunk {location} is corrupted")
+            return data
+        except (HTTPError, URLError, TimeoutError, ValueError, lzma.LZMAError) as e:
+            if attempt == 2:
+                raise
+            print_warning(f"Failed to fetch chunk {sha256}: {e}, retrying")
+            time.sleep(2 ** attempt)
+
+
+#######################################################################################
+#                                   REBUILDING                                        #
+#######################################################################################
+# Rebuild the image described by index at output_path. Chunks are copied from the seed images (usually the previous
+# release) where possible and fetched from the store otherwise. The result is verified against the hash in the index.
+def apply_index(index: dict, seed_paths: list, output_path: str, store: str = "", jobs: int = 8) -> dict:
+    start_time = time.perf_counter()
+    stats = {"chunks": len(index["chunks"]), "zero_chunks": 0, "seeded_chunks": 0, "seeded_bytes": 0,
+             "fetched_chunks": 0, "fetched_bytes": 0}
+    needed = {}  # sha256 -> offsets in the new image
+    for offset, length, sha256 in index["chunks"]:
+        if sha256:
+            needed.setdefault(sha256, []).append(offset)
+        else:
+            stats["zero_chunks"] += 1
+
+    sources = {}  # sha256 -> (seed path, offset, length)
+    for seed_path in seed_paths:
+        print_status(f"Indexing seed {seed_path}")
+        for offset, length, sha256 in chunk_file(seed_path)[0]:
+            if sha256 in needed and sha256 not in sources:
+                sources[sha256] = (seed_path, offset, length)
+    missing = [sha256 for sha256 in needed if sha256 not in sources]
+    if missing and not store:
+        raise ValueError(f"{len(missing)} chunks are not in the seed images and no chunk store was given")
+
+    rmfile(output_path)
+    output_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(output_fd, index["size"])  # zero chunks stay holes
+        for sha256, (seed_path, seed_offset, length) in sources.items():
+            with open(seed_path, "rb") as seed:
+                data = os.pread(seed.fileno(), length, seed_offset)
+            for offset in needed[sha256]:
+                os.pwrite(output_fd, data, offset)
+                stats["seeded_chunks"] += 1
+                stats["seeded_bytes"] += length
+
+        def fetch(sha256: str) -> int:
+            data = __fetch_chunk(store, sha256)
+            for offset in needed[sha256]:
+                os.pwrite(output_fd, data, offset)
+            return len(data) * len(needed[sha256])
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            stats["fetched_bytes"] = sum(executor.map(fetch, missing))
+        stats["fetched_chunks"] = sum(len(needed[sha256]) for sha256 in missing)
+        os.fsync(output_fd)
+    finally:
+        os.close(output_fd)
+
+    print_status("Verifying image")
+    if chunk_file(output_path)[1] != index["sha256"]:
+        raise ValueError(f"sha256 of {output_path} doesn't match the index")
+    stats["time"] = time.perf_counter() - start_time
+    return stats
+
+
+# How much of the new index can be taken from the old one
+def compare_indexes(old_index: dict, new_index: dict) -> dict:
+    old_hashes = {chunk[2] for chunk in old_index["chunks"] if chunk[2]}
+    stats = {"chunks": 0, "bytes": 0, "reused_chunks": 0, "reused_bytes": 0, "zero_bytes": 0}
+    for offset, length, sha256 in new_index["chunks"]:
+        if not sha256:
+            stats["zero_bytes"] += length
+            continue
+        stats["chunks"] += 1
+        stats["bytes"] += length
+        if sha256 in old_hashes:
+            stats["reused_chunks"] += 1
+            stats["reused_bytes"] += length
+    return stats
+
+
+def print_reuse(stats: dict) -> None:
+    print_status(f"{stats['reused_chunks']} of {stats['chunks']} chunks reused, "
+                 f"{stats['reused_bytes'] / 1048576:.1f} of {stats['bytes'] / 1048576:.1f} MiB "
+                 f"({stats['reused_bytes'] / max(stats['bytes'], 1) * 100:.1f}%), "
+                 f"{(stats['bytes'] - stats['reused_bytes']) / 1048576:.1f} MiB have to be downloaded")
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Create chunk indexes of images and rebuild images from them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    index_parser = subparsers.add_parser("index", help="Write the chunk index of an image.")
+    index_parser.add_argument("image", help="Raw image file.")
+    index_parser.add_argument("--output", dest="output", default="", help="Index file, default: <image>.chunks.json")
+    index_parser.add_argument("--store", dest="store", default="", help="Also add the chunks to this chunk store.")
+    apply_parser = subparsers.add_parser("apply", help="Rebuild an image from its index, seeds and a chunk store.")
+    apply_parser.add_argument("index", help="Path or url of the index of the new image.")
+    apply_parser.add_argument("output", help="Path of the rebuilt image.")
+    apply_parser.add_argument("--seed", dest="seeds", action="append", default=[],
+                              help="Old image to copy unchanged chunks from, can be used multiple times.")
+    apply_parser.add_argument("--store", dest="store", default="", help="Path or url of the chunk store.")
+    apply_parser.add_argument("--jobs", dest="jobs", type=int, default=8, help="Parallel chunk downloads.")
+    stats_parser = subparsers.add_parser("stats", help="Show how many chunks of a new index are in an old one.")
+    stats_parser.add_argument("old_index", help="Path or url of the old index.")
+    stats_parser.add_argument("new_index", help="Path or url of the new index.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = process_args()
+    if args.command == "index":
+        image_chunks, image_sha256 = chunk_file(args.image)
+        write_index(args.output or f"{args.image}.chunks.json", os.path.getsize(args.image), image_sha256,
+                    image_chunks)
+        print_status(f"Indexed {len(image_chunks)} chunks")
+        if args.store:
+            store_stats = store_chunks(args.image, image_chunks, args.store)
+            print_status(f"Added {store_stats['new_chunks']} chunks ({store_stats['compressed_bytes'] / 1048576:.1f} "
+                         f"MiB compressed) to the store, {store_stats['stored_chunks']} were already stored")
+    elif args.command == "apply":
+        apply_stats = apply_index(read_index(args.index), args.seeds, args.output, args.store, args.jobs)
+        print_status(f"Rebuilt {args.output} in {apply_stats['time']:.1f}s: {apply_stats['seeded_chunks']} chunks "
+                     f"({apply_stats['seeded_bytes'] / 1048576:.1f} MiB) copied from seeds, "
+                     f"{apply_stats['fetched_chunks']} chunks ({apply_stats['fetched_bytes'] / 1048576:.1f} MiB) "
+                     f"fetched, {apply_stats['zero_chunks']} zero chunks")
+    else:
+        print_reuse(compare_indexes(read_index(args.old_index), read_index(args.new_index)))
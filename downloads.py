@@ -0,0 +1,293 @@
+# Download manager of the build: parallel range requests, resumable downloads, sha256 verification while downloading
+# and a content addressed cache of finished downloads.
+
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock, Thread
+from time import sleep
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from functions import *
+from filesystem import cpfile
+from progress import ProgressMonitor
+
+# Downloads are stored by sha256 in download_cache_dir/objects. urls.json remembers which object a url (identified by
+# its ETag/Last-Modified and size) resolved to, so an unchanged file is never downloaded twice.
+download_cache_dir = "/var/cache/eupneaos-build/downloads"
+download_cache_lock = Lock()
+
+
+# Raised when a server ignores the Range header, retrying the range request won't help
+class RangeNotSupported(IOError):
+    pass
+
+
+def set_download_cache_dir(new_dir: str) -> None:
+    global download_cache_dir
+    download_cache_dir = new_dir
+
+
+def __load_url_index() -> dict:
+    try:
+        with open(f"{download_cache_dir}/urls.json", "r") as index:
+            return json.load(index)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def __update_url_index(url: str, entry: dict) -> None:
+    with download_cache_lock:
+        url_index = __load_url_index()
+        url_index[url] = entry
+        with open(f"{download_cache_dir}/urls.json.tmp", "w") as index:
+            json.dump(url_index, index, indent=2)
+        os.replace(f"{download_cache_dir}/urls.json.tmp", f"{download_cache_dir}/urls.json")
+
+
+def __cached_object(sha256: str) -> str:
+    return f"{download_cache_dir}/objects/{sha256}"
+
+
+# Hardlink src to the new file dst. Across filesystems it's copied with copy_file_range, which reflinks on btrfs/xfs.
+# Downloads and cache hits always replace dest with os.replace() and nothing writes to the artifacts in place, so
+# sharing the inode with the cache is safe.
+def __link_or_copy(src: str, dst: str) -> None:
+    rmfile(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        cpfile(src, dst)
+
+
+def __copy_from_cache(sha256: str, dest: str, progress) -> None:
+    __link_or_copy(__cached_object(sha256), dest + ".part")
+    os.replace(dest + ".part", dest)
+    if progress:
+        progress.advance(os.path.getsize(dest))
+
+
+def __add_to_cache(file_path: str, sha256: str) -> None:
+    mkdir(f"{download_cache_dir}/objects", create_parents=True)
+    if not path_exists(__cached_object(sha256)):
+        temp_path = f"{__cached_object(sha256)}.{threading.get_ident()}.tmp"
+        __link_or_copy(file_path, temp_path)
+        os.replace(temp_path, __cached_object(sha256))
+
+
+# Returns size, range support and the validators of a url. If the url can't be probed, the size is unknown and the
+# file is downloaded in one stream, the download itself retries and reports the error.
+def __probe_url(url: str) -> dict:
+    try:
+        with urlopen(Request(url, method="HEAD"), timeout=60) as response:
+            return {"size": int(response.headers.get("Content-Length", 0)),
+                    "ranges": response.headers.get("Accept-Ranges", "") == "bytes",
+                    "etag": response.headers.get("ETag", ""),
+                    "last_modified": response.headers.get("Last-Modified", "")}
+    except (URLError, OSError) as e:  # HTTPError too, some servers don't allow HEAD
+        if not isinstance(e, HTTPError):
+            print_warning(f"Failed to probe {url} ({e}), downloading it in one stream")
+        return {"size": 0, "ranges": False, "etag": "", "last_modified": ""}
+
+
+# Download the byte range [segment[0], segment[2]) of a url into the part file, segment[1] is the current position.
+# Progress is written to the segment list, so an interrupted download can be resumed from the state file.
+# Without range support, a retry starts again at the beginning of the file.
+def __download_segment(url: str, part_path: str, segment: list, state: dict, progress) -> None:
+    for attempt in range(5):
+        try:
+            if not state["ranges"] and segment[1] > 0:
+                if progress:
+                    progress.advance(-segment[1])
+                with state["condition"]:
+                    segment[1] = 0
+            request = Request(url)
+            if segment[1] > 0 or segment[2] != state["size"]:
+                request.add_header("Range", f"bytes={segment[1]}-{segment[2] - 1 if segment[2] else ''}")
+            with urlopen(request, timeout=60) as response:
+                if request.has_header("Range") and response.status != 206:
+                    raise RangeNotSupported(f"{url} doesn't support range requests")
+                part_fd = os.open(part_path, os.O_WRONLY)
+                try:
+                    while data := response.read(1048576):
+                        os.pwrite(part_fd, data, segment[1])
+                        with state["condition"]:
+                            segment[1] += len(data)
+                            state["condition"].notify_all()
+                        if progress:
+                            progress.advance(len(data))
+                        __save_download_state(part_path, state)
+                finally:
+                    os.close(part_fd)
+            if not segment[2]:  # size was unknown, now it is known
+                segment[2] = segment[1]
+            return
+        except (URLError, OSError) as e:
+            if attempt == 4 or isinstance(e, RangeNotSupported):
+                raise
+            print_warning(f"Download of {url} failed ({e}), retrying")
+            sleep(2 ** attempt)
+
+
+def __save_download_state(part_path: str, state: dict, force: bool = False) -> None:
+    with state["condition"]:
+        now = time.perf_counter()
+        if not force and now - state.get("saved", 0) < 1:
+            return
+        state["saved"] = now
+        saved_state = {key: state[key] for key in ["url", "size", "etag", "last_modified", "segments"]}
+        with open(part_path + ".json", "w") as state_file:
+            json.dump(saved_state, state_file)
+
+
+# Hash the part file in order while the segments are downloaded, so that the hash is ready when the download is done
+def __hash_part_file(part_path: str, state: dict, result: dict) -> None:
+    file_hash = hashlib.sha256()
+    hashed = 0
+    with open(part_path, "rb", buffering=0) as part_file:
+        while True:
+            with state["condition"]:
+                # data is available up to the position of the first unfinished segment
+                available = hashed
+                for start, position, end in state["segments"]:
+                    if start > available:
+                        break
+                    available = max(available, position)
+                    if not end or position < end:
+                        break
+                if available == hashed:
+                    if state["finished"]:
+                        break
+                    state["condition"].wait(1)
+                    continue
+            while hashed < available:
+                data = os.pread(part_file.fileno(), min(8388608, available - hashed), hashed)
+                file_hash.update(data)
+                hashed += len(data)
+    result["sha256"] = file_hash.hexdigest()
+
+
+# Download the unfinished segments of state into the part file while hashing it. Returns the sha256 and the errors of
+# the segments.
+def __download_segments(url: str, part_path: str, state: dict, progress) -> tuple:
+    state["finished"] = False
+    hash_result = {}
+    hash_thread = Thread(target=__hash_part_file, args=(part_path, state, hash_result), daemon=True)
+    hash_thread.start()
+    errors = []
+
+    def download_segment(segment: list) -> None:
+        try:
+            __download_segment(url, part_path, segment, state, progress)
+        except Exception as e:
+            errors.append(e)
+
+    segment_threads = [Thread(target=download_segment, args=(segment,), daemon=True)
+                       for segment in state["segments"] if not segment[2] or segment[1] < segment[2]]
+    for thread in segment_threads:
+        thread.start()
+    for thread in segment_threads:
+        thread.join()
+    __save_download_state(part_path, state, force=True)
+    with state["condition"]:
+        state["finished"] = True
+        state["condition"].notify_all()
+    hash_thread.join()
+    return hash_result.get("sha256", ""), errors
+
+
+# Download a url to dest. Files larger than 2 * min_segment_size are split into up to segments parallel range
+# requests. Interrupted downloads are resumed, the sha256 is calculated while downloading and checked against sha256 if
+# it is given. remote is the result of __probe_url() if the url has been probed already. Returns the sha256 of the file.
+def download_file(url: str, dest: str, sha256: str = "", segments: int = 4, min_segment_size: int = 67108864,
+                  progress=None, remote: dict = None) -> str:
+    if sha256 and path_exists(__cached_object(sha256)):
+        print_status(f"Using cached {Path(dest).name}")
+        __copy_from_cache(sha256, dest, progress)
+        return sha256
+
+    remote = remote or __probe_url(url)
+    cached = __load_url_index().get(url, {})
+    validator = remote["etag"] or remote["last_modified"]
+    if (validator and cached.get("validator") == validator and cached.get("size") == remote["size"]
+            and path_exists(__cached_object(cached["sha256"])) and (not sha256 or sha256 == cached["sha256"])):
+        print_status(f"{Path(dest).name} is unchanged, using cached file")
+        __copy_from_cache(cached["sha256"], dest, progress)
+        return cached["sha256"]
+
+    part_path = dest + ".part"
+    state = {"url": url, "size": remote["size"], "etag": remote["etag"], "last_modified": remote["last_modified"],
+             "segments": [], "ranges": remote["ranges"]}
+    try:  # resume if the remote file didn't change since the last attempt
+        with open(part_path + ".json", "r") as state_file:
+            saved_state = json.load(state_file)
+        if (path_exists(part_path) and remote["ranges"] and all(saved_state[key] == state[key] for key in
+                                                                 ["url", "size", "etag", "last_modified"])):
+            state["segments"] = saved_state["segments"]
+            print_status(f"Resuming download of {Path(dest).name}")
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    if not state["segments"]:
+        segment_count = 1
+        if remote["ranges"] and remote["size"]:
+            segment_count = max(1, min(segments, remote["size"] // min_segment_size))
+        segment_size = -(-remote["size"] // segment_count)
+        state["segments"] = [[start, start, min(start + segment_size, remote["size"])]
+                             for start in range(0, max(remote["size"], 1), max(segment_size, 1))]
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(remote["size"])
+    state["condition"] = threading.Condition()
+
+    if progress:
+        progress.advance(sum(position - start for start, position, _ in state["segments"]))
+    file_sha256, errors = __download_segments(url, part_path, state, progress)
+    if errors and all(isinstance(error, RangeNotSupported) for error in errors):
+        # the server announced range support but ignored the Range header, download the file in one stream
+        print_warning(f"{url} doesn't support range requests, downloading it in one stream")
+        if progress:
+            progress.advance(-sum(position - start for start, position, _ in state["segments"]))
+        state["segments"] = [[0, 0, state["size"]]]
+        state["ranges"] = False
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(state["size"])
+        file_sha256, errors = __download_segments(url, part_path, state, progress)
+    if errors:
+        raise errors[0]
+
+    if sha256 and file_sha256 != sha256:
+        rmfile(part_path)
+        rmfile(part_path + ".json")
+        raise ValueError(f"sha256 mismatch for {url}: expected {sha256}, got {file_sha256}")
+    os.replace(part_path, dest)
+    rmfile(part_path + ".json")
+    __add_to_cache(dest, file_sha256)
+    if validator:
+        __update_url_index(url, {"validator": validator, "size": remote["size"], "sha256": file_sha256})
+    return file_sha256
+
+
+# Download several files at the same time. downloads is a list of dicts with url, path and optionally sha256.
+# Returns the sha256 of every downloaded path.
+def download_files(downloads: list, jobs: int = 4) -> dict:
+    mkdir(download_cache_dir, create_parents=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # every url is probed once, for the total size and by download_file()
+        remotes = list(executor.map(lambda download: __probe_url(download["url"]), downloads))
+    progress = ProgressMonitor(f"Downloading {len(downloads)} files", total=sum(remote["size"] for remote in remotes))
+    progress.start()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {download["path"]: executor.submit(download_file, download["url"], download["path"],
+                                                         download.get("sha256", ""), progress=progress, remote=remote)
+                       for download, remote in zip(downloads, remotes)}
+            return {path: future.result() for path, future in futures.items()}
+    finally:
+        progress.stop()
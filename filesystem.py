@@ -0,0 +1,238 @@
+# Copying and removing files and trees of the build without passing their data through python.
+# functions.py is synced from upstream by the update-functions workflow and keeps its simple rmdir, cpdir and cpfile,
+# build.py and the helper modules use the ones here.
+
+import errno
+import fcntl
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from functions import *
+import functions
+
+FICLONE = 0x40049409  # ioctl that shares the extents of one file with another on btrfs, xfs and bcachefs
+
+# errors that mean a copy method isn't supported for this pair of files
+UNSUPPORTED_COPY_ERRORS = [errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS]
+
+
+def __unlink_batch(paths: list) -> int:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    return len(paths)
+
+
+# unlink all files in a directory and remove the directory
+# The tree is walked without recursion and files are deleted in batches on a thread pool while the walk continues.
+# Symlinks are removed, never followed, and mounted filesystems inside the tree are left alone.
+def rmdir(rm_dir: str, keep_dir: bool = True, jobs: int = 8) -> int:
+    try:
+        root_dev = os.lstat(rm_dir).st_dev
+    except FileNotFoundError:
+        print(f"Couldn't remove non existent directory: {rm_dir}, ignoring")
+        return 0
+    start_time = time.perf_counter()
+    removed = 0
+    dirs = []  # in the order they were found, so every dir comes before its subdirs
+    batch = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        pending_dirs = [rm_dir]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.stat(follow_symlinks=False).st_dev != root_dev:
+                            print_warning(f"Not removing mounted filesystem {entry.path}")
+                            continue
+                        pending_dirs.append(entry.path)
+                        dirs.append(entry.path)
+                    else:
+                        batch.append(entry.path)
+                        if len(batch) == 1024:
+                            futures.append(executor.submit(__unlink_batch, batch))
+                            batch = []
+        futures.append(executor.submit(__unlink_batch, batch))
+        removed += sum(future.result() for future in futures)
+    if not keep_dir:
+        dirs.insert(0, rm_dir)
+    for current_dir in reversed(dirs):
+        try:
+            os.rmdir(current_dir)
+            removed += 1
+        except OSError as e:
+            if e.errno != errno.ENOTEMPTY:  # dirs above a mountpoint stay
+                raise
+    if functions.verbose:
+        elapsed = time.perf_counter() - start_time
+        print(f"Removed {removed} entries from {rm_dir} in {elapsed:.1f}s ({removed / max(elapsed, 0.001):.0f}/s)")
+    return removed
+
+
+# Copy a file by sharing its data blocks with the source. Returns False if the filesystem doesn't support it.
+def __reflink(src_fd: int, dst_fd: int) -> bool:
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in UNSUPPORTED_COPY_ERRORS:
+            return False
+        raise
+
+
+# Copy the data of one open file into another without passing it through python. copy_file_range lets the filesystem
+# share or copy the blocks itself, sendfile works between any two files and a fixed 1 MiB buffer is the last resort.
+# Returns the amount of bytes copied.
+def __copy_file_data(src_fd: int, dst_fd: int) -> int:
+    copied = 0
+    for kernel_copy in [lambda: os.copy_file_range(src_fd, dst_fd, 1073741824),
+                        lambda: os.sendfile(dst_fd, src_fd, None, 1073741824)]:
+        try:
+            while length := kernel_copy():
+                copied += length
+            return copied
+        except OSError as e:
+            if copied or e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+    buffer = bytearray(1048576)
+    while length := os.readv(src_fd, [buffer]):
+        data = memoryview(buffer)[:length]
+        while data:
+            data = data[os.write(dst_fd, data):]
+        copied += length
+    return copied
+
+
+def __copy_xattrs(src: str, dst: str) -> None:
+    try:
+        for name in os.listxattr(src, follow_symlinks=False):
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+    except OSError as e:
+        if e.errno not in [errno.ENOTSUP, errno.EOPNOTSUPP]:  # filesystem without xattrs
+            raise
+
+
+def __sha256_of(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb", buffering=0) as file:
+        while chunk := file.read(1048576):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Copy one file of a tree, returns the amount of bytes copied or -1 if dst was already up to date
+def __sync_file(src_entry: os.DirEntry, dst: str, hardlink: bool, verify_hash: bool) -> int:
+    src_stat = src_entry.stat(follow_symlinks=False)
+    try:
+        dst_stat = os.lstat(dst)
+        if (dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+                and os.path.isfile(dst) and not os.path.islink(dst)
+                and (not verify_hash or __sha256_of(src_entry.path) == __sha256_of(dst))):
+            return -1
+        os.unlink(dst)  # never write through an existing link into another file
+    except FileNotFoundError:
+        pass
+    if hardlink:
+        try:
+            os.link(src_entry.path, dst)
+            return 0
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+    with open(src_entry.path, "rb", buffering=0) as src_file, open(dst, "wb", buffering=0) as dst_file:
+        if not __reflink(src_file.fileno(), dst_file.fileno()):
+            __copy_file_data(src_file.fileno(), dst_file.fileno())
+    __copy_metadata(src_stat, dst)
+    return src_stat.st_size
+
+
+def __copy_metadata(src_stat: os.stat_result, dst: str) -> None:
+    try:
+        os.chown(dst, src_stat.st_uid, src_stat.st_gid, follow_symlinks=False)
+    except PermissionError:  # only root can give files away
+        pass
+    os.chmod(dst, src_stat.st_mode & 0o7777)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+
+# Copy the content of a dir into another dir, like "cp -a src/. dst". Files that exist in dst with the same size and
+# mtime are skipped, with verify_hash only if their content is the same too. Files are reflinked if the filesystem
+# supports it, with hardlink they are hardlinked if src and dst are on the same filesystem. Symlinks are copied as
+# symlinks, never followed. Returns the number of copied files and bytes.
+def cpdir(src_as_str: str, dst_as_string: str, hardlink: bool = False, verify_hash: bool = False,
+          jobs: int = 8) -> dict:  # dst_dir must be a full path, including the new dir name
+    src_as_path = Path(src_as_str)
+    if not src_as_path.is_dir():
+        raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
+    if functions.verbose:
+        print(f"Copying {src_as_path.absolute().as_posix()} to {Path(dst_as_string).absolute().as_posix()}")
+    start_time = time.perf_counter()
+    stats = {"files": 0, "bytes": 0, "skipped": 0}
+    created_dirs = []  # dir metadata is set last, adding files changes the mtime
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        pending_dirs = [(src_as_path.absolute().as_posix(), dst_as_string)]
+        while pending_dirs:
+            src_dir, dst_dir = pending_dirs.pop()
+            mkdir(dst_dir, create_parents=True)
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    dst = os.path.join(dst_dir, entry.name)
+                    if entry.is_symlink():
+                        target = os.readlink(entry.path)
+                        if os.path.islink(dst) and os.readlink(dst) == target:
+                            continue
+                        if os.path.lexists(dst):
+                            os.unlink(dst)
+                        os.symlink(target, dst)
+                    elif entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append((entry.path, dst))
+                        created_dirs.append((entry.stat(follow_symlinks=False), dst))
+                    elif entry.is_file(follow_symlinks=False):
+                        futures.append(executor.submit(__sync_file, entry, dst, hardlink, verify_hash))
+        for future in futures:
+            copied_bytes = future.result()
+            if copied_bytes < 0:
+                stats["skipped"] += 1
+            else:
+                stats["files"] += 1
+                stats["bytes"] += copied_bytes
+    for dir_stat, dst_dir in reversed(created_dirs):
+        __copy_metadata(dir_stat, dst_dir)
+    stats["time"] = time.perf_counter() - start_time
+    if functions.verbose:
+        print(f"Copied {stats['files']} files ({stats['bytes'] / 1048576:.1f} MiB), skipped {stats['skipped']} "
+              f"unchanged in {stats['time']:.1f}s ({stats['files'] / max(stats['time'], 0.001):.0f} files/s, "
+              f"{stats['bytes'] / 1048576 / max(stats['time'], 0.001):.1f} MiB/s)")
+    return stats
+
+
+# Copy a single file. With preserve, mode, ownership and xattrs (SELinux labels too) are copied from src, mode sets
+# the permissions of dst.
+def cpfile(src_as_str: str, dst_as_str: str, preserve: bool = False,
+           mode: int = None) -> None:  # "/etc/resolv.conf", "/var/some_config/resolv.conf"
+    src_as_path = Path(src_as_str)
+    dst_as_path = Path(dst_as_str)
+    if functions.verbose:
+        print(f"Copying {src_as_path.absolute().as_posix()} to {dst_as_path.absolute().as_posix()}")
+    if not src_as_path.exists():
+        raise FileNotFoundError(f"No such file: {src_as_path.absolute().as_posix()}")
+    with open(src_as_path, "rb", buffering=0) as src_file, open(dst_as_path, "wb", buffering=0) as dst_file:
+        __copy_file_data(src_file.fileno(), dst_file.fileno())
+    if preserve:
+        src_stat = src_as_path.stat()
+        try:
+            os.chown(dst_as_path, src_stat.st_uid, src_stat.st_gid)
+        except PermissionError:  # only root can give files away
+            pass
+        os.chmod(dst_as_path, src_stat.st_mode & 0o7777)
+        __copy_xattrs(src_as_str, dst_as_str)
+    if mode is not None:
+        os.chmod(dst_as_path, mode)
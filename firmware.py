@@ -0,0 +1,226 @@
+# Selects the firmware the built kernel can actually load from the ChromiumOS linux-firmware clone.
+# Every module lists the firmware files it requests in its .modinfo section ("firmware=<path>"), builtin drivers list
+# theirs in modules.builtin.modinfo. Firmware that is loaded without being declared (e.g. audio dsp topologies) has to
+# be added to configs/firmware-allowlist.conf.
+
+import fnmatch
+import hashlib
+import lzma
+import os
+import struct
+import subprocess
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import *
+from filesystem import cpfile
+
+
+# Return the NUL separated key=value strings of the .modinfo section of a kernel module
+def read_modinfo(module: bytes) -> list:
+    if module[:4] != b"\x7fELF":
+        return []
+    is_64bit = module[4] == 2
+    endian = "<" if module[5] == 1 else ">"
+    if is_64bit:
+        section_offset, = struct.unpack_from(endian + "Q", module, 0x28)
+        entry_size, entry_count, names_index = struct.unpack_from(endian + "HHH", module, 0x3A)
+    else:
+        section_offset, = struct.unpack_from(endian + "I", module, 0x20)
+        entry_size, entry_count, names_index = struct.unpack_from(endian + "HHH", module, 0x2E)
+
+    def read_section(index: int) -> tuple:  # name offset, data offset, data size
+        header = section_offset + index * entry_size
+        if is_64bit:
+            name, = struct.unpack_from(endian + "I", module, header)
+            offset, size = struct.unpack_from(endian + "QQ", module, header + 0x18)
+        else:
+            name, = struct.unpack_from(endian + "I", module, header)
+            offset, size = struct.unpack_from(endian + "II", module, header + 0x10)
+        return name, offset, size
+
+    _, names_offset, _ = read_section(names_index)
+    for index in range(entry_count):
+        name, offset, size = read_section(index)
+        if module[names_offset + name:names_offset + name + 9] == b".modinfo\0":
+            return [entry.decode(errors="replace") for entry in module[offset:offset + size].split(b"\0") if entry]
+    return []
+
+
+# Collect the firmware files requested by the modules and the builtin drivers of a modules tarball
+def get_kernel_firmware(modules_archive: str) -> set:
+    firmware = set()
+    # xz decodes the archive on all cores, tarfile only has to parse the stream
+    decoder = subprocess.Popen(["xz", "-T0", "-dc", modules_archive], stdout=subprocess.PIPE)
+    with tarfile.open(fileobj=decoder.stdout, mode="r|") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            if member.name.endswith("modules.builtin.modinfo"):
+                entries = archive.extractfile(member).read().decode(errors="replace").split("\0")
+                firmware.update(entry.split(".firmware=", 1)[1] for entry in entries if ".firmware=" in entry)
+            elif member.name.endswith((".ko", ".ko.xz")):
+                module = archive.extractfile(member).read()
+                if member.name.endswith(".xz"):
+                    module = lzma.decompress(module)
+                firmware.update(entry[9:] for entry in read_modinfo(module) if entry.startswith("firmware="))
+    if decoder.wait() != 0:
+        raise subprocess.CalledProcessError(decoder.returncode, ["xz", "-dc", modules_archive])
+    return firmware
+
+
+# One glob per line, relative to the firmware dir. Lines starting with # are comments.
+def read_allowlist(allowlist_path: str) -> list:
+    if not path_exists(allowlist_path):
+        return []
+    with open(allowlist_path, "r") as allowlist:
+        return [line.strip() for line in allowlist if line.strip() and not line.startswith("#")]
+
+
+# Return the files of firmware_dir that match the requested names or patterns. Symlinks are returned together with
+# the files they point to.
+def resolve_firmware(firmware_dir: str, requested: set, patterns: list) -> list:
+    available = []
+    for root, dirs, files in os.walk(firmware_dir):
+        dirs[:] = [name for name in dirs if name != ".git"]
+        available.extend(os.path.relpath(os.path.join(root, name), firmware_dir) for name in files)
+    available_set = set(available)
+    wildcards = patterns + [name for name in requested if any(char in name for char in "*?[")]
+    selected = set()
+    for name in available:
+        # the kernel also loads compressed versions of the requested name
+        base_name = name.removesuffix(".xz").removesuffix(".zst")
+        if base_name in requested or any(fnmatch.fnmatch(base_name, pattern) for pattern in wildcards):
+            selected.add(name)
+    for name in list(selected):
+        path = os.path.join(firmware_dir, name)
+        visited = {path}
+        while os.path.islink(path):
+            path = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+            if path in visited:
+                break  # symlink loop
+            visited.add(path)
+            target = os.path.relpath(path, firmware_dir)
+            if target in available_set:
+                selected.add(target)
+    return sorted(selected)
+
+
+def __file_hash(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    if file_path.endswith(".xz"):
+        with lzma.open(file_path, "rb") as file:
+            while chunk := file.read(1048576):
+                file_hash.update(chunk)
+    else:
+        with open(file_path, "rb", buffering=0) as file:
+            while chunk := file.read(1048576):
+                file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Create the symlink name of src_dir in dst_dir, pointing to the same target or to its .xz version.
+# Returns False without creating anything if the target isn't in dst_dir (yet) and dangling isn't set.
+def __install_link(src_dir: str, dst_dir: str, name: str, dangling: bool) -> bool:
+    target = os.readlink(os.path.join(src_dir, name))
+    dst_path = os.path.join(dst_dir, name)
+    target_path = os.path.join(os.path.dirname(dst_path), target)
+    link_path = dst_path
+    if not os.path.lexists(target_path):
+        if os.path.lexists(target_path + ".xz"):
+            link_path += ".xz"
+            target += ".xz"
+        elif not dangling:
+            return False
+    mkdir(os.path.dirname(dst_path), create_parents=True)
+    for path in {dst_path, link_path}:  # the kernel prefers an old uncompressed file over the .xz link
+        if os.path.lexists(path):
+            os.unlink(path)
+    os.symlink(target, link_path)
+    return True
+
+
+# Copy the firmware the kernel in modules_archive can use from src_dir to dst_dir.
+# Files that dnf already installed with the same content (compressed or not) are not copied again and identical files
+# within the selection are hardlinked. Every installed file is counted on progress (a progress.ProgressMonitor) if it's
+# passed. Returns the sizes and counts for the report.
+def install_firmware(src_dir: str, dst_dir: str, modules_archive: str, allowlist_path: str, jobs: int = 8,
+                     progress=None) -> dict:
+    start_time = time.perf_counter()
+    requested = get_kernel_firmware(modules_archive)
+    selected = resolve_firmware(src_dir, requested, read_allowlist(allowlist_path))
+    if progress:
+        progress.total = len(selected)
+    stats = {"requested": len(requested), "selected": len(selected), "copied": 0, "hardlinked": 0, "installed": 0,
+             "copied_bytes": 0, "saved_bytes": 0, "total_bytes": 0}
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = [name for name in dirs if name != ".git"]
+        stats["total_bytes"] += sum(os.lstat(os.path.join(root, name)).st_size for name in files)
+
+    regular_files = [name for name in selected if not os.path.islink(os.path.join(src_dir, name))]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        src_hashes = dict(zip(regular_files, executor.map(lambda name: __file_hash(os.path.join(src_dir, name)),
+                                                           regular_files)))
+
+    def installed_hash(name: str) -> str:
+        for candidate in [name, name + ".xz"]:
+            candidate_path = os.path.join(dst_dir, candidate)
+            if os.path.isfile(candidate_path) and not os.path.islink(candidate_path):
+                return __file_hash(candidate_path)
+        return ""
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        dst_hashes = dict(zip(regular_files, executor.map(installed_hash, regular_files)))
+
+    first_copies = {}  # content hash -> path of the first copy in dst_dir
+    for name in regular_files:
+        if progress:
+            progress.advance()
+        src_path = os.path.join(src_dir, name)
+        dst_path = os.path.join(dst_dir, name)
+        mkdir(os.path.dirname(dst_path), create_parents=True)
+        file_size = os.path.getsize(src_path)
+        if dst_hashes[name] == src_hashes[name]:
+            stats["installed"] += 1  # the kernel finds the same firmware in the fedora package
+            stats["saved_bytes"] += file_size
+            continue
+        if os.path.lexists(dst_path):
+            os.unlink(dst_path)
+        if src_hashes[name] in first_copies:
+            os.link(first_copies[src_hashes[name]], dst_path)
+            stats["hardlinked"] += 1
+            stats["saved_bytes"] += file_size
+            continue
+        cpfile(src_path, dst_path, preserve=True)
+        first_copies[src_hashes[name]] = dst_path
+        stats["copied"] += 1
+        stats["copied_bytes"] += file_size
+
+    # Symlinks are created once their targets are in place. A target that is only installed as <target>.xz by dnf gets
+    # a <link>.xz pointing to it, the kernel would read the compressed data as firmware through a plain link.
+    links = [name for name in selected if os.path.islink(os.path.join(src_dir, name))]
+    while links:
+        pending = []
+        for name in links:
+            if not __install_link(src_dir, dst_dir, name, dangling=False):
+                pending.append(name)
+            elif progress:
+                progress.advance()
+        if len(pending) == len(links):  # the targets aren't installed at all, copy the links as they are
+            for name in pending:
+                __install_link(src_dir, dst_dir, name, dangling=True)
+            if progress:
+                progress.advance(len(pending))
+            break
+        links = pending
+    stats["time"] = time.perf_counter() - start_time
+    return stats
+
+
+def print_firmware_report(stats: dict) -> None:
+    print_status(f"Kernel requests {stats['requested']} firmware files, {stats['selected']} files selected")
+    print_status(f"Copied {stats['copied']} files ({stats['copied_bytes'] / 1048576:.1f} MiB) of "
+                 f"{stats['total_bytes'] / 1048576:.1f} MiB in {stats['time']:.1f}s, "
+                 f"{stats['hardlinked']} hardlinked and {stats['installed']} already installed by dnf "
+                 f"({stats['saved_bytes'] / 1048576:.1f} MiB deduplicated)")
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Writes and reads GUID partition tables of image files, without parted, cgpt or a loop device.
+# A layout is a list of partition dicts:
+#   name: partition name
+#   type: partition type guid
+#   start, end: byte offsets, end is exclusive. An end of 0 extends the partition to the last usable sector.
+#   attributes: 64 bit attribute field, see chromeos_kernel_attributes()
+#   guid: unique partition guid, a random one is used if it's missing
+# The tables are 512 byte sectors with 128 entries, the same as parted creates.
+
+import argparse
+import os
+import struct
+import uuid
+import zlib
+
+from functions import *
+
+SECTOR_SIZE = 512
+ENTRY_COUNT = 128
+ENTRY_SIZE = 128
+ENTRIES_SECTORS = ENTRY_COUNT * ENTRY_SIZE // SECTOR_SIZE  # 32
+HEADER_SIZE = 92
+HEADER_FORMAT = "<8sIIIIQQQQ16sQIII"
+ENTRY_FORMAT = "<16s16sQQQ72s"
+
+CHROMEOS_KERNEL = "FE3A2A5D-4F32-41A7-B725-ACCC3285A309"
+LINUX_DATA = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"  # what parted uses when no filesystem type is given
+EFI_SYSTEM = "C12A7328-F81F-11D2-BA4B-00A0C93EC93B"
+
+
+# Depthcharge boots the kernel partition with the highest priority that has tries left or booted successfully before
+def chromeos_kernel_attributes(priority: int, tries: int, successful: bool) -> int:
+    return (priority & 0xF) << 48 | (tries & 0xF) << 52 | int(successful) << 56
+
+
+def parse_chromeos_attributes(attributes: int) -> dict:
+    return {"priority": attributes >> 48 & 0xF, "tries": attributes >> 52 & 0xF,
+            "successful": bool(attributes >> 56 & 1)}
+
+
+def __sector_count(image_path: str) -> int:
+    return os.path.getsize(image_path) // SECTOR_SIZE
+
+
+def __protective_mbr(sector_count: int) -> bytes:
+    mbr = bytearray(SECTOR_SIZE)
+    # one partition of type 0xee that covers the whole disk, CHS values are the ones every tool writes
+    mbr[446:462] = struct.pack("<B3sB3sII", 0, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff", 1,
+                               min(sector_count - 1, 0xFFFFFFFF))
+    mbr[510:512] = b"\x55\xaa"
+    return bytes(mbr)
+
+
+def __pack_entries(layout: list, last_usable: int) -> bytes:
+    entries = b""
+    for partition in layout:
+        first_lba = partition["start"] // SECTOR_SIZE
+        last_lba = partition["end"] // SECTOR_SIZE - 1 if partition["end"] else last_usable
+        entries += struct.pack(ENTRY_FORMAT, uuid.UUID(partition["type"]).bytes_le,
+                               uuid.UUID(partition.get("guid") or str(uuid.uuid4())).bytes_le, first_lba, last_lba,
+                               partition.get("attributes", 0), partition["name"].encode("utf-16-le"))
+    return entries.ljust(ENTRY_COUNT * ENTRY_SIZE, b"\0")
+
+
+def __pack_header(current_lba: int, backup_lba: int, last_usable: int, disk_guid: str, entries_lba: int,
+                  entries: bytes) -> bytes:
+    fields = [b"EFI PART", 0x10000, HEADER_SIZE, 0, 0, current_lba, backup_lba, 2 + ENTRIES_SECTORS, last_usable,
+              uuid.UUID(disk_guid).bytes_le, entries_lba, ENTRY_COUNT, ENTRY_SIZE, zlib.crc32(entries)]
+    fields[3] = zlib.crc32(struct.pack(HEADER_FORMAT, *fields))
+    return struct.pack(HEADER_FORMAT, *fields).ljust(SECTOR_SIZE, b"\0")
+
+
+def __check_layout(layout: list, last_usable: int) -> None:
+    previous_end = (2 + ENTRIES_SECTORS) * SECTOR_SIZE
+    for partition in layout:
+        if partition["start"] % SECTOR_SIZE or partition["end"] % SECTOR_SIZE:
+            raise ValueError(f"Partition {partition['name']} isn't aligned to {SECTOR_SIZE} byte sectors")
+        if partition["start"] < previous_end:
+            raise ValueError(f"Partition {partition['name']} overlaps the partition table or the partition before it")
+        end = partition["end"] or (last_usable + 1) * SECTOR_SIZE
+        if end <= partition["start"] or end > (last_usable + 1) * SECTOR_SIZE:
+            raise ValueError(f"Partition {partition['name']} doesn't fit into the image")
+        previous_end = end
+    if len(layout) > ENTRY_COUNT:
+        raise ValueError(f"A gpt can only hold {ENTRY_COUNT} partitions")
+
+
+# Write the protective mbr, the primary gpt at the start and the backup gpt at the end of the image file
+def write_gpt(image_path: str, layout: list, disk_guid: str = "") -> None:
+    sector_count = __sector_count(image_path)
+    last_lba = sector_count - 1
+    last_usable = last_lba - ENTRIES_SECTORS - 1
+    __check_layout(layout, last_usable)
+    disk_guid = disk_guid or str(uuid.uuid4())
+    entries = __pack_entries(layout, last_usable)
+    primary = (__protective_mbr(sector_count)
+               + __pack_header(1, last_lba, last_usable, disk_guid, 2, entries) + entries)
+    backup = entries + __pack_header(last_lba, 1, last_usable, disk_guid, last_lba - ENTRIES_SECTORS, entries)
+    image_fd = os.open(image_path, os.O_WRONLY)
+    try:
+        os.pwrite(image_fd, primary, 0)
+        os.pwrite(image_fd, backup, (last_lba - ENTRIES_SECTORS) * SECTOR_SIZE)
+        os.fsync(image_fd)
+    finally:
+        os.close(image_fd)
+
+
+def __read_header(image_file, lba: int) -> tuple:
+    image_file.seek(lba * SECTOR_SIZE)
+    header = image_file.read(HEADER_SIZE)
+    fields = list(struct.unpack(HEADER_FORMAT, header))
+    if fields[0] != b"EFI PART":
+        raise ValueError(f"No gpt header at sector {lba}")
+    header_crc = fields[3]
+    fields[3] = 0
+    if zlib.crc32(struct.pack(HEADER_FORMAT, *fields)) != header_crc:
+        raise ValueError(f"Gpt header at sector {lba} is corrupted")
+    image_file.seek(fields[10] * SECTOR_SIZE)
+    entries = image_file.read(fields[11] * fields[12])
+    if zlib.crc32(entries) != fields[13]:
+        raise ValueError(f"Partition entries of the gpt header at sector {lba} are corrupted")
+    return fields, entries
+
+
+# Read both tables, check their crcs and that they are the same. Returns the disk guid and the layout.
+def read_gpt(image_path: str) -> dict:
+    with open(image_path, "rb") as image_file:
+        primary, primary_entries = __read_header(image_file, 1)
+        backup, backup_entries = __read_header(image_file, primary[6])
+    if primary_entries != backup_entries or primary[9] != backup[9] or backup[6] != 1:
+        raise ValueError("Primary and backup gpt don't match")
+    layout = []
+    for index in range(primary[11]):
+        entry = struct.unpack(ENTRY_FORMAT, primary_entries[index * ENTRY_SIZE:(index + 1) * ENTRY_SIZE])
+        if entry[0] == bytes(16):  # unused entry
+            continue
+        layout.append({"number": index + 1, "name": entry[5].decode("utf-16-le").rstrip("\0"),
+                       "type": str(uuid.UUID(bytes_le=entry[0])).upper(), "guid": str(uuid.UUID(bytes_le=entry[1])),
+                       "start": entry[2] * SECTOR_SIZE, "end": (entry[3] + 1) * SECTOR_SIZE, "attributes": entry[4]})
+    return {"disk_guid": str(uuid.UUID(bytes_le=primary[9])), "last_usable": primary[8], "partitions": layout}
+
+
+# Compare the table of an image with the layout it was written with
+def verify_gpt(image_path: str, layout: list) -> dict:
+    table = read_gpt(image_path)
+    if len(table["partitions"]) != len(layout):
+        raise ValueError(f"Expected {len(layout)} partitions, found {len(table['partitions'])}")
+    for partition, written in zip(layout, table["partitions"]):
+        expected = {"name": partition["name"], "type": partition["type"].upper(), "start": partition["start"],
+                    "end": partition["end"] or (table["last_usable"] + 1) * SECTOR_SIZE,
+                    "attributes": partition.get("attributes", 0)}
+        if partition.get("guid"):
+            expected["guid"] = str(uuid.UUID(partition["guid"]))
+        for key, value in expected.items():
+            if written[key] != value:
+                raise ValueError(f"Partition {written['number']}: {key} is {written[key]}, expected {value}")
+    return table
+
+
+# Size of an image whose last partition ends at last_partition_end: the backup gpt comes right after it
+def get_image_size(last_partition_end: int) -> int:
+    return last_partition_end + (ENTRIES_SECTORS + 1) * SECTOR_SIZE
+
+
+# Move the end of the last partition and the backup gpt behind it, then cut the image right after the backup gpt.
+# The guids stay the same, so the PARTUUIDs in the kernel cmdline and fstab are still valid.
+def resize_last_partition(image_path: str, new_end: int) -> None:
+    table = read_gpt(image_path)
+    layout = table["partitions"]
+    if new_end % SECTOR_SIZE or new_end <= layout[-1]["start"]:
+        raise ValueError(f"Invalid end for partition {layout[-1]['number']}: {new_end}")
+    # write_gpt() packs the entries, so unused entries between partitions would change the partition numbers
+    if layout[-1]["number"] != len(layout):
+        raise ValueError("Only tables without unused entries between partitions can be resized")
+    layout[-1]["end"] = new_end
+    os.truncate(image_path, get_image_size(new_end))
+    write_gpt(image_path, layout, table["disk_guid"])
+    verify_gpt(image_path, layout)
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Print the gpt of an image file.")
+    parser.add_argument("image", help="Image file to read.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = process_args()
+    table = read_gpt(args.image)
+    print(f"Disk guid: {table['disk_guid']}")
+    for partition in table["partitions"]:
+        line = (f"{partition['number']:>3} {partition['start']:>14} {partition['end'] - 1:>14} "
+                f"{(partition['end'] - partition['start']) / 1048576:>10.1f}MiB {partition['name']:<10}"
+                f"{partition['type']} {partition['guid']}")
+        if partition["type"] == CHROMEOS_KERNEL:
+            line += " " + str(parse_chromeos_attributes(partition["attributes"]))
+        print(line)
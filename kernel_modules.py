@@ -0,0 +1,70 @@
+# Prepares the extracted kernel modules for the image: compresses them, optionally strips their debug sections and
+# generates the modules.dep files ahead of time, so that the first boot doesn't have to run depmod.
+
+import lzma
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import *
+
+# The same settings the kernel uses for CONFIG_MODULE_COMPRESS_XZ. The in-kernel xz decoder only supports crc32
+# checks and a small dictionary keeps the memory kmod needs to load a module low.
+XZ_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": 1048576}]
+# Appended by scripts/sign-file. Stripping a signed module would invalidate the signature.
+SIGNATURE_MAGIC = b"~Module signature appended~\n"
+
+
+def __process_module(module_path: str, strip: bool) -> tuple:
+    # returns the size before and after and whether the module was stripped
+    old_size = os.path.getsize(module_path)
+    stripped = False
+    if strip:
+        with open(module_path, "rb") as module:
+            module.seek(max(old_size - len(SIGNATURE_MAGIC), 0))
+            signed = module.read() == SIGNATURE_MAGIC
+        if not signed:
+            subprocess.run(["strip", "--strip-debug", module_path], check=True)
+            stripped = True
+    with open(module_path, "rb") as module:
+        # lzma releases the gil while compressing, so the thread pool uses all cores
+        compressed = lzma.compress(module.read(), format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=XZ_FILTERS)
+    with open(f"{module_path}.xz", "wb") as module:
+        module.write(compressed)
+    shutil.copystat(module_path, f"{module_path}.xz")
+    os.unlink(module_path)
+    return old_size, len(compressed), stripped
+
+
+# Compress (and strip) every module of kernel_version below root and run depmod against root.
+# Returns the sizes and counts for the report.
+def process_modules(root: str, kernel_version: str, strip: bool = False, jobs: int = 0) -> dict:
+    start_time = time.perf_counter()
+    modules_dir = f"{root}/lib/modules/{kernel_version}"
+    module_paths = []
+    for dir_path, dirs, files in os.walk(modules_dir):
+        dirs[:] = [name for name in dirs if not os.path.islink(os.path.join(dir_path, name))]  # skip build -> headers
+        module_paths.extend(os.path.join(dir_path, name) for name in files if name.endswith(".ko"))
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        results = list(executor.map(lambda module_path: __process_module(module_path, strip), module_paths))
+    stats = {"modules": len(module_paths), "stripped": sum(result[2] for result in results),
+             "old_bytes": sum(result[0] for result in results), "new_bytes": sum(result[1] for result in results),
+             "compress_time": time.perf_counter() - start_time}
+    if strip and stats["stripped"] < stats["modules"]:
+        print_warning(f"{stats['modules'] - stats['stripped']} signed modules were not stripped")
+
+    # depmod reads the modules from the image, so the host kernel version doesn't matter
+    bash(f"depmod -b {root} {kernel_version}")
+    stats["time"] = time.perf_counter() - start_time
+    return stats
+
+
+def print_modules_report(stats: dict) -> None:
+    saved = stats["old_bytes"] - stats["new_bytes"]
+    print_status(f"Compressed {stats['modules']} modules ({stats['stripped']} stripped) from "
+                 f"{stats['old_bytes'] / 1048576:.1f} MiB to {stats['new_bytes'] / 1048576:.1f} MiB, saved "
+                 f"{saved / 1048576:.1f} MiB in {stats['compress_time']:.1f}s "
+                 f"({stats['time']:.1f}s including depmod)")
@@ -0,0 +1,128 @@
+# Build profiler: stage timings, command timings and system load samples, written as a cost report at the end.
+# runner.py adds every command it runs to the profile.
+
+import json
+import resource
+import time
+from contextlib import contextmanager
+from threading import Event, Thread
+
+from functions import *
+
+# stages, build steps, commands and load samples collected for the profile report
+profile = {"stages": [], "steps": {}, "commands": [], "samples": []}
+current_stage = ""
+
+
+# rchar/wchar: bytes passed to read()/write(), read_bytes/write_bytes: bytes fetched from/sent to storage
+def read_process_io(pid: str = "self") -> dict:
+    try:
+        with open(f"/proc/{pid}/io", "r") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+    except (FileNotFoundError, PermissionError):
+        return {}
+    return {key: int(counters[key]) for key in ["rchar", "wchar", "read_bytes", "write_bytes"]}
+
+
+# Measure a stage of the build: wall time, cpu time and io of this process and every child reaped during the stage
+# and the peak memory of the commands that ran in it. Children that are still running at the end are not included.
+@contextmanager
+def profile_stage(stage_name: str):
+    global current_stage
+    previous_stage = current_stage
+    current_stage = stage_name
+    first_command = len(profile["commands"])
+    start_time = time.perf_counter()
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_io = read_process_io()
+    try:
+        yield
+    finally:
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_io = read_process_io()
+        commands = profile["commands"][first_command:]
+        user_time = end_self.ru_utime - start_self.ru_utime + end_children.ru_utime - start_children.ru_utime
+        system_time = end_self.ru_stime - start_self.ru_stime + end_children.ru_stime - start_children.ru_stime
+        record = {"stage": stage_name, "wall_time": time.perf_counter() - start_time, "user_time": user_time,
+                  "system_time": system_time,
+                  "max_rss": max([end_self.ru_maxrss] + [command["max_rss"] for command in commands]),
+                  "commands": len(commands)}
+        for key in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+            record[key] = end_io.get(key, 0) - start_io.get(key, 0)
+        profile["stages"].append(record)
+        current_stage = previous_stage
+
+
+load_sampler_stop = None
+
+
+# Sample load average, cpu usage, iowait and memory every interval seconds until stop_load_sampler() is called
+def start_load_sampler(interval: float = 1) -> None:
+    global load_sampler_stop
+    load_sampler_stop = Event()
+    Thread(target=__sample_load, args=(interval, load_sampler_stop), daemon=True).start()
+
+
+def stop_load_sampler() -> None:
+    if load_sampler_stop is not None:
+        load_sampler_stop.set()
+
+
+def __read_cpu_times() -> list:
+    with open("/proc/stat", "r") as stat:
+        return [int(value) for value in stat.readline().split()[1:]]
+
+
+def __sample_load(interval: float, stop_event) -> None:
+    previous_cpu = __read_cpu_times()
+    while not stop_event.wait(interval):
+        cpu = __read_cpu_times()
+        delta = [now - before for now, before in zip(cpu, previous_cpu)]
+        previous_cpu = cpu
+        total = sum(delta) or 1
+        with open("/proc/meminfo", "r") as meminfo:
+            memory = {line.split(":")[0]: int(line.split()[1]) for line in meminfo}
+        with open("/proc/loadavg", "r") as loadavg:
+            load = float(loadavg.read().split()[0])
+        # /proc/stat: user nice system idle iowait irq softirq ...
+        profile["samples"].append({"time": time.time(), "stage": current_stage, "load": load,
+                                   "cpu_busy": 1 - (delta[3] + delta[4]) / total, "iowait": delta[4] / total,
+                                   "memory_used": (memory["MemTotal"] - memory["MemAvailable"]) * 1024})
+
+
+# Write the profile as json and print the stages and the most expensive commands sorted by wall time.
+# If a baseline report from an earlier run is given, the difference per stage is printed too.
+def write_profile_report(report_path: str, baseline_path: str = "") -> None:
+    for stage in profile["stages"]:
+        samples = [sample for sample in profile["samples"] if sample["stage"] == stage["stage"]]
+        if samples:
+            stage["avg_load"] = sum(sample["load"] for sample in samples) / len(samples)
+            stage["avg_cpu_busy"] = sum(sample["cpu_busy"] for sample in samples) / len(samples)
+            stage["avg_iowait"] = sum(sample["iowait"] for sample in samples) / len(samples)
+    with open(report_path, "w") as report:
+        json.dump(profile, report, indent=2)
+
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path, "r") as baseline_file:
+            baseline = {stage["stage"]: stage for stage in json.load(baseline_file)["stages"]}
+
+    print_header("Build profile")
+    print(f"{'stage':<24}{'wall':>10}{'cpu':>10}{'read':>11}{'written':>11}{'peak rss':>11}"
+          + (f"{'vs baseline':>13}" if baseline else ""))
+    for stage in sorted(profile["stages"], key=lambda s: s["wall_time"], reverse=True):
+        line = (f"{stage['stage']:<24}{stage['wall_time']:>9.1f}s{stage['user_time'] + stage['system_time']:>9.1f}s"
+                f"{stage['rchar'] / 1048576:>8.0f}MiB{stage['wchar'] / 1048576:>8.0f}MiB"
+                f"{stage['max_rss'] / 1024:>8.0f}MiB")
+        if stage["stage"] in baseline:
+            difference = stage["wall_time"] - baseline[stage["stage"]]["wall_time"]
+            line += f"{difference:>+12.1f}s"
+        print(line)
+    print_header("Most expensive commands")
+    for command in sorted(profile["commands"], key=lambda c: c["wall_time"], reverse=True)[:15]:
+        command_str = command["command"] if isinstance(command["command"], str) else " ".join(command["command"])
+        print(f"{command['wall_time']:>9.1f}s {command['user_time'] + command['system_time']:>9.1f}s cpu  "
+              f"[{command['stage']}] {command_str[:80]}")
+    print_status(f"Profile written to {report_path}")
@@ -0,0 +1,69 @@
+# Progress output of the build. The polling start/stop_progress and download progress helpers of functions.py are
+# upstream code for the postinstall scripts, nothing in this repo calls them.
+
+import sys
+import time
+from threading import Event, Lock, Thread
+
+
+# Prints the progress of a running operation every interval seconds: the amount done, the rate and, if the total is
+# known, the ETA. The amount is either counted with advance() or read with poll(). The printer thread sleeps on an
+# event, so it doesn't use any cpu between updates and stop() returns immediately.
+class ProgressMonitor:
+    def __init__(self, label: str, total: int = 0, unit: str = "B", interval: float = 1, poll=None):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.poll = poll
+        self.done = 0
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.interactive = sys.stdout.isatty()
+        self.interval = interval if self.interactive else max(interval, 10)  # don't flood ci logs
+        self.start_time = 0
+        self.thread = None
+
+    def advance(self, amount: int = 1) -> None:
+        with self.lock:
+            self.done += amount
+
+    def start(self) -> None:
+        self.start_time = time.perf_counter()
+        self.thread = Thread(target=self._print_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self._print_line(final=True)
+
+    def _print_loop(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self._print_line()
+
+    def _format_amount(self, amount: float) -> str:
+        if self.unit == "B":
+            return f"{amount / 1048576:.1f} MiB"
+        return f"{amount:.0f} {self.unit}"
+
+    def _print_line(self, final: bool = False) -> None:
+        if self.poll:
+            try:
+                self.done = self.poll()
+            except FileNotFoundError:  # e.g. download hasn't started yet
+                pass
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.done / elapsed if elapsed else 0
+        line = f"{self.label}: {self._format_amount(self.done)}"
+        if self.total:
+            line += f" of {self._format_amount(self.total)} ({self.done / self.total:.0%})"
+        line += f", {self._format_amount(rate)}/s"
+        if final:
+            line += f", {elapsed:.1f}s"
+        elif self.total and rate:
+            line += f", ETA {max(self.total - self.done, 0) / rate:.0f}s"
+        if self.interactive:
+            print("\r\033[K" + line, end="\n" if final else "", flush=True)
+        else:
+            print(line, flush=True)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# Labels a rootfs for SELinux like `setfiles` does, without chrooting into it.
+# The file_contexts of the policy are loaded once and indexed by the literal directory every spec starts with, so a
+# path is only matched against the specs of its parent directories instead of all ~6000 regexes.
+# Files whose security.selinux xattr is already correct are not written, which makes relabeling an unchanged tree
+# almost free.
+# Matching follows libselinux: a spec without regex characters beats every regex, otherwise the spec that comes last
+# wins. file_contexts.homedirs and file_contexts.local come after file_contexts. Paths are first rewritten with
+# file_contexts.subs and file_contexts.subs_dist.
+
+import argparse
+import errno
+import multiprocessing
+import os
+import re
+import stat
+import time
+from functools import lru_cache
+
+from functions import *
+
+XATTR_NAME = "security.selinux"
+META_CHARS = ".^$?*+|[({\\"
+# file type flags of the specs
+FILE_TYPES = {"--": stat.S_IFREG, "-d": stat.S_IFDIR, "-l": stat.S_IFLNK, "-c": stat.S_IFCHR, "-b": stat.S_IFBLK,
+              "-s": stat.S_IFSOCK, "-p": stat.S_IFIFO}
+BATCH_SIZE = 2048
+
+matcher = None  # FileContexts used by __label_batch, the workers load their own in __init_worker
+
+
+class FileContexts:
+    def __init__(self, policy_dir: str):
+        start_time = time.perf_counter()
+        self.policy_dir = policy_dir
+        self.regex_specs = {}  # index key -> [(priority, compiled regex, file type, context)]
+        self.exact_specs = {}  # path -> [(priority, file type, context)]
+        self.substitutions = [[], []]  # (alias, path) of file_contexts.subs and file_contexts.subs_dist
+        self.customizable_types = set()
+        self.spec_count = 0
+
+        files_dir = f"{policy_dir}/contexts/files"
+        if not path_exists(f"{files_dir}/file_contexts"):
+            raise FileNotFoundError(f"{files_dir}/file_contexts")
+        for name in ["file_contexts", "file_contexts.homedirs", "file_contexts.local"]:
+            if path_exists(f"{files_dir}/{name}"):
+                self.__load_specs(f"{files_dir}/{name}")
+        # local substitutions are applied before the distribution ones
+        for substitutions, name in zip(self.substitutions, ["file_contexts.subs", "file_contexts.subs_dist"]):
+            if path_exists(f"{files_dir}/{name}"):
+                with open(f"{files_dir}/{name}", "r") as file:
+                    for line in file:
+                        fields = line.split()
+                        if len(fields) == 2 and not fields[0].startswith("#"):
+                            substitutions.append((fields[0].rstrip("/"), fields[1].rstrip("/") or "/"))
+        if path_exists(f"{policy_dir}/contexts/customizable_types"):
+            with open(f"{policy_dir}/contexts/customizable_types", "r") as file:
+                self.customizable_types = {line.strip() for line in file if line.strip()}
+        for specs in self.regex_specs.values():
+            specs.sort(key=lambda spec: spec[0], reverse=True)
+        self.load_time = time.perf_counter() - start_time
+
+    # Return the directory every path matching regex is in or below. The directory itself can match too.
+    @staticmethod
+    def __get_index_key(regex: str) -> str:
+        depth = 0
+        for char in regex:
+            depth += char == "("
+            depth -= char == ")"
+            if char == "|" and depth == 0:
+                return "/"  # alternatives of the whole spec can start anywhere
+
+        prefix = ""
+        index = 0
+        while index < len(regex):
+            if regex[index] == "\\" and index + 1 < len(regex) and not regex[index + 1].isalnum():
+                prefix += regex[index + 1]  # escaped literal, e.g. \.
+                index += 2
+            elif regex[index] in META_CHARS:
+                break
+            else:
+                prefix += regex[index]
+                index += 1
+        rest = regex[index:]
+        if rest[:1] in ("?", "*", "{"):
+            prefix = prefix[:-1]  # the character before the quantifier is optional
+
+        if prefix.endswith("/"):
+            return prefix.rstrip("/") or "/"
+        if rest.startswith("(/"):
+            # /usr/lib/foo(/.*)? matches /usr/lib/foo and everything below it
+            depth = 0
+            for index, char in enumerate(rest):
+                depth += char == "("
+                depth -= char == ")"
+                if depth == 0:
+                    if rest[index + 1:] in ("", "?"):
+                        return prefix or "/"
+                    break
+        return prefix[:prefix.rfind("/")] or "/"
+
+    @staticmethod
+    def __is_exact(regex: str) -> bool:
+        index = 0
+        while index < len(regex):
+            if regex[index] == "\\":
+                if index + 1 < len(regex) and regex[index + 1].isalnum():
+                    return False  # character classes like \d or \w
+                index += 2
+            elif regex[index] in META_CHARS:
+                return False
+            else:
+                index += 1
+        return True
+
+    @staticmethod
+    def __unescape(regex: str) -> str:
+        return re.sub(r"\\(.)", r"\1", regex)
+
+    def __load_specs(self, file_path: str) -> None:
+        with open(file_path, "r") as file:
+            for line_number, line in enumerate(file, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                if len(fields) == 2:
+                    regex, file_type, context = fields[0], 0, fields[1]
+                elif len(fields) == 3 and fields[1] in FILE_TYPES:
+                    regex, file_type, context = fields[0], FILE_TYPES[fields[1]], fields[2]
+                else:
+                    raise ValueError(f"{file_path}:{line_number}: invalid spec: {line.strip()}")
+                self.spec_count += 1
+                if self.__is_exact(regex):
+                    self.exact_specs.setdefault(self.__unescape(regex), []).append(
+                        (self.spec_count, file_type, context))
+                else:
+                    self.regex_specs.setdefault(self.__get_index_key(regex), []).append(
+                        (self.spec_count, re.compile(f"^(?:{regex})$"), file_type, context))
+
+    # The first matching alias of each file is replaced
+    def substitute(self, path: str) -> str:
+        for substitutions in self.substitutions:
+            for alias, real_path in substitutions:
+                if path == alias or path.startswith(alias + "/"):
+                    path = (real_path if real_path != "/" else "") + path[len(alias):] or "/"
+                    break
+        return path
+
+    # Specs of path and all its parent directories, the best ones first
+    @lru_cache(maxsize=4096)
+    def __get_candidates(self, dir_path: str) -> tuple:
+        candidates = self.regex_specs.get(dir_path, [])
+        if dir_path == "/":
+            return tuple(candidates)
+        parent_candidates = self.__get_candidates(os.path.dirname(dir_path))
+        if not candidates:
+            return parent_candidates
+        return tuple(sorted(candidates + list(parent_candidates), key=lambda spec: spec[0], reverse=True))
+
+    # Return the context for a path inside the rootfs, None if no spec matches
+    def lookup(self, path: str, mode: int) -> str:
+        path = self.substitute(path)
+        file_type = stat.S_IFMT(mode)
+        for _, spec_type, context in reversed(self.exact_specs.get(path, [])):
+            if not spec_type or spec_type == file_type:
+                return context
+        for _, regex, spec_type, context in self.__get_candidates(path):
+            if (not spec_type or spec_type == file_type) and regex.match(path):
+                return context
+        return None
+
+
+# Without force, only the type of an existing label is changed and customizable types are kept, like setfiles does
+def __get_new_context(current: str, context: str, customizable_types: set, force: bool) -> str:
+    if force or not current or current.count(":") < 3:
+        return context
+    current_fields = current.split(":", 3)
+    if current_fields[2] in customizable_types:
+        return current
+    new_fields = context.split(":", 3)
+    return ":".join(current_fields[:2] + [new_fields[2]] + current_fields[3:])
+
+
+def __label_batch(batch: list, root: str, force: bool) -> dict:
+    counts = {"changed": 0, "skipped": 0, "unmatched": 0}
+    for path, mode in batch:
+        context = matcher.lookup(path, mode)
+        if context is None or context == "<<none>>":
+            counts["unmatched"] += 1
+            continue
+        full_path = root + path if path != "/" else root
+        try:
+            current = os.getxattr(full_path, XATTR_NAME, follow_symlinks=False).rstrip(b"\0").decode()
+        except OSError as e:
+            if e.errno not in (errno.ENODATA, errno.ENOTSUP):
+                raise
+            current = ""
+        new_context = __get_new_context(current, context, matcher.customizable_types, force)
+        if new_context == current:
+            counts["skipped"] += 1
+            continue
+        # libselinux stores the context with its terminating null byte
+        os.setxattr(full_path, XATTR_NAME, new_context.encode() + b"\0", follow_symlinks=False)
+        counts["changed"] += 1
+    return counts
+
+
+def __label_batch_worker(batch_args: tuple) -> dict:
+    return __label_batch(*batch_args)
+
+
+def __init_worker(policy_dir: str) -> None:
+    global matcher
+    matcher = FileContexts(policy_dir)
+
+
+def __read_exclude_dirs(root: str) -> set:
+    exclude_dirs = set()
+    if path_exists(f"{root}/etc/selinux/fixfiles_exclude_dirs"):
+        with open(f"{root}/etc/selinux/fixfiles_exclude_dirs", "r") as file:
+            exclude_dirs = {line.strip().rstrip("/") for line in file if line.strip().startswith("/")}
+    return exclude_dirs
+
+
+# Yield batches of (path inside the rootfs, mode). Other filesystems mounted into the rootfs are not labeled.
+def __walk_tree(root: str, exclude_dirs: set):
+    root_device = os.lstat(root).st_dev
+    batch = [("/", os.lstat(root).st_mode)]
+    pending_dirs = ["/"]
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        with os.scandir(root + dir_path if dir_path != "/" else root) as entries:
+            for entry in entries:
+                path = f"{dir_path.rstrip('/')}/{entry.name}"
+                entry_stat = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    if entry_stat.st_dev != root_device or path in exclude_dirs:
+                        continue
+                    pending_dirs.append(path)
+                batch.append((path, entry_stat.st_mode))
+                if len(batch) >= BATCH_SIZE:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def get_policy_dir(root: str) -> str:
+    policy_type = "targeted"
+    if path_exists(f"{root}/etc/selinux/config"):
+        with open(f"{root}/etc/selinux/config", "r") as config:
+            for line in config:
+                if line.strip().startswith("SELINUXTYPE="):
+                    policy_type = line.split("=", 1)[1].strip()
+    return f"{root}/etc/selinux/{policy_type}"
+
+
+# Load the policy of the rootfs. Raises FileNotFoundError or ValueError if it can't be used.
+def load_file_contexts(root: str) -> FileContexts:
+    global matcher
+    matcher = FileContexts(get_policy_dir(root))
+    return matcher
+
+
+# Label every file of the rootfs at root, with the file contexts loaded by load_file_contexts() if they are passed.
+# Returns the counts and timings for the report.
+def relabel_tree(root: str, file_contexts: FileContexts = None, force: bool = False, jobs: int = 0) -> dict:
+    global matcher
+    root = os.path.abspath(root)
+    matcher = file_contexts or load_file_contexts(root)
+    start_time = time.perf_counter()
+    stats = {"specs": matcher.spec_count, "load_time": matcher.load_time, "visited": 0, "changed": 0, "skipped": 0,
+             "unmatched": 0}
+
+    batches = ((batch, root, force) for batch in __walk_tree(root, __read_exclude_dirs(root)))
+    jobs = jobs or os.cpu_count()
+    if jobs > 1:
+        # build.py runs the steps on threads, forking it could copy a lock held by another thread into the workers.
+        # They are started by the fork server instead and load the policy themselves.
+        with multiprocessing.get_context("forkserver").Pool(jobs, initializer=__init_worker,
+                                                            initargs=(matcher.policy_dir,)) as pool:
+            results = list(pool.imap_unordered(__label_batch_worker, batches))
+    else:
+        results = [__label_batch(*batch_args) for batch_args in batches]
+    for counts in results:
+        for key, value in counts.items():
+            stats[key] += value
+    stats["visited"] = stats["changed"] + stats["skipped"] + stats["unmatched"]
+    stats["time"] = time.perf_counter() - start_time
+    return stats
+
+
+def print_relabel_report(stats: dict) -> None:
+    print_status(f"Loaded {stats['specs']} file context specs in {stats['load_time']:.2f}s")
+    print_status(f"Visited {stats['visited']} files in {stats['time']:.1f}s: {stats['changed']} relabeled, "
+                 f"{stats['skipped']} already labeled, {stats['unmatched']} without context")
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Label a rootfs with the file contexts of its SELinux policy.")
+    parser.add_argument("root", help="Root directory of the rootfs.")
+    parser.add_argument("-F", "--force", action="store_true", dest="force", default=False,
+                        help="Replace the whole context of existing labels, not only the type.")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=0, help="Worker processes, default: one per core.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = process_args()
+    print_relabel_report(relabel_tree(args.root, force=args.force, jobs=args.jobs))
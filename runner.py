@@ -0,0 +1,171 @@
+# Streaming command runner of the build. Commands stream their output while they run, can time out and are logged
+# with their resource usage to the command log and the profile (profiler.py).
+# functions.bash() is the buffered upstream version, build.py uses bash() and run() from here.
+
+import json
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+from threading import Lock, RLock, Thread
+
+from functions import *
+import functions
+import profiler
+
+command_log = ""  # json lines file that every command run by run()/bash() is recorded to
+command_log_lock = Lock()
+running_groups = set()  # process groups of the commands that are running right now
+running_groups_lock = RLock()  # reentrant, the SIGINT handler takes it in the main thread
+
+
+# Raised when a command writes more than max_output bytes to stdout or stderr
+class OutputLimitExceeded(subprocess.SubprocessError):
+    def __init__(self, command, max_output: int):
+        super().__init__(f"Output of {command} exceeded {max_output} bytes")
+        self.command = command
+        self.max_output = max_output
+
+
+def set_command_log(new_log: str) -> None:
+    global command_log
+    command_log = new_log
+
+
+# return the output of a command
+def bash(command: str) -> str:
+    return run(command)["stdout"].strip()
+
+
+# Run a command and stream its output while it runs. Strings are run by a shell, lists are run directly.
+# stdout is printed if echo (default: verbose) is set, stderr is always printed. on_output(stream_name, data) is called
+# for every chunk of output. If max_output is set and a stream gets longer than that, the command is killed and
+# OutputLimitExceeded is raised.
+# Returns a dict with returncode, stdout, stderr, wall/user/system time and the peak RSS (KiB) of the command.
+def run(command, timeout: float = None, check: bool = True, echo: bool = None, cwd: str = None,
+        input_text: str = None, on_output=None, max_output: int = None) -> dict:
+    if echo is None:
+        echo = functions.verbose
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, shell=isinstance(command, str), cwd=cwd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL,
+                               start_new_session=True)  # own process group, so that timeouts kill all children
+    with running_groups_lock:
+        running_groups.add(process.pid)
+    try:
+        if input_text is not None:
+            Thread(target=__write_input, args=(process, input_text), daemon=True).start()
+
+        outputs = {"stdout": bytearray(), "stderr": bytearray()}
+        terminals = {"stdout": sys.stdout, "stderr": sys.stderr}
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+        deadline = start_time + timeout if timeout else None
+        while selector.get_map():
+            wait_time = None if deadline is None else deadline - time.perf_counter()
+            if wait_time is not None and wait_time <= 0:
+                __kill_process_group(process)
+                raise subprocess.TimeoutExpired(command, timeout, bytes(outputs["stdout"]), bytes(outputs["stderr"]))
+            for key, _ in selector.select(wait_time):
+                data = os.read(key.fileobj.fileno(), 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                if echo or key.data == "stderr":
+                    __write_terminal(terminals[key.data], data)
+                if on_output:
+                    on_output(key.data, data)
+                outputs[key.data] += data
+                if max_output is not None and len(outputs[key.data]) > max_output:
+                    __kill_process_group(process)
+                    raise OutputLimitExceeded(command, max_output)
+        selector.close()
+
+        result = wait_process(process, command, start_time)
+    finally:
+        with running_groups_lock:
+            running_groups.discard(process.pid)
+    process.stdout.close()
+    process.stderr.close()
+    result["stdout"] = outputs["stdout"].decode(errors="replace")
+    result["stderr"] = outputs["stderr"].decode(errors="replace")
+    log_command(result)
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, result["stdout"], result["stderr"])
+    return result
+
+
+# Reap a child and return its exit status and resource usage: wall/user/system time, peak RSS (KiB) and the bytes it
+# and its reaped children read and wrote. The io counters are read from /proc before the zombie is reaped.
+def wait_process(process: subprocess.Popen, command, start_time: float) -> dict:
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    process_io = profiler.read_process_io(str(process.pid))
+    # wait4 instead of wait to get the resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if not process_io:  # no /proc, fall back to the block counters of rusage
+        process_io = {"rchar": 0, "wchar": 0, "read_bytes": usage.ru_inblock * 512,
+                      "write_bytes": usage.ru_oublock * 512}
+    return {"command": command, "returncode": process.returncode, "wall_time": time.perf_counter() - start_time,
+            "user_time": usage.ru_utime, "system_time": usage.ru_stime, "max_rss": usage.ru_maxrss} | process_io
+
+
+def __write_terminal(terminal, data: bytes) -> None:
+    if hasattr(terminal, "buffer"):
+        terminal.buffer.write(data)
+    else:  # stdout/stderr have been replaced by a text stream
+        terminal.write(data.decode(errors="replace"))
+    terminal.flush()
+
+
+def __write_input(process: subprocess.Popen, input_text: str) -> None:
+    try:
+        process.stdin.write(input_text.encode())
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+
+
+def __kill_process_group(process: subprocess.Popen) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+# Commands run in their own process group, so Ctrl-C in the terminal doesn't reach them. The SIGINT is forwarded to
+# every running command before KeyboardInterrupt is raised in the main thread as usual.
+def __forward_interrupt(signal_number: int, frame) -> None:
+    with running_groups_lock:
+        groups = list(running_groups)
+    for group in groups:
+        try:
+            os.killpg(group, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+    signal.default_int_handler(signal_number, frame)
+
+
+if threading.current_thread() is threading.main_thread():  # signal handlers can only be set from the main thread
+    signal.signal(signal.SIGINT, __forward_interrupt)
+
+
+# Append the timings of a command to the command log and the profile, output is not logged
+def log_command(result: dict) -> None:
+    record = {key: value for key, value in result.items() if key not in ["stdout", "stderr"]}
+    record["finished"] = time.time()
+    record["stage"] = profiler.current_stage
+    with command_log_lock:
+        profiler.profile["commands"].append(record)
+        if command_log:
+            with open(command_log, "a") as log:
+                log.write(json.dumps(record) + "\n")
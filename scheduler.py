@@ -0,0 +1,131 @@
+# Runs the steps of a build stage as a dependency graph.
+# Every step is a dict with:
+#   name: unique name of the step
+#   function, args: what to run
+#   inputs: names of things the step needs, e.g. "rootfs". The step waits for every step that lists them in outputs.
+#   outputs: names of things the step produces
+#   resources: things only one step can use at a time, e.g. "dnf" or "mounts"
+# Independent steps run at the same time on a thread pool. The timings of all steps are kept for critical_path().
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from functions import *
+
+# name -> {"start", "end", "blocked_by"} of every step that was run, times are relative to the first step
+step_timings = {}
+start_time = 0.0
+last_step = ""  # step that finished last in the previous run_steps(), the steps of the next run wait for it
+
+
+def step(function, args: list = None, inputs: list = None, outputs: list = None, resources: list = None,
+         name: str = "") -> dict:
+    return {"name": name or function.__name__, "function": function, "args": args or [], "inputs": inputs or [],
+            "outputs": outputs or [], "resources": resources or []}
+
+
+# Every step depends on the steps that produce its inputs. Inputs nobody in steps produces have to exist already.
+def __get_dependencies(steps: list) -> dict:
+    producers = {}
+    for current_step in steps:
+        for output in current_step["outputs"]:
+            producers.setdefault(output, []).append(current_step["name"])
+    dependencies = {current_step["name"]: set() for current_step in steps}
+    for current_step in steps:
+        for step_input in current_step["inputs"]:
+            dependencies[current_step["name"]].update(producers.get(step_input, []))
+        dependencies[current_step["name"]].discard(current_step["name"])
+
+    # a cycle would make the scheduler wait forever
+    visited = set()
+    for name in dependencies:
+        path = [name]
+        stack = [iter(dependencies[name])]
+        while stack:
+            dependency = next(stack[-1], None)
+            if dependency is None:
+                visited.add(path.pop())
+                stack.pop()
+            elif dependency in path:
+                raise ValueError(f"Steps depend on each other: {' -> '.join(path + [dependency])}")
+            elif dependency not in visited:
+                path.append(dependency)
+                stack.append(iter(dependencies[dependency]))
+    return dependencies
+
+
+# Run all steps, returns the return values of the step functions by step name
+def run_steps(steps: list, workers: int = 4) -> dict:
+    global start_time, last_step
+    if not start_time:
+        start_time = time.perf_counter()
+    dependencies = __get_dependencies(steps)
+    pending = {current_step["name"]: current_step for current_step in steps}
+    running = {}  # future -> step
+    finished = set()
+    busy_resources = set()
+    last_users = {}  # resource -> step that released it last
+    results = {}
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # start every step whose dependencies are done and whose resources are free, in the declared order
+            if not errors:
+                for name, current_step in list(pending.items()):
+                    if not dependencies[name] <= finished or busy_resources & set(current_step["resources"]):
+                        continue
+                    del pending[name]
+                    busy_resources.update(current_step["resources"])
+                    # whatever finished last before this step could start was holding it back
+                    blockers = list(dependencies[name]) + [last_users[resource] for resource in
+                                                           current_step["resources"] if resource in last_users]
+                    step_timings[name] = {"start": time.perf_counter() - start_time, "end": 0.0,
+                                          "blocked_by": max(blockers, key=lambda b: step_timings[b]["end"],
+                                                            default=last_step)}
+                    running[executor.submit(current_step["function"], *current_step["args"])] = current_step
+            if not running:
+                break  # a step failed, nothing is running anymore
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                current_step = running.pop(future)
+                step_timings[current_step["name"]]["end"] = time.perf_counter() - start_time
+                busy_resources.difference_update(current_step["resources"])
+                for resource in current_step["resources"]:
+                    last_users[resource] = current_step["name"]
+                try:
+                    results[current_step["name"]] = future.result()
+                    finished.add(current_step["name"])
+                except Exception as e:
+                    print_error(f"Step {current_step['name']} failed")
+                    errors.append(e)
+                last_step = current_step["name"]
+    if errors:
+        raise errors[0]
+    return results
+
+
+# The chain of steps that determined the total build time. Starts at the step that finished last and follows the step
+# that was holding it back.
+def critical_path() -> list:
+    if not step_timings:
+        return []
+    path = [max(step_timings, key=lambda name: step_timings[name]["end"])]
+    while step_timings[path[-1]]["blocked_by"]:
+        path.append(step_timings[path[-1]]["blocked_by"])
+    return list(reversed(path))
+
+
+def print_critical_path() -> None:
+    path = critical_path()
+    if not path:
+        return
+    total_time = max(timing["end"] for timing in step_timings.values())
+    busy_time = sum(timing["end"] - timing["start"] for timing in step_timings.values())
+    print_header("Critical path")
+    print(f"{'step':<32}{'start':>10}{'time':>10}")
+    for name in path:
+        timing = step_timings[name]
+        print(f"{name:<32}{timing['start']:>9.1f}s{timing['end'] - timing['start']:>9.1f}s")
+    print(f"{len(step_timings)} steps ran for {busy_time:.1f}s in {total_time:.1f}s "
+          f"({busy_time / total_time if total_time else 0:.1f}x parallel)")
@@ -0,0 +1,48 @@
+# Reading sparse files (the image) without reading their holes
+
+import errno
+import os
+
+
+# Return the (offset, length) ranges of a file that contain data. Holes are skipped with SEEK_DATA/SEEK_HOLE, if the
+# filesystem doesn't support them the whole file is returned as one range.
+def get_data_ranges(file_path: str) -> list:
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if not hasattr(os, "SEEK_DATA"):
+            return [(0, size)] if size else []
+        ranges = []
+        offset = 0
+        while offset < size:
+            try:
+                data_start = os.lseek(file.fileno(), offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # only a hole is left
+                    break
+                return [(0, size)]  # SEEK_DATA is not supported by the filesystem
+            data_end = min(os.lseek(file.fileno(), data_start, os.SEEK_HOLE), size)
+            ranges.append((data_start, data_end - data_start))
+            offset = data_end
+        return ranges
+
+
+# Yield the content of a file as data chunks (bytes) and holes (int, length of the hole). Holes are never read.
+def read_sparse_chunks(file_path: str, data_ranges: list = None, chunk_size: int = 8388608):
+    if data_ranges is None:
+        data_ranges = get_data_ranges(file_path)
+    with open(file_path, "rb", buffering=0) as file:
+        size = os.fstat(file.fileno()).st_size
+        position = 0
+        for offset, length in data_ranges:
+            if offset > position:
+                yield offset - position
+            end = offset + length
+            while offset < end:
+                chunk = os.pread(file.fileno(), min(chunk_size, end - offset), offset)
+                if not chunk:  # file was truncated while reading
+                    break
+                yield chunk
+                offset += len(chunk)
+            position = end
+        if size > position:
+            yield size - position
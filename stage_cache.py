@@ -0,0 +1,216 @@
+# Content-addressed cache for the outputs of the build.py stages.
+# Every stage is keyed by the hash of its inputs (files, directories, git clones and the source files of the build) and
+# the key of the stage before it. After a stage finished, its output (the image file or a staging tree) and the files it
+# left for later stages are stored under that key.
+# A rebuild restores the newest stage whose key is still valid and continues from there.
+
+import hashlib
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+
+from functions import *
+from filesystem import cpfile, rmdir
+from runner import run
+
+cache_dir = "/var/cache/eupneaos-build/stages"
+max_cache_size = 50 * 1073741824  # bytes, least recently used snapshots are evicted above this size
+
+
+def set_cache_dir(new_dir: str) -> None:
+    global cache_dir
+    cache_dir = new_dir
+
+
+def set_max_cache_size(new_size: int) -> None:
+    global max_cache_size
+    max_cache_size = new_size
+
+
+#######################################################################################
+#                                 INPUT HASHING                                       #
+#######################################################################################
+# Hashing the multi-GB tarballs on every run would be slow, so file hashes are remembered by path, size, mtime and inode
+def __load_file_hashes() -> dict:
+    try:
+        with open(f"{cache_dir}/file-hashes.json", "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def __save_file_hashes(file_hashes: dict) -> None:
+    mkdir(cache_dir, create_parents=True)
+    with open(f"{cache_dir}/file-hashes.json.tmp", "w") as file:
+        json.dump(file_hashes, file)
+    os.replace(f"{cache_dir}/file-hashes.json.tmp", f"{cache_dir}/file-hashes.json")
+
+
+def __hash_file(file_path: str, file_hashes: dict) -> str:
+    file_stat = os.stat(file_path)
+    file_id = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+    absolute_path = os.path.abspath(file_path)
+    if absolute_path in file_hashes and file_hashes[absolute_path][:3] == file_id:
+        return file_hashes[absolute_path][3]
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb", buffering=0) as file:
+        while chunk := file.read(8388608):
+            file_hash.update(chunk)
+    file_hashes[absolute_path] = file_id + [file_hash.hexdigest()]
+    return file_hash.hexdigest()
+
+
+# Git clones are identified by their HEAD commit plus the content of every modified or untracked file.
+# If git can't read the clone, all of its files are hashed instead.
+def __hash_git_repo(repo_path: str, input_hash, file_hashes: dict) -> None:
+    try:
+        head = run(["git", "-C", repo_path, "rev-parse", "HEAD"], echo=False)["stdout"]
+        changes = run(["git", "-C", repo_path, "status", "--porcelain", "-z", "--untracked-files=all"],
+                      echo=False)["stdout"]
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # with sudo git refuses clones owned by another user ("dubious ownership")
+        print_warning(f"Couldn't read the git state of {repo_path}, hashing its files instead")
+        __hash_dir(repo_path, input_hash, file_hashes)
+        return
+    input_hash.update(head.encode())
+    for entry in sorted(filter(None, changes.split("\0"))):
+        input_hash.update(entry.encode())
+        changed_path = f"{repo_path}/{entry[3:]}"
+        if os.path.isfile(changed_path) and not os.path.islink(changed_path):
+            input_hash.update(__hash_file(changed_path, file_hashes).encode())
+
+
+def __hash_dir(dir_path: str, input_hash, file_hashes: dict) -> None:
+    for root, dirs, files in os.walk(dir_path):
+        dirs[:] = sorted(name for name in dirs if name != ".git")  # git metadata is not an input of the build
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            input_hash.update(os.path.relpath(file_path, dir_path).encode() + b"\0")
+            if os.path.islink(file_path):
+                input_hash.update(b"link:" + os.readlink(file_path).encode())
+            else:
+                input_hash.update(oct(os.stat(file_path).st_mode).encode())
+                input_hash.update(__hash_file(file_path, file_hashes).encode())
+
+
+# Hash a list of input paths and any extra data the stage depends on
+def hash_stage_inputs(input_paths: list, extra: str = "") -> str:
+    file_hashes = __load_file_hashes()
+    input_hash = hashlib.sha256(extra.encode())
+    for input_path in input_paths:
+        input_hash.update(b"\0path:" + input_path.encode())
+        if not os.path.exists(input_path):
+            input_hash.update(b"missing")
+        elif os.path.isdir(f"{input_path}/.git"):
+            __hash_git_repo(input_path, input_hash, file_hashes)
+        elif os.path.isdir(input_path):
+            __hash_dir(input_path, input_hash, file_hashes)
+        else:
+            input_hash.update(__hash_file(input_path, file_hashes).encode())
+    __save_file_hashes(file_hashes)
+    return input_hash.hexdigest()
+
+
+# The key of a stage includes the key of the stage before it, so changing an early stage invalidates all later ones
+def get_stage_key(previous_key: str, stage_name: str, inputs_hash: str) -> str:
+    return hashlib.sha256(f"{previous_key}\0{stage_name}\0{inputs_hash}".encode()).hexdigest()
+
+
+#######################################################################################
+#                                  SNAPSHOTS                                          #
+#######################################################################################
+def __entry_dir(key: str) -> str:
+    return f"{cache_dir}/{key}"
+
+
+def __read_entry(key: str) -> dict:
+    with open(f"{__entry_dir(key)}/stage.json", "r") as file:
+        return json.load(file)
+
+
+def __write_entry(key: str, entry: dict) -> None:
+    with open(f"{__entry_dir(key)}/stage.json.tmp", "w") as file:
+        json.dump(entry, file, indent=2)
+    os.replace(f"{__entry_dir(key)}/stage.json.tmp", f"{__entry_dir(key)}/stage.json")
+
+
+def __allocated_size(path: str) -> int:
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_blocks * 512
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            size += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return size
+
+
+# Copy an image file or a tree. Reflinks are used where the filesystem supports them, holes are kept.
+def __copy_snapshot(src: str, dst: str) -> None:
+    if os.path.isdir(src):
+        run(["cp", "-a", "--reflink=auto", f"{src}/.", dst])
+    else:
+        run(["cp", "--reflink=auto", "--sparse=always", src, dst])
+
+
+def has_snapshot(key: str) -> bool:
+    return path_exists(f"{__entry_dir(key)}/stage.json")
+
+
+# files are small files outside of src that later stages read, e.g. the kernel cmdline
+def store_snapshot(key: str, stage_name: str, src: str, files: list = None) -> None:
+    print_status(f"Caching output of {stage_name}")
+    start_time = time.perf_counter()
+    if path_exists(__entry_dir(key)):
+        rmdir(__entry_dir(key))
+    mkdir(__entry_dir(key), create_parents=True)
+    snapshot_path = f"{__entry_dir(key)}/snapshot"
+    if os.path.isdir(src):
+        mkdir(snapshot_path)
+    __copy_snapshot(src, snapshot_path)
+    files = files or []
+    mkdir(f"{__entry_dir(key)}/files")
+    for index, file_path in enumerate(files):
+        cpfile(file_path, f"{__entry_dir(key)}/files/{index}", preserve=True)
+    __write_entry(key, {"stage": stage_name, "key": key, "created": time.time(), "last_used": time.time(),
+                        "size": __allocated_size(snapshot_path), "files": files})
+    print_status(f"Cached {stage_name} in {time.perf_counter() - start_time:.1f}s")
+    evict_snapshots(keep=[key])
+
+
+def restore_snapshot(key: str, dst: str) -> None:
+    entry = __read_entry(key)
+    print_status(f"Restoring cached output of {entry['stage']}")
+    snapshot_path = f"{__entry_dir(key)}/snapshot"
+    if os.path.isdir(snapshot_path):
+        if path_exists(dst):
+            rmdir(dst)
+        mkdir(dst, create_parents=True)
+    else:
+        rmfile(dst)
+    __copy_snapshot(snapshot_path, dst)
+    for index, file_path in enumerate(entry.get("files", [])):
+        cpfile(f"{__entry_dir(key)}/files/{index}", file_path, preserve=True)
+    entry["last_used"] = time.time()
+    __write_entry(key, entry)
+
+
+# Remove least recently used snapshots until the cache fits into max_cache_size
+def evict_snapshots(keep: list = None) -> None:
+    keep = keep or []
+    if not path_exists(cache_dir):
+        return
+    entries = []
+    for entry_dir in Path(cache_dir).iterdir():
+        if entry_dir.is_dir() and entry_dir.joinpath("stage.json").exists():
+            entries.append(__read_entry(entry_dir.name))
+    total_size = sum(entry["size"] for entry in entries)
+    for entry in sorted(entries, key=lambda e: e["last_used"]):
+        if total_size <= max_cache_size:
+            break
+        if entry["key"] in keep:
+            continue
+        print_status(f"Evicting cached {entry['stage']} ({entry['size'] / 1073741824:.1f} GiB)")
+        rmdir(__entry_dir(entry["key"]), keep_dir=False)
+        total_size -= entry["size"]
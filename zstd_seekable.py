@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Seekable zstd archives of raw images.
+# The image is split into FRAME_SIZE frames that are compressed independently with long distance matching, so they
+# can be compressed and decompressed in parallel. A seek table in a skippable frame at the end lists the size of every
+# frame (https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md).
+# zstd skips that frame, so `zstd -dc eupneaos-uefi.img.zst | dd of=/dev/sdX` works as well.
+# Frames that only contain zeros (the holes of the sparse image) are compressed once and reused.
+
+import argparse
+import hashlib
+import os
+import stat
+import struct
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import *
+from sparse import read_sparse_chunks
+
+FRAME_SIZE = 67108864
+WINDOW_LOG = 26  # the whole frame is in the long distance matching window
+ZSTD_LEVEL = 15
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+FOOTER_SIZE = 9
+# every job holds a frame and a zstd process with a 64 MiB window, more than 8 use a lot of memory for little gain
+DEFAULT_JOBS = min(os.cpu_count() or 1, 8)
+
+
+def compress_frame(data: bytes, level: int) -> bytes:
+    # every frame has a content checksum and its size in the header
+    return subprocess.run(["zstd", f"-{level}", f"--long={WINDOW_LOG}", "-T1", "-q", "-c", "--check",
+                           f"--stream-size={len(data)}"], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+def decompress_frame(frame: bytes) -> bytes:
+    return subprocess.run(["zstd", "-d", f"--long={WINDOW_LOG}", "-q", "-c"], input=frame, stdout=subprocess.PIPE,
+                          check=True).stdout
+
+
+# Writes a seekable archive from a stream. The frames are compressed on a thread pool and written in order, at most
+# jobs + 2 frames (FRAME_SIZE each) are kept in memory.
+class SeekableWriter:
+    def __init__(self, output_path: str, level: int = ZSTD_LEVEL, jobs: int = 0):
+        self.output = open(output_path, "wb")
+        self.output_hash = hashlib.sha256()
+        self.level = level
+        self.jobs = jobs or DEFAULT_JOBS
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.running = deque()  # futures of the compressed frames, in order
+        self.frames = []  # (compressed size, decompressed size)
+        self.pieces = []  # data (bytes) and holes (int) of the next frame
+        self.pieces_size = 0
+        self.zero_frames = {}  # decompressed size -> future of the compressed zero frame
+
+    def __submit_frame(self) -> None:
+        if all(isinstance(piece, int) for piece in self.pieces):
+            if self.pieces_size not in self.zero_frames:
+                self.zero_frames[self.pieces_size] = self.executor.submit(compress_frame, bytes(self.pieces_size),
+                                                                          self.level)
+            future = self.zero_frames[self.pieces_size]
+        else:
+            data = b"".join(bytes(piece) if isinstance(piece, int) else piece for piece in self.pieces)
+            future = self.executor.submit(compress_frame, data, self.level)
+        self.running.append((future, self.pieces_size))
+        self.pieces = []
+        self.pieces_size = 0
+        while len(self.running) > self.jobs + 2:
+            self.__write_frame()
+
+    def __write_frame(self) -> None:
+        future, size = self.running.popleft()
+        frame = future.result()
+        self.output.write(frame)
+        self.output_hash.update(frame)
+        self.frames.append((len(frame), size))
+
+    def __add(self, piece, length: int) -> None:
+        self.pieces.append(piece)
+        self.pieces_size += length
+        if self.pieces_size == FRAME_SIZE:
+            self.__submit_frame()
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while len(view):
+            length = min(len(view), FRAME_SIZE - self.pieces_size)
+            self.__add(bytes(view[:length]), length)
+            view = view[length:]
+
+    def write_zeros(self, length: int) -> None:
+        while length:
+            piece = min(length, FRAME_SIZE - self.pieces_size)
+            self.__add(piece, piece)
+            length -= piece
+
+    def close(self) -> None:
+        if self.pieces_size:
+            self.__submit_frame()
+        while self.running:
+            self.__write_frame()
+        self.executor.shutdown()
+        entries = b"".join(struct.pack("<II", compressed, decompressed) for compressed, decompressed in self.frames)
+        footer = struct.pack("<IBI", len(self.frames), 0, SEEKABLE_MAGIC)  # no checksums, the frames have their own
+        seek_table = struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + FOOTER_SIZE) + entries + footer
+        self.output.write(seek_table)
+        self.output_hash.update(seek_table)
+        self.output.close()
+
+    def hexdigest(self) -> str:
+        return self.output_hash.hexdigest()
+
+
+def compress_file(image_path: str, output_path: str, level: int = ZSTD_LEVEL, jobs: int = 0) -> str:
+    writer = SeekableWriter(output_path, level, jobs)
+    for chunk in read_sparse_chunks(image_path):
+        if isinstance(chunk, int):
+            writer.write_zeros(chunk)
+        else:
+            writer.write(chunk)
+    writer.close()
+    return writer.hexdigest()
+
+
+# Return the (offset in the archive, compressed size, offset in the image, decompressed size) of every frame
+def read_seek_table(archive_path: str) -> list:
+    with open(archive_path, "rb") as archive:
+        archive_size = os.fstat(archive.fileno()).st_size
+        frame_count, descriptor, magic = struct.unpack("<IBI", os.pread(archive.fileno(), FOOTER_SIZE,
+                                                                        archive_size - FOOTER_SIZE))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError(f"{archive_path} is not a seekable zstd archive")
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = frame_count * entry_size + FOOTER_SIZE
+        table_start = archive_size - table_size - 8
+        skippable_magic, frame_size = struct.unpack("<II", os.pread(archive.fileno(), 8, table_start))
+        if skippable_magic != SKIPPABLE_MAGIC or frame_size != table_size:
+            raise ValueError(f"Seek table of {archive_path} is corrupted")
+        entries = os.pread(archive.fileno(), frame_count * entry_size, table_start + 8)
+    frames = []
+    archive_offset = 0
+    image_offset = 0
+    for index in range(frame_count):
+        compressed, decompressed = struct.unpack_from("<II", entries, index * entry_size)
+        frames.append((archive_offset, compressed, image_offset, decompressed))
+        archive_offset += compressed
+        image_offset += decompressed
+    if archive_offset != table_start:
+        raise ValueError(f"Seek table of {archive_path} doesn't match the frames")
+    return frames
+
+
+# Decompress an archive into a file or straight onto a block device, jobs frames at a time. Zero frames are left as
+# holes in regular files. Returns the amount of bytes written.
+def decompress_file(archive_path: str, output_path: str, jobs: int = 0) -> int:
+    frames = read_seek_table(archive_path)
+    image_size = sum(frame[3] for frame in frames)
+    is_file = not path_exists(output_path) or stat.S_ISREG(os.stat(output_path).st_mode)
+    output_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    archive_fd = os.open(archive_path, os.O_RDONLY)
+    written = 0
+    try:
+        if is_file:
+            os.ftruncate(output_fd, 0)
+            os.ftruncate(output_fd, image_size)
+
+        def decompress(frame: tuple) -> int:
+            archive_offset, compressed, image_offset, decompressed = frame
+            data = decompress_frame(os.pread(archive_fd, compressed, archive_offset))
+            if len(data) != decompressed:
+                raise ValueError(f"Frame at {archive_offset} of {archive_path} has the wrong size")
+            if is_file and data.count(0) == len(data):
+                return 0
+            view = memoryview(data)
+            while len(view):
+                view = view[os.pwrite(output_fd, view, image_offset + decompressed - len(view)):]
+            return decompressed
+
+        with ThreadPoolExecutor(max_workers=jobs or DEFAULT_JOBS) as executor:
+            written = sum(executor.map(decompress, frames))
+        os.fsync(output_fd)
+    finally:
+        os.close(archive_fd)
+        os.close(output_fd)
+    return written
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Create and extract seekable zstd archives of images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compress_parser = subparsers.add_parser("compress", help="Compress an image.")
+    compress_parser.add_argument("image", help="Raw image file.")
+    compress_parser.add_argument("--output", dest="output", default="", help="Archive path, default: <image>.zst")
+    compress_parser.add_argument("--level", dest="level", type=int, default=ZSTD_LEVEL, help="zstd level, 1-19.")
+    decompress_parser = subparsers.add_parser("decompress", help="Extract an archive to a file or a block device.")
+    decompress_parser.add_argument("archive", help="Seekable zstd archive.")
+    decompress_parser.add_argument("output", help="Image file or block device, e.g. /dev/sdX.")
+    info_parser = subparsers.add_parser("info", help="List the frames of an archive.")
+    info_parser.add_argument("archive", help="Seekable zstd archive.")
+    for subparser in [compress_parser, decompress_parser]:
+        subparser.add_argument("--jobs", dest="jobs", type=int, default=0,
+                               help=f"Frames processed at the same time, default: {DEFAULT_JOBS}. Up to jobs + 2 "
+                                    f"frames of {FRAME_SIZE // 1048576} MiB are kept in memory, plus a zstd process "
+                                    f"with a {2 ** WINDOW_LOG // 1048576} MiB window per job.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = process_args()
+    start_time = time.perf_counter()
+    if args.command == "compress":
+        compress_file(args.image, args.output or f"{args.image}.zst", args.level, args.jobs)
+        print_status(f"Compressed {args.image} in {time.perf_counter() - start_time:.1f}s")
+    elif args.command == "decompress":
+        bytes_written = decompress_file(args.archive, args.output, args.jobs)
+        print_status(f"Wrote {bytes_written / 1048576:.0f} MiB to {args.output} in "
+                     f"{time.perf_counter() - start_time:.1f}s")
+    else:
+        seek_table = read_seek_table(args.archive)
+        for archive_offset, compressed_size, image_offset, decompressed_size in seek_table:
+            print(f"{image_offset:>14} {decompressed_size:>10} -> {archive_offset:>14} {compressed_size:>10}")
+        total_size = sum(frame[3] for frame in seek_table)
+        archive_size = os.path.getsize(args.archive)
+        print(f"{len(seek_table)} frames, {total_size / 1048576:.0f} MiB in {archive_size / 1048576:.1f} MiB "
+              f"({archive_size / max(total_size, 1) * 100:.1f}%)")